@@ -1,15 +1,55 @@
 """Clone directory/file structure of Obsidian notebooks related to SQL and database learning"""
-import os, shutil
-from typing import List 
+import os, shutil, json, hashlib, argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple 
+
+# manifest of the synced source files, kept in the destination
+MANIFEST_NAME = ".clone_manifest.json"
+
+HASH_CHUNK = 2**20
 
 class InvalidDirectoryError(ValueError):
     def __init__(self, dest: str) -> None:
         super().__init__(f"{dest} is not a valid directory")
 
+def fileHash(path: str) -> str:
+    """BLAKE2b digest of a file's content"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def walkFiles(root: str, rel: str="") -> List[Tuple[str, os.stat_result]]:
+    """Relative path and stat of every file under `root`/`rel`, recursively"""
+    found = []
+    stack = [rel]
+    while stack:
+        sub = stack.pop()
+        with os.scandir(os.path.join(root, sub)) as it:
+            for entry in it:
+                path = f"{sub}/{entry.name}" if sub else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file():
+                    found.append((path, entry.stat()))
+    return found
+
 class cloneObsidian:
+    """
+    Copy `folders` and `files` from `obsidian_path` to `dest`
+
+    By default, files that exist in `dest` are skipped. With `sync`,
+    folders are walked recursively and `dest` keeps a manifest of the
+    size, mtime and content hash of every source file, so only new or
+    changed files are copied, by a pool of `workers` threads. Files
+    whose size and mtime are unchanged are not read at all. `dry_run`
+    only reports what would be copied.
+    """
     def __init__(self, folders: List[str]=None, files: List[str]=None, 
                 dest: str=r"./Obsidian notebooks/",
-                obsidian_path: str=None):
+                obsidian_path: str=None, sync: bool=False,
+                dry_run: bool=False, workers: int=8):
         
         if not os.path.isdir(dest):
             raise InvalidDirectoryError(dest)
@@ -19,9 +59,13 @@ class cloneObsidian:
                 
         self.dest = dest 
         self.obsidian_path = obsidian_path
+        self.workers = workers
         
-        self.copyFiles(files)
-        self.copyFolder(folders)
+        if sync:
+            self.report = self.syncTree(folders, files, dry_run=dry_run)
+        else:
+            self.copyFiles(files)
+            self.copyFolder(folders)
         
     def copyFiles(self, files: List[str]) -> int:
         """
@@ -74,12 +118,143 @@ class cloneObsidian:
             
         print(f"\nTotal added files: {added_files}")
         print(f"Total added folders: {added_folders}")
-            
-obsidian_path = r"C:/Users/delbe/Downloads/wut/wut/Post_grad/UBC/Research/records/obsidian notes/Literature/Computational/"
-dest_path = r"./Obsidian notebooks/"
-folders = ["Web Scraping - Mitchell"]
-files = None
-
-cloneObsidian(folders=folders, files=files, 
-            obsidian_path=obsidian_path, 
-            dest=dest_path)
\ No newline at end of file
+
+    # ------------------------------------------------------------------------ #
+
+    def loadManifest(self) -> Dict[str, dict]:
+        path = os.path.join(self.dest, MANIFEST_NAME)
+        if not os.path.isfile(path):
+            return dict()
+        with open(path, mode='r', encoding='utf8') as f:
+            return json.load(f)
+
+    def saveManifest(self, manifest: Dict[str, dict]) -> None:
+        path = os.path.join(self.dest, MANIFEST_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, mode='w', encoding='utf8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    def _sources(self, folders: List[str], files: List[str]) -> List[Tuple[str, os.stat_result]]:
+        sources = []
+        for folder in folders or []:
+            if not os.path.isdir(self.obsidian_path + folder):
+                raise InvalidDirectoryError(self.obsidian_path + folder)
+            sources.extend(walkFiles(self.obsidian_path, folder))
+
+        for f in files or []:
+            src_f = self.obsidian_path + f
+            if not os.path.isfile(src_f):
+                raise ValueError(f"{src_f} is not a valid file")
+            sources.append((f, os.stat(src_f)))
+
+        return sources
+
+    def _check(self, rel: str, st: os.stat_result, entry: dict) -> Tuple[str, dict]:
+        """Whether `rel` is 'new', 'changed' or 'unchanged', and its manifest entry"""
+
+        dest_st = None
+        try:
+            dest_st = os.stat(self.dest + rel)
+        except FileNotFoundError:
+            pass
+
+        if (entry is not None) and (dest_st is not None) and \
+            (entry["size"] == st.st_size == dest_st.st_size) and \
+            (entry["mtime_ns"] == st.st_mtime_ns):
+            return "unchanged", entry
+
+        new_entry = {
+            "size" : st.st_size, "mtime_ns" : st.st_mtime_ns,
+            "hash" : fileHash(self.obsidian_path + rel),
+        }
+
+        if dest_st is None:
+            return "new", new_entry
+
+        # touched but same content, or copied before the manifest existed
+        if (entry is not None) and (entry["hash"] == new_entry["hash"]) and \
+            (dest_st.st_size == st.st_size):
+            return "unchanged", new_entry
+        if (entry is None) and (dest_st.st_size == st.st_size) and \
+            (fileHash(self.dest + rel) == new_entry["hash"]):
+            return "unchanged", new_entry
+
+        return "changed", new_entry
+
+    def _copy(self, rel: str) -> None:
+        dest_f = self.dest + rel
+        os.makedirs(os.path.dirname(dest_f) or ".", exist_ok=True)
+        shutil.copy2(self.obsidian_path + rel, dest_f)
+
+    def syncTree(self, folders: List[str]=None, files: List[str]=None,
+                dry_run: bool=False) -> Dict[str, List[str]]:
+        """
+        Copy new and changed files of `folders` (recursively) and `files`
+        Returns the relative paths that are new, changed, unchanged and
+        no longer in the source
+        """
+        manifest = self.loadManifest()
+        sources = self._sources(folders, files)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            checked = list(pool.map(
+                lambda s: self._check(s[0], s[1], manifest.get(s[0])), sources
+            ))
+
+            report = {"new" : [], "changed" : [], "unchanged" : []}
+            updated = dict()
+            for (rel, _), (state, entry) in zip(sources, checked):
+                report[state].append(rel)
+                updated[rel] = entry
+
+            to_copy = report["new"] + report["changed"]
+            if not dry_run:
+                # raises the first failed copy, after the others finished
+                list(pool.map(self._copy, to_copy))
+
+        roots = tuple(f"{folder}/" for folder in folders or [])
+        report["removed"] = sorted(
+            rel for rel in manifest if (rel not in updated) and
+            (rel.startswith(roots) or rel in (files or []))
+        )
+
+        for state in ("new", "changed"):
+            for rel in report[state]:
+                print(f"{'Would copy' if dry_run else 'Copied'} {state} {rel}")
+        for rel in report["removed"]:
+            print(f"No longer in source: {rel}")
+
+        print(
+            f"\n{len(to_copy)} files {'to copy' if dry_run else 'copied'}, "
+            f"{len(report['unchanged'])} unchanged, "
+            f"{len(report['removed'])} removed from source."
+        )
+
+        if not dry_run:
+            # entries of other folders stay, removed files are forgotten
+            for rel in report["removed"]:
+                manifest.pop(rel, None)
+            manifest.update(updated)
+            self.saveManifest(manifest)
+
+        return report
+
+if __name__ == '__main__':
+    obsidian_path = r"C:/Users/delbe/Downloads/wut/wut/Post_grad/UBC/Research/records/obsidian notes/Literature/Computational/"
+    dest_path = r"./Obsidian notebooks/"
+    folders = ["Web Scraping - Mitchell"]
+    files = None
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sync', action='store_true',
+                        help="copy only new or changed files, recursively")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="with --sync, only report what would be copied")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    cloneObsidian(folders=folders, files=files,
+                obsidian_path=obsidian_path,
+                dest=dest_path, sync=args.sync, dry_run=args.dry_run,
+                workers=args.workers)
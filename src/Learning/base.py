@@ -1,12 +1,19 @@
 """Commonly used functions and methods"""
-import pandas as pd 
-import numpy as np 
-import sys 
-import os 
+import pandas as pd
+import numpy as np
+import io
+import time
+import traceback
+import tracemalloc
+
+from contextlib import nullcontext, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Union
 
 class TestRuntimeError(Exception):
-    def __init__(self, func_name, test_input) -> None:
-        super().__init__(f"Function {func_name} failed to run on input:\n{test_input}")
+    def __init__(self, func_name, test_input, cause: str=None) -> None:
+        msg = f"Function {func_name} failed to run on input:\n{test_input}"
+        super().__init__(msg if cause is None else f"{msg}\n{cause}")
 
 class TestAssertionError(AssertionError):
     def __init__(self, func_name: str, test_input, test_output, true_output) -> None:
@@ -15,48 +22,230 @@ class TestAssertionError(AssertionError):
             Output was{test_output}.\nExpected output was {true_output}"
         )
 
-class CommonTest:
-    def __init__(self, func, test_inputs: list, true_outputs: list, suppress_printing=True) -> None:
-        
-        if suppress_printing:
-            sys.stdout = open(os.devnull, 'w')
-            
-        try:
-            self._applyTest(func, test_inputs, true_outputs)
-        except Exception as e:
-            print(e)
-        
-        if suppress_printing:
-            sys.stdout = sys.__stdout__
-    
-    def _applyTest(self, func, test_inputs: list, true_outputs: list):
-        fname = func.__name__
-    
-        for test_input, true_output in zip(test_inputs, true_outputs):
-            
-            try:
+# ---------------------------------------------------------------------------- #
+
+def _arrays_match(test, true, rtol: float, atol: float) -> bool:
+    """Elementwise equality, within tolerances for floats, NaN equal to NaN"""
+
+    test, true = np.asarray(test), np.asarray(true)
+    if test.shape != true.shape:
+        return False
+
+    kinds = (test.dtype.kind, true.dtype.kind)
+    if all(k in 'biu' for k in kinds):
+        return bool(np.array_equal(test, true))
+    if all(k in 'biufc' for k in kinds):
+        return bool(np.isclose(test, true, rtol=rtol, atol=atol, equal_nan=True).all())
+
+    same = np.asarray(test == true)
+    if same.shape != true.shape:
+        return False
+    return bool((same | (pd.isna(test) & pd.isna(true))).all())
+
+def outputs_match(test_output, true_output, rtol: float=1e-7,
+                atol: float=0.) -> bool:
+    """
+    Whether `test_output` equals `true_output`. pandas outputs are
+    aligned on the expected index and columns once, then compared as
+    whole arrays: numeric columns together, the others together.
+    """
+
+    if isinstance(true_output, (pd.Series, pd.DataFrame)):
+        if type(test_output) is not type(true_output):
+            return False
+        if len(test_output) != len(true_output):
+            return False
+
+        if not test_output.index.equals(true_output.index):
+            if not true_output.index.isin(test_output.index).all():
+                return False
+            test_output = test_output.reindex(true_output.index)
+
+        if isinstance(true_output, pd.Series):
+            return _arrays_match(
+                test_output.to_numpy(), true_output.to_numpy(), rtol, atol
+            )
+
+        cols = true_output.columns
+        if set(test_output.columns) != set(cols):
+            return False
+
+        numeric = true_output.select_dtypes('number').columns
+        other = cols.difference(numeric, sort=False)
+        return all(
+            _arrays_match(
+                test_output[c].to_numpy(), true_output[c].to_numpy(), rtol, atol
+            ) for c in (numeric, other) if len(c)
+        )
+
+    if isinstance(true_output, np.ndarray):
+        return _arrays_match(test_output, true_output, rtol, atol)
+
+    if isinstance(true_output, float) and isinstance(test_output, (int, float)):
+        return _arrays_match(test_output, true_output, rtol, atol)
+
+    return bool(test_output == true_output)
+
+# ---------------------------------------------------------------------------- #
+
+class CaseResult:
+    """Outcome, wall time and peak traced memory of one test case"""
+
+    __slots__ = ('case', 'passed', 'seconds', 'peak_bytes', 'error',
+                'output', 'stdout')
+
+    def __init__(self, case: int, passed: bool, seconds: float,
+                peak_bytes: Union[int, None], error: str=None,
+                output: Any=None, stdout: str='') -> None:
+        self.case = case
+        self.passed = passed
+        self.seconds = seconds
+        self.peak_bytes = peak_bytes
+        # traceback of an exception raised by the tested function
+        self.error = error
+        # the output, only kept if it was wrong
+        self.output = output
+        self.stdout = stdout
+
+def _run_case(func: Callable, case: int, test_input, true_output,
+            rtol: float, atol: float, capture: bool,
+            trace_memory: bool) -> CaseResult:
+    """Run and check one case; module level, so worker processes can run it"""
+
+    out = io.StringIO()
+    # a caller that is tracing memory already keeps its own peak
+    trace_memory = trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    error = test_output = None
+    try:
+        if capture:
+            with redirect_stdout(out):
                 test_output = func(test_input)
-            except Exception as e:
-                print(e)
-                TestRuntimeError(fname, test_input)
-            
-            if isinstance(true_output, pd.Series) or isinstance(true_output, pd.DataFrame):
-                test_output = test_output.loc[true_output.index, :]
-                
-            compared = (test_output == true_output)
-            
-            try:
-                if isinstance(true_output, pd.Series):
-                        assert compared.all()
-                elif isinstance(true_output, pd.DataFrame):
-                        assert compared.all().all()
-                elif isinstance(true_output, np.ndarray):
-                    assert np.all(compared)
-                else:
-                    assert compared 
-                    
-            except AssertionError:
-                TestAssertionError(fname, test_input, test_output, true_output)
-                
-        return True 
+        else:
+            test_output = func(test_input)
+    except Exception:
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    passed = (error is None) and outputs_match(test_output, true_output, rtol, atol)
+    return CaseResult(
+        case, passed, seconds, peak, error,
+        None if passed else test_output, out.getvalue()
+    )
+
+class CommonTest:
+    """
+    Run `func` on each of `test_inputs` and compare with `true_outputs`
+
+    Cases run one after another, or in a pool of `workers` processes
+    (`pool='process'`, for picklable functions) or threads. Each case
+    is timed, and its peak memory traced unless it runs in a thread or
+    memory is traced already.
+    `results` has every case and `summary` tabulates them. The first
+    failure is raised after all cases ran, if `raise_errors`.
+    """
+
+    def __init__(self, func, test_inputs: list, true_outputs: list,
+                suppress_printing=True, workers: int=1, pool: str='process',
+                rtol: float=1e-7, atol: float=0., trace_memory: bool=True,
+                raise_errors: bool=True) -> None:
+
+        self.func = func
+        self.fname = getattr(func, '__name__', repr(func))
+        self.test_inputs = list(test_inputs)
+        self.true_outputs = list(true_outputs)
+
+        if len(self.test_inputs) != len(self.true_outputs):
+            raise ValueError(
+                f"{len(self.test_inputs)} inputs for "
+                f"{len(self.true_outputs)} expected outputs"
+            )
+        if pool not in ('process', 'thread'):
+            raise ValueError(f"Unknown pool {pool!r}")
+
+        self.results: List[CaseResult] = self._applyTest(
+            suppress_printing, workers, pool, rtol, atol, trace_memory
+        )
+
+        if raise_errors:
+            self.raise_first_failure()
+
+    def _applyTest(self, capture: bool, workers: int, pool: str, rtol: float,
+                atol: float, trace_memory: bool) -> List[CaseResult]:
+
+        cases = list(zip(
+            range(len(self.test_inputs)), self.test_inputs, self.true_outputs
+        ))
+
+        if (workers <= 1) or (len(cases) <= 1):
+            return [
+                _run_case(self.func, *case, rtol, atol, capture, trace_memory)
+                for case in cases
+            ]
+
+        if pool == 'thread':
+            # sys.stdout and tracemalloc are shared by all threads
+            with redirect_stdout(io.StringIO()) if capture else nullcontext():
+                with ThreadPoolExecutor(workers) as executor:
+                    futures = [
+                        executor.submit(
+                            _run_case, self.func, *case, rtol, atol, False, False
+                        ) for case in cases
+                    ]
+                    return [f.result() for f in futures]
+
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(
+                    _run_case, self.func, *case, rtol, atol, capture, trace_memory
+                ) for case in cases
+            ]
+            return [f.result() for f in futures]
+
+    @property
+    def passed(self) -> bool:
+        return all(r.passed for r in self.results)
+
+    def failures(self) -> List[CaseResult]:
+        return [r for r in self.results if not r.passed]
+
+    def raise_first_failure(self) -> None:
+        for r in self.failures():
+            test_input = self.test_inputs[r.case]
+            if r.error is not None:
+                raise TestRuntimeError(self.fname, test_input, r.error)
+            raise TestAssertionError(
+                self.fname, test_input, r.output, self.true_outputs[r.case]
+            )
+
+    def summary(self, baseline: pd.DataFrame=None) -> pd.DataFrame:
+        """
+        Outcome, seconds and peak MiB of each case, with a `slowdown`
+        relative to the `seconds` of a previous summary, if given
+        """
+
+        df = pd.DataFrame.from_records(
+            [(r.case, r.passed, r.seconds,
+            None if r.peak_bytes is None else r.peak_bytes / 2**20,
+            None if r.error is None else r.error.strip().splitlines()[-1])
+            for r in self.results],
+            columns=['case', 'passed', 'seconds', 'peak_mib', 'error'],
+            index='case'
+        )
+
+        if baseline is not None:
+            df['baseline_seconds'] = baseline['seconds'].reindex(df.index)
+            df['slowdown'] = df['seconds'] / df['baseline_seconds']
+
+        return df
 
+    def __repr__(self) -> str:
+        return f"CommonTest({self.fname})\n{self.summary().to_string()}"
@@ -0,0 +1,437 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Fetch and parse web pages concurrently, for quick pulls outside Scrapy
+
+Pages are fetched with asyncio over HTTP/1.1 keep-alive connections,
+pooled per host, at most `per_host` at a time to one host and `limit`
+overall. gzip and deflate responses are decompressed, and brotli too if
+the `brotli` package is installed. Pages are parsed with lxml, or with
+BeautifulSoup if asked. In a notebook:
+
+    pages = fetch_pages([f"https://ncode.syosetu.com/{n}/" for n in ncodes])
+    titles = [p.tree().findtext('.//title') for p in pages]
+
+or, to handle pages as they arrive:
+
+    async with FetchClient(per_host=8) as client:
+        async for page in client.stream(urls):
+            ...
+"""
+
+import ssl
+import zlib
+import time
+import asyncio
+import threading
+
+from collections import defaultdict, deque
+from urllib.parse import urljoin, urlsplit
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Union
+
+from lxml import html as lxml_html
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ---------------------------------------------------------------------------- #
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/104.0.0.0 Safari/537.36"
+)
+
+ACCEPT_ENCODING = "gzip, deflate" + (", br" if brotli is not None else "")
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+class FetchError(Exception):
+    def __init__(self, url: str, reason: str) -> None:
+        super().__init__(f"Failed to fetch {url}: {reason}")
+
+def decode_body(body: bytes, content_encoding: str) -> bytes:
+    """Undo the `Content-Encoding` of a response body"""
+
+    codings = [c.strip().lower() for c in content_encoding.split(',')]
+    for coding in reversed(codings):
+        if coding in ('', 'identity'):
+            continue
+        elif coding in ('gzip', 'x-gzip'):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif coding == 'deflate':
+            # zlib wrapped, or raw deflate from some servers
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        elif coding == 'br' and brotli is not None:
+            body = brotli.decompress(body)
+        else:
+            raise ValueError(f"Unsupported content encoding {coding!r}")
+    return body
+
+# ---------------------------------------------------------------------------- #
+
+class Page:
+    """A fetched page, or the error that stopped it"""
+
+    __slots__ = ('url', 'status', 'headers', 'body', 'seconds', 'error',
+                'data', '_tree')
+
+    def __init__(self, url: str, status: int=None, headers: Dict[str, str]=None,
+                body: bytes=b'', seconds: float=0., error: str=None) -> None:
+        # the final url, after redirects
+        self.url = url
+        self.status = status
+        # lower-case names
+        self.headers = headers or dict()
+        self.body = body
+        self.seconds = seconds
+        self.error = error
+        # result of the `parse` function, if one was given
+        self.data = None
+        self._tree = None
+
+    @property
+    def ok(self) -> bool:
+        return (self.error is None) and (200 <= self.status < 300)
+
+    @property
+    def encoding(self) -> Union[str, None]:
+        """Charset of the `Content-Type` header, if any"""
+        for param in self.headers.get('content-type', '').split(';')[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'charset':
+                return value.strip().strip('"\'') or None
+        return None
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf8', errors='replace')
+
+    def tree(self, soup: bool=False):
+        """
+        The page parsed by lxml, or by BeautifulSoup (with lxml) if
+        `soup`. The lxml tree is parsed once and kept.
+        """
+        if soup:
+            from bs4 import BeautifulSoup
+            return BeautifulSoup(self.body, 'lxml', from_encoding=self.encoding)
+
+        if self._tree is None:
+            parser = lxml_html.HTMLParser(encoding=self.encoding)
+            self._tree = lxml_html.document_fromstring(
+                self.body, parser=parser, base_url=self.url
+            )
+        return self._tree
+
+    def __repr__(self) -> str:
+        state = self.status if self.error is None else self.error
+        return f"Page({self.url}, {state})"
+
+# ---------------------------------------------------------------------------- #
+
+class _Connection:
+    __slots__ = ('reader', 'writer')
+
+    def __init__(self, reader: asyncio.StreamReader,
+                writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def closed(self) -> bool:
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+class _HostPool:
+    """Idle keep-alive connections to one host, and a cap on busy ones"""
+
+    __slots__ = ('busy', 'idle')
+
+    def __init__(self, size: int) -> None:
+        self.busy = asyncio.Semaphore(size)
+        self.idle = deque()
+
+class FetchClient:
+    """
+    Concurrent GET requests over keep-alive connections pooled per host
+
+    At most `per_host` requests to one host and `limit` in total are in
+    flight. Each request, connection included, times out after
+    `timeout` seconds, not counting the wait for a free slot on its
+    host, and is retried `retries` times. `headers` are
+    added to every request. Use it as an async context manager, so the
+    pooled connections are closed.
+    """
+
+    def __init__(self, per_host: int=6, limit: int=64, timeout: float=30.,
+                retries: int=2, max_redirects: int=5,
+                headers: Dict[str, str]=None) -> None:
+
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.max_redirects = max_redirects
+
+        self.headers = {
+            "User-Agent" : USER_AGENT,
+            "Accept" : "text/html,application/xhtml+xml,*/*;q=0.8",
+            "Accept-Encoding" : ACCEPT_ENCODING,
+        }
+        self.headers.update(headers or dict())
+
+        self._limit = asyncio.Semaphore(limit)
+        self._pools: Dict[tuple, _HostPool] = defaultdict(
+            lambda: _HostPool(self.per_host)
+        )
+        self._ssl = None
+
+        # connections opened, for checking the pooling
+        self.connections = 0
+
+    async def __aenter__(self) -> 'FetchClient':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        for pool in self._pools.values():
+            while pool.idle:
+                await pool.idle.pop().close()
+
+    # ------------------------------------------------------------------------ #
+
+    async def _connect(self, scheme: str, host: str, port: int) -> _Connection:
+        context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        self.connections += 1
+        return _Connection(reader, writer)
+
+    async def _exchange(self, conn: _Connection, netloc: str, target: str):
+        """Send one GET on `conn`; returns the status, headers, body and keep-alive"""
+
+        lines = [f"GET {target} HTTP/1.1", f"Host: {netloc}"]
+        lines.extend(f"{k}: {v}" for k, v in self.headers.items())
+        conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await conn.writer.drain()
+
+        reader = conn.reader
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionResetError("connection closed by the server")
+            version, status = line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name, value = name.strip().lower(), value.strip()
+                headers[name] = f"{headers[name]}, {value}" if name in headers else value
+
+            # skip interim responses, like 100 Continue
+            if status >= 200:
+                break
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep = connection != 'close'
+        else:
+            keep = connection == 'keep-alive'
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # trailers, up to the blank line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif status in (204, 304):
+            body = b''
+        else:
+            body = await reader.read()
+            keep = False
+
+        return status, headers, body, keep
+
+    async def _get(self, url: str):
+        """One request, on a pooled connection to the host if there is one"""
+
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Not an http(s) url: {url}")
+
+        port = parts.port or (443 if scheme == 'https' else 80)
+        target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        pool = self._pools[(scheme, parts.hostname, port)]
+
+        # the wait for a free slot on the host is not timed
+        async with pool.busy:
+            return await asyncio.wait_for(
+                self._send(pool, scheme, parts.hostname, port, parts.netloc, target),
+                self.timeout
+            )
+
+    async def _send(self, pool: _HostPool, scheme: str, host: str, port: int,
+                    netloc: str, target: str):
+        while True:
+            conn = None
+            while pool.idle and conn is None:
+                conn = pool.idle.pop()
+                if conn.closed:
+                    await conn.close()
+                    conn = None
+
+            reused = conn is not None
+            if conn is None:
+                conn = await self._connect(scheme, host, port)
+
+            try:
+                status, headers, body, keep = await self._exchange(
+                    conn, netloc, target
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await conn.close()
+                # the server may have dropped an idle connection
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                await conn.close()
+                raise
+
+            if keep:
+                pool.idle.append(conn)
+            else:
+                await conn.close()
+            return status, headers, body
+
+    async def fetch(self, url: str) -> Page:
+        """GET `url`, following redirects; errors are kept in `Page.error`"""
+
+        start = time.perf_counter()
+        async with self._limit:
+            for attempt in range(self.retries + 1):
+                current = url
+                try:
+                    for _ in range(self.max_redirects + 1):
+                        status, headers, body = await self._get(current)
+                        if (status not in REDIRECTS) or ('location' not in headers):
+                            break
+                        current = urljoin(current, headers['location'])
+                    else:
+                        raise FetchError(url, "too many redirects")
+
+                    body = decode_body(body, headers.get('content-encoding', ''))
+                    return Page(
+                        current, status, headers, body,
+                        time.perf_counter() - start
+                    )
+
+                except (OSError, EOFError, asyncio.TimeoutError) as e:
+                    error = f"{type(e).__name__}: {e}"
+                except (FetchError, ValueError, zlib.error) as e:
+                    error = f"{type(e).__name__}: {e}"
+                    break
+
+        return Page(current, seconds=time.perf_counter() - start, error=error)
+
+    async def stream(self, urls: Iterable[str],
+                    parse: Callable[[Page], Any]=None) -> AsyncIterator[Page]:
+        """
+        Fetch `urls` concurrently and yield the pages as they complete.
+        `parse` is applied to each successful page and kept in
+        `Page.data`; its errors are kept in `Page.error`.
+        """
+        tasks = [asyncio.ensure_future(self.fetch(url)) for url in urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                page = await task
+                if (parse is not None) and page.ok:
+                    try:
+                        page.data = parse(page)
+                    except Exception as e:
+                        page.error = f"{type(e).__name__}: {e}"
+                yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+# ---------------------------------------------------------------------------- #
+
+async def _fetch_pages(urls: List[str], parse: Callable[[Page], Any],
+                    kwargs: dict) -> List[Page]:
+    # repeated urls are fetched once
+    unique = list(dict.fromkeys(urls))
+
+    async with FetchClient(**kwargs) as client:
+        pages = await asyncio.gather(*(client.fetch(url) for url in unique))
+
+    for page in pages:
+        if (parse is not None) and page.ok:
+            try:
+                page.data = parse(page)
+            except Exception as e:
+                page.error = f"{type(e).__name__}: {e}"
+
+    fetched = dict(zip(unique, pages))
+    return [fetched[url] for url in urls]
+
+def fetch_pages(urls: Iterable[str], parse: Callable[[Page], Any]=None,
+                **kwargs) -> List[Page]:
+    """
+    Fetch `urls` with a `FetchClient(**kwargs)` and return the pages in
+    the same order. Blocks until all are done, also when called from a
+    running event loop, like a notebook's, by running in a thread.
+    """
+    urls = list(urls)
+    coro = _fetch_pages(urls, parse, kwargs)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = dict()
+    def run():
+        try:
+            result['pages'] = asyncio.run(coro)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    if 'error' in result:
+        raise result['error']
+    return result['pages']
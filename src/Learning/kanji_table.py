@@ -0,0 +1,133 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Kanji grades as a table indexed by codepoint
+
+`data/kanji.json` is packed into a `uint8` array with one row per
+codepoint from `BASE` and one column per grading system (`SYSTEMS`).
+Level 0 means the kanji is not graded in that system. The table is
+saved as `.npy`, so it loads memory-mapped without parsing, and text is
+graded with array operations rather than one dict lookup per character.
+
+Rebuild the table with
+
+    python ./src/Learning/kanji_table.py [json_path] [npy_path]
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+from functools import lru_cache
+from typing import Dict, Union
+
+# ---------------------------------------------------------------------------- #
+
+DATA_PATH = os.path.normpath(
+    os.path.join(os.path.dirname(__file__), "../../data")
+) + os.sep
+
+JSON_PATH = DATA_PATH + "kanji.json"
+TABLE_PATH = DATA_PATH + "kanji_table.npy"
+
+# first codepoint of the CJK Unified Ideographs block
+BASE = 0x4E00
+
+SYSTEMS = ('wk', 'joyo', 'jlpt', 'category')
+
+# highest level of each system
+LEVELS = {'wk' : 60, 'joyo' : 9, 'jlpt' : 5, 'category' : 2}
+
+# levels of the non-numeric grades, as in `kanji_grades.parquet`
+JLPT_LEVELS = {'N1' : 1, 'N2' : 2, 'N3' : 3, 'N4' : 4, 'N5' : 5}
+CATEGORIES = {'jōyō' : 1, 'jinmeiyō' : 2}
+
+# ---------------------------------------------------------------------------- #
+
+def _level(system: str, grade: Union[int, str, None]) -> int:
+    if grade is None:
+        return 0
+    if system == 'jlpt':
+        return JLPT_LEVELS[grade]
+    if system == 'category':
+        return CATEGORIES[grade]
+    return int(grade)
+
+def build_table(json_path: str=JSON_PATH) -> np.ndarray:
+    """Table of levels, shape (codepoints, systems), from `kanji.json`"""
+
+    with open(json_path, mode='r', encoding='utf8') as file:
+        data = json.load(file)
+
+    size = max(ord(c) for c in data) - BASE + 1
+    table = np.zeros((size, len(SYSTEMS)), dtype=np.uint8)
+
+    for char, grades in data.items():
+        table[ord(char) - BASE] = [
+            _level(s, grades.get(s)) for s in SYSTEMS
+        ]
+
+    return table
+
+def save_table(table: np.ndarray, path: str=TABLE_PATH) -> None:
+    np.save(path, table, allow_pickle=False)
+
+@lru_cache(maxsize=None)
+def load_table(path: str=TABLE_PATH, mmap: bool=True) -> np.ndarray:
+    """Saved table, memory-mapped read-only unless `mmap` is False"""
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+# ---------------------------------------------------------------------------- #
+
+def to_codepoints(text: str) -> np.ndarray:
+    """Codepoints of `text` as `uint32`, without a Python loop"""
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+def lookup(text: str, table: np.ndarray=None) -> np.ndarray:
+    """Rows of `table` for every kanji of `text` that is in `kanji.json`"""
+
+    table = load_table() if table is None else table
+
+    offsets = to_codepoints(text).astype(np.int64) - BASE
+    offsets = offsets[(offsets >= 0) & (offsets < table.shape[0])]
+
+    # every listed kanji has a category
+    rows = table[offsets]
+    return rows[rows[:, SYSTEMS.index('category')] > 0]
+
+def count_levels(text: str, system: str='jlpt',
+                table: np.ndarray=None) -> np.ndarray:
+    """
+    Number of kanji in `text` at each level of `system`. Index 0 counts
+    kanji that `system` does not grade.
+    """
+    rows = lookup(text, table)
+    col = SYSTEMS.index(system)
+
+    return np.bincount(rows[:, col], minlength=LEVELS[system] + 1)
+
+def level_profile(text: str, table: np.ndarray=None) -> Dict[str, pd.Series]:
+    """Per-level kanji counts of `text` in every system, in one pass"""
+
+    rows = lookup(text, table)
+
+    profile = dict()
+    for col, system in enumerate(SYSTEMS):
+        counts = np.bincount(rows[:, col], minlength=LEVELS[system] + 1)
+        profile[system] = pd.Series(counts, name=system)
+
+    return profile
+
+
+if __name__ == '__main__':
+    json_path = sys.argv[1] if len(sys.argv) > 1 else JSON_PATH
+    npy_path = sys.argv[2] if len(sys.argv) > 2 else TABLE_PATH
+
+    table = build_table(json_path)
+    save_table(table, npy_path)
+    print(f"Saved {table.shape} table ({table.nbytes} bytes) to {npy_path}")
@@ -0,0 +1,181 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Lemma frequencies of Japanese text
+
+Same counting rules as `jp_text_tagger` in `segment.ipynb`: text is
+tagged with fugashi (UniDic), particles and auxiliary verbs (parts of
+speech containing '助') are dropped, and the remaining words are counted
+by lemma. Text is tagged in chunks that end at sentence boundaries, and
+files can be counted in parallel, with one cached tagger per process.
+"""
+
+import os
+import logging
+import regex as re
+import pandas as pd
+
+from time import perf_counter
+from functools import lru_cache
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Union
+
+try:
+    from fugashi import Tagger
+except ImportError:
+    Tagger = None
+
+# ---------------------------------------------------------------------------- #
+
+# chunks are cut after one of these, so no word is split between chunks
+SENTENCE_END_REGEX = re.compile(r"[。！？!?\n]")
+
+CHUNK_CHARS = 2**16
+
+FILE_OPTS = dict(mode='r', encoding='utf8')
+
+# ---------------------------------------------------------------------------- #
+
+@lru_cache(maxsize=None)
+def get_tagger(args: str='') -> 'Tagger':
+    """One `fugashi.Tagger` per process and argument string"""
+
+    if Tagger is None:
+        raise ImportError(
+            "Counting words requires fugashi and a UniDic dictionary, "
+            "e.g. `pip install fugashi unidic-lite`."
+        )
+
+    return Tagger(args)
+
+def iter_chunks(text: Union[str, Iterable[str]],
+                size: int=CHUNK_CHARS) -> Iterator[str]:
+    """
+    Split `text`, a string or an iterable of strings such as an open
+    file, into chunks of about `size` characters that end at a sentence
+    boundary where there is one.
+    """
+    if isinstance(text, str):
+        text = (text,)
+
+    buf = ''
+    for part in text:
+        buf += part
+
+        while len(buf) >= size:
+            cut = None
+            for m in SENTENCE_END_REGEX.finditer(buf, 0, size):
+                cut = m.end()
+
+            # no boundary: cut anyway, rather than buffer without limit
+            cut = size if cut is None else cut
+
+            yield buf[:cut]
+            buf = buf[cut:]
+
+    if buf:
+        yield buf
+
+_SKIP = 0
+_UNKNOWN = 1
+
+# lemma by raw feature string, since building `word.feature` and
+# `word.pos` costs more than tagging itself
+_LEMMAS = dict()
+
+def _lemma(word) -> Union[str, int]:
+    feat = word.feature
+    if any('助' in p for p in feat[:4]):
+        return _SKIP
+
+    # UniDic has no lemma for unknown words
+    return _UNKNOWN if feat.lemma is None else feat.lemma
+
+def tag_lemmas(text: str, tagger: 'Tagger'=None) -> List[str]:
+    """Lemmas of the words in `text`, without particles or auxiliaries"""
+
+    tagger = get_tagger() if tagger is None else tagger
+
+    words = []
+    for word in tagger(text):
+        raw = word.feature_raw
+
+        lemma = _LEMMAS.get(raw)
+        if lemma is None:
+            lemma = _LEMMAS[raw] = _lemma(word)
+
+        if lemma == _SKIP:
+            continue
+        words.append(word.surface if lemma == _UNKNOWN else lemma)
+
+    return words
+
+def count_lemmas(text: Union[str, Iterable[str]], tagger: 'Tagger'=None,
+                chunk_chars: int=CHUNK_CHARS) -> Counter:
+    """Lemma counts of `text`, tagged in chunks of `chunk_chars`"""
+
+    tagger = get_tagger() if tagger is None else tagger
+
+    counts = Counter()
+    for chunk in iter_chunks(text, chunk_chars):
+        counts.update(tag_lemmas(chunk, tagger))
+
+    return counts
+
+def _count_file(path: str, chunk_chars: int=CHUNK_CHARS) -> Counter:
+    with open(path, **FILE_OPTS) as file:
+        return count_lemmas(file, chunk_chars=chunk_chars)
+
+def count_files(paths: Iterable[str], workers: int=None,
+                chunk_chars: int=CHUNK_CHARS) -> Counter:
+    """
+    Lemma counts of the text files in `paths`, merged over `workers`
+    processes. Files are streamed, so they need not fit in memory.
+    """
+    paths = list(paths)
+    workers = os.cpu_count() if workers is None else workers
+
+    counts = Counter()
+    start = perf_counter()
+
+    if workers < 2 or len(paths) < 2:
+        for path in paths:
+            counts.update(_count_file(path, chunk_chars))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for res in pool.map(
+                _count_file, paths, [chunk_chars] * len(paths)
+            ):
+                counts.update(res)
+
+    logging.info(
+        f"Counted {sum(counts.values())} words in {len(paths)} files "
+        f"in {perf_counter() - start:.1f} s"
+    )
+
+    return counts
+
+# ---------------------------------------------------------------------------- #
+
+def to_frame(counts: Counter) -> pd.DataFrame:
+    """`Count` and `PercentFrequency` of each lemma, most common first"""
+
+    df = pd.DataFrame.from_records(
+        counts.most_common(), columns=['lemma', 'Count'], index='lemma'
+    )
+    df.index.name = None
+    df['PercentFrequency'] = 100 * df['Count'] / df['Count'].sum()
+
+    return df
+
+def count_words(data: List[str]) -> pd.DataFrame:
+    """Frequency table of a list of lemmas"""
+    return to_frame(Counter(data))
+
+def word_frequencies(text: Union[str, Iterable[str]]) -> pd.DataFrame:
+    """Frequency table of the lemmas in `text`"""
+    return to_frame(count_lemmas(text))
@@ -0,0 +1,341 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Record a crawl into a WARC archive and replay it offline
+
+`ArchiveRecorderMiddleware` (in `middlewares.py`) writes every response,
+as received from the network, to `ARCHIVE_RECORD_PATH`:
+
+    scrapy crawl novels -s ARCHIVE_RECORD_PATH=novels.warc.gz
+
+`ReplayDownloadHandler` answers requests from such an archive instead of
+the network, so the rest of the middlewares, the spider and the
+pipelines run on the recorded pages at full speed. URLs missing from
+the archive get a 404. `replay_settings` gives the settings for a
+replay, and this module runs one and reports its throughput:
+
+    python -m syosetu.archive novels.warc.gz novels -a max_novel_cnt=100
+
+Archives are gzipped WARC/1.0 with one member per record, as written by
+common web archiving tools, and only `response` records are replayed.
+"""
+
+import sys
+import zlib
+import gzip
+import uuid
+import logging
+import argparse
+import tempfile
+
+from time import perf_counter
+from http import HTTPStatus
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Tuple, Union
+
+from w3lib.url import canonicalize_url
+
+from scrapy.core.downloader.handlers.base import BaseDownloadHandler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+# ---------------------------------------------------------------------------- #
+
+# status, headers as (name, value) pairs, body
+Record = Tuple[int, List[Tuple[str, str]], bytes]
+
+CHUNK_SIZE = 2**20
+
+def _key(url: str) -> str:
+    return canonicalize_url(url)
+
+def _parse_fields(block: bytes) -> List[Tuple[str, str]]:
+    fields = []
+    for line in block.split(b"\r\n"):
+        if not line:
+            continue
+        name, _, value = line.partition(b":")
+        fields.append((name.decode('latin1'), value.strip().decode('latin1')))
+    return fields
+
+def _iter_members(file) -> Iterator[Tuple[int, int, bytes]]:
+    """Offset, compressed length and content of every gzip member"""
+
+    start = pos = 0
+    decomp = zlib.decompressobj(wbits=31)
+    parts = []
+
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        while chunk:
+            parts.append(decomp.decompress(chunk))
+            if not decomp.eof:
+                pos += len(chunk)
+                break
+
+            # the rest of the chunk belongs to the next member
+            used = len(chunk) - len(decomp.unused_data)
+            pos += used
+            yield start, pos - start, b"".join(parts)
+
+            chunk = decomp.unused_data
+            decomp = zlib.decompressobj(wbits=31)
+            parts = []
+            start = pos
+
+    if start < pos:
+        logging.warning(f"Ignoring a truncated record at byte {start}")
+
+def parse_record(data: bytes) -> Tuple[Dict[str, str], bytes]:
+    """WARC headers and content block of one record"""
+
+    head, _, rest = data.partition(b"\r\n\r\n")
+    if not head.startswith(b"WARC/"):
+        raise ValueError("Not a WARC record.")
+
+    headers = dict(_parse_fields(head.split(b"\r\n", 1)[1]))
+    length = int(headers['Content-Length'])
+    return headers, rest[:length]
+
+def parse_http_response(block: bytes) -> Record:
+    head, _, body = block.partition(b"\r\n\r\n")
+    status_line, _, fields = head.partition(b"\r\n")
+    status = int(status_line.split(b" ")[1])
+    return status, _parse_fields(fields), body
+
+# ---------------------------------------------------------------------------- #
+
+class ArchiveWriter:
+    """Appends `response` records to a gzipped WARC file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, mode='ab')
+        self.count = 0
+
+    @staticmethod
+    def http_block(status: int, headers: List[Tuple[str, str]],
+                body: bytes) -> bytes:
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+
+        lines = [f"HTTP/1.1 {status} {reason}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        head = "\r\n".join(lines).encode('latin1')
+        return head + b"\r\n\r\n" + body
+
+    def write(self, url: str, status: int, headers: List[Tuple[str, str]],
+            body: bytes) -> None:
+
+        block = self.http_block(status, headers, body)
+        date = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        warc_head = "\r\n".join([
+            "WARC/1.0",
+            "WARC-Type: response",
+            f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>",
+            f"WARC-Date: {date}",
+            f"WARC-Target-URI: {url}",
+            "Content-Type: application/http; msgtype=response",
+            f"Content-Length: {len(block)}",
+        ]).encode('utf8')
+
+        # one gzip member per record, so records can be read on their own
+        self.file.write(gzip.compress(
+            warc_head + b"\r\n\r\n" + block + b"\r\n\r\n", mtime=0
+        ))
+        self.count += 1
+
+    def write_response(self, response) -> None:
+        headers = [
+            (name.decode('latin1'), value.decode('latin1'))
+            for name, values in response.headers.items() for value in values
+        ]
+        self.write(response.url, response.status, headers, response.body)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ArchiveReader:
+    """
+    Responses of a WARC archive by URL
+
+    The archive is scanned once for the offsets of its response records.
+    Records are decompressed when they are read, so only the index is
+    held in memory. A URL recorded twice maps to its last response.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index: Dict[str, Tuple[int, int]] = dict()
+
+        with open(path, mode='rb') as file:
+            for offset, length, data in _iter_members(file):
+                try:
+                    headers, _ = parse_record(data)
+                except (ValueError, KeyError, IndexError):
+                    logging.warning(f"Skipping a bad record at byte {offset}")
+                    continue
+
+                if headers.get('WARC-Type') == 'response':
+                    url = headers['WARC-Target-URI']
+                    self.index[_key(url)] = (offset, length)
+
+        self.file = open(path, mode='rb')
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, url: str) -> bool:
+        return _key(url) in self.index
+
+    def urls(self) -> List[str]:
+        return list(self.index)
+
+    def get(self, url: str) -> Union[Record, None]:
+        entry = self.index.get(_key(url))
+        if entry is None:
+            return None
+
+        offset, length = entry
+        self.file.seek(offset)
+        _, block = parse_record(gzip.decompress(self.file.read(length)))
+        return parse_http_response(block)
+
+    def close(self) -> None:
+        self.file.close()
+
+# ---------------------------------------------------------------------------- #
+
+class ReplayDownloadHandler(BaseDownloadHandler):
+    """
+    Download handler serving responses from `ARCHIVE_REPLAY_PATH`,
+    without network access
+    """
+
+    def __init__(self, crawler) -> None:
+        super().__init__(crawler)
+
+        path = crawler.settings.get('ARCHIVE_REPLAY_PATH')
+        if not path:
+            raise NotConfigured("ARCHIVE_REPLAY_PATH is not set")
+
+        self.archive = ArchiveReader(path)
+        self.stats = crawler.stats
+        logging.info(f"Replaying {len(self.archive)} responses from {path}")
+
+    async def download_request(self, request):
+        record = self.archive.get(request.url)
+
+        if record is None:
+            self.stats.inc_value('replay/missing')
+            return responsetypes.from_args(url=request.url)(
+                url=request.url, status=404, request=request,
+                flags=['replayed']
+            )
+
+        status, fields, body = record
+        headers = Headers()
+        for name, value in fields:
+            headers.appendlist(name, value)
+
+        self.stats.inc_value('replay/hit')
+        respcls = responsetypes.from_args(
+            headers=headers, url=request.url, body=body
+        )
+        return respcls(
+            url=request.url, status=status, headers=headers, body=body,
+            request=request, flags=['replayed']
+        )
+
+    async def close(self) -> None:
+        self.archive.close()
+
+
+def replay_settings(path: str) -> dict:
+    """
+    Settings that replay the archive at `path` as fast as possible: no
+    delays, caches, seen-set or recording. Replays are repeatable and
+    leave the stores of live crawls alone: unchanged novels are not
+    skipped, nothing is written to SQLite or the time series, and
+    Parquet files go to a new temporary directory.
+    """
+    handler = 'syosetu.archive.ReplayDownloadHandler'
+    return {
+        'ARCHIVE_REPLAY_PATH' : path,
+        'ARCHIVE_RECORD_PATH' : None,
+        'DOWNLOAD_HANDLERS' : {'http' : handler, 'https' : handler},
+        'ROBOTSTXT_OBEY' : False,
+        'DOWNLOAD_DELAY' : 0,
+        'AUTOTHROTTLE_ENABLED' : False,
+        'ADAPTIVE_CONCURRENCY_ENABLED' : False,
+        'SYOSETU_CACHE_ENABLED' : False,
+        'DUPEFILTER_CLASS' : 'scrapy.dupefilters.RFPDupeFilter',
+        'CONCURRENT_REQUESTS' : 64,
+        'CONCURRENT_REQUESTS_PER_DOMAIN' : 64,
+        'SYOSETU_SKIP_UNCHANGED' : False,
+        'SQLITE_PATH' : None,
+        'TIMESERIES_PATH' : None,
+        'PARQUET_DIR' : tempfile.mkdtemp(prefix='syosetu-replay-'),
+    }
+
+# ---------------------------------------------------------------------------- #
+
+def main(argv: List[str]=None) -> None:
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    parser = argparse.ArgumentParser(description="Replay a recorded crawl")
+    parser.add_argument('archive')
+    parser.add_argument('spider')
+    parser.add_argument(
+        '-a', dest='spargs', action='append', default=[],
+        metavar='NAME=VALUE', help="spider argument"
+    )
+    parser.add_argument(
+        '-s', dest='settings', action='append', default=[],
+        metavar='NAME=VALUE', help="setting"
+    )
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    settings.setdict(replay_settings(args.archive), priority='cmdline')
+    for opt in args.settings:
+        name, _, value = opt.partition('=')
+        settings.set(name, value, priority='cmdline')
+
+    spargs = dict(opt.partition('=')[::2] for opt in args.spargs)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(args.spider)
+
+    start = perf_counter()
+    process.crawl(crawler, **spargs)
+    process.start()
+    elapsed = perf_counter() - start
+
+    stats = crawler.stats.get_stats()
+    pages = stats.get('replay/hit', 0)
+    items = stats.get('item_scraped_count', 0)
+    print(
+        f"Replayed {pages} pages ({stats.get('replay/missing', 0)} missing) "
+        f"and scraped {items} items in {elapsed:.2f} s: "
+        f"{pages / elapsed:.1f} pages/s, {items / elapsed:.1f} items/s"
+    )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,413 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Near-duplicate summaries and chapters, by MinHash and LSH
+
+Two texts are compared by the Jaccard similarity of their sets of
+character shingles, the `shingle_size`-grams of the text normalised by
+`syosetu.text.normalize`. `MinHasher` estimates it with a signature of
+`num_perm` minimum hashes per text, computed for many texts at once.
+Signatures are cut into bands, and texts sharing any band are
+candidates, so texts are never compared all against all. Candidates are
+kept if the share of equal minimum hashes is at least `threshold`.
+
+`near_duplicates` does this for a batch of signatures, by sorting the
+band hashes, and `LSHIndex` one text at a time, for
+`NearDuplicatePipeline`. Both take near-linear time. The batch job
+reads stored novels or chapters and writes the pairs as CSV:
+
+    python -m syosetu.dedup summaries novels.db -o pairs.csv
+    python -m syosetu.dedup chapters chapters --threshold 0.9
+"""
+
+import os
+import sys
+import csv
+import sqlite3
+import argparse
+import numpy as np
+
+from time import perf_counter
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, Iterator, List, Sequence, Tuple, Union
+
+from syosetu.text import normalize
+
+# ---------------------------------------------------------------------------- #
+
+THRESHOLD = 0.8
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+
+# buckets larger than this, e.g. of boilerplate text, are paired with
+# their first text only, so they do not add a quadratic number of pairs
+MAX_BUCKET = 64
+
+# shingles hashed per block of `MinHasher.signatures`
+HASH_BLOCK = 2**15
+
+# ncode or (ncode, chapter), first text, second text, estimated Jaccard
+Pair = Tuple[Hashable, Hashable, float]
+
+_EMPTY = np.iinfo(np.uint32).max
+_PRIME = np.uint64(0x100000001B3)
+
+def shingle_hashes(text: str, k: int=SHINGLE_SIZE) -> np.ndarray:
+    """Distinct 64-bit hashes of the `k`-character shingles of `text`"""
+
+    text = normalize(text)
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+    if not len(codes):
+        return np.zeros(0, dtype=np.uint64)
+    # a short text is one shingle
+    codes = np.pad(codes, (0, max(k - len(codes), 0)))
+
+    n = len(codes) - k + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * _PRIME + codes[j:j + n]
+    return np.unique(hashes)
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Exact Jaccard similarity of two sets of shingle hashes"""
+    union = len(np.union1d(a, b))
+    return len(np.intersect1d(a, b, assume_unique=True)) / union if union else 0.
+
+# ---------------------------------------------------------------------------- #
+
+class MinHasher:
+    """
+    MinHash signatures of `num_perm` 32-bit hashes over `shingle_size`
+    character shingles. Each hash is multiply-shift hashing of the
+    shingle hashes, ((a*x + b) mod 2**64) >> 32, with a fixed `seed`, so
+    signatures of separate runs can be compared.
+    """
+
+    def __init__(self, num_perm: int=NUM_PERM, shingle_size: int=SHINGLE_SIZE,
+                seed: int=1) -> None:
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        info = np.iinfo(np.uint64)
+        self.a = rng.integers(0, info.max, num_perm, dtype=np.uint64, endpoint=True) | np.uint64(1)
+        self.b = rng.integers(0, info.max, num_perm, dtype=np.uint64, endpoint=True)
+
+    def _hash(self, shingles: np.ndarray) -> np.ndarray:
+        # (num_perm, len(shingles)), wrapping around 2**64; the shift is
+        # monotone, so it is left until after the minimum
+        h = np.multiply(self.a[:, None], shingles[None, :])
+        h += self.b[:, None]
+        return h
+
+    @staticmethod
+    def _shift(h: np.ndarray) -> np.ndarray:
+        return (h >> np.uint64(32)).astype(np.uint32)
+
+    def signature(self, text: str) -> np.ndarray:
+        """Signature of one text, all `_EMPTY` if it has no shingles"""
+        shingles = shingle_hashes(text, self.shingle_size)
+        if not len(shingles):
+            return np.full(self.num_perm, _EMPTY, dtype=np.uint32)
+        return self._shift(self._hash(shingles).min(axis=1))
+
+    def _block_signatures(self, block: List[np.ndarray]) -> np.ndarray:
+        """Signatures of the texts of one block, by their shingle hashes"""
+
+        lengths = np.array([len(s) for s in block])
+        sigs = np.full((len(block), self.num_perm), _EMPTY, dtype=np.uint32)
+
+        docs = np.flatnonzero(lengths)
+        if len(docs):
+            hashed = self._hash(np.concatenate(block))
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            sigs[docs] = self._shift(np.minimum.reduceat(
+                hashed, offsets[lengths > 0], axis=1
+            ).T)
+        return sigs
+
+    def _blocks(self, texts: Iterable[str]) -> Iterator[List[np.ndarray]]:
+        """Shingle hashes of consecutive texts, about `HASH_BLOCK` a block"""
+
+        block, size = [], 0
+        for text in texts:
+            shingles = shingle_hashes(text, self.shingle_size)
+            # a long text is a block of its own
+            if block and size + len(shingles) > HASH_BLOCK:
+                yield block
+                block, size = [], 0
+            block.append(shingles)
+            size += len(shingles)
+
+        if block:
+            yield block
+
+    def signatures(self, texts: Iterable[str]) -> np.ndarray:
+        """
+        (number of texts, num_perm) signatures. `texts` are read as
+        needed and hashed block by block, so only the signatures are kept.
+        """
+        sigs = np.empty((1024, self.num_perm), dtype=np.uint32)
+        n = 0
+
+        for block in self._blocks(texts):
+            while n + len(block) > len(sigs):
+                sigs = np.concatenate((sigs, np.empty_like(sigs)))
+            sigs[n:n + len(block)] = self._block_signatures(block)
+            n += len(block)
+
+        return sigs[:n].copy()
+
+# ---------------------------------------------------------------------------- #
+
+@lru_cache(maxsize=None)
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Bands and rows per band with the least area of false positives below
+    `threshold` and false negatives above it, with equal weights
+    """
+    s = np.linspace(0, 1, 201)
+    below, above = s <= threshold, s >= threshold
+
+    best, params = np.inf, (num_perm, 1)
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            p = 1 - (1 - s**rows)**bands
+            error = np.trapezoid(p[below], s[below]) + np.trapezoid(1 - p[above], s[above])
+            if error < best:
+                best, params = error, (bands, rows)
+    return params
+
+@lru_cache(maxsize=None)
+def _band_multipliers(rows: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(1, np.iinfo(np.uint64).max, rows, dtype=np.uint64) | np.uint64(1)
+
+def band_hashes(sigs: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    """(len(sigs), bands) hashes of the rows of each band"""
+    sigs = np.atleast_2d(sigs)[:, :bands * rows].astype(np.uint64)
+    mult = _band_multipliers(rows)
+    return (sigs.reshape(len(sigs), bands, rows) * mult).sum(axis=2, dtype=np.uint64)
+
+def _agreement(sigs: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Share of equal minimum hashes of each pair, the estimated Jaccard"""
+    out = np.empty(len(first))
+    for i in range(0, len(first), 2**16):
+        j = slice(i, i + 2**16)
+        out[j] = (sigs[first[j]] == sigs[second[j]]).mean(axis=1)
+    return out
+
+def candidate_pairs(sigs: np.ndarray, bands: int, rows: int,
+                    max_bucket: int=MAX_BUCKET) -> np.ndarray:
+    """(i, j) rows of `sigs`, i < j, sharing a band"""
+
+    n = len(sigs)
+    keep = np.flatnonzero(sigs[:, 0] != _EMPTY)
+    if len(keep) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    hashes = band_hashes(sigs[keep], bands, rows)
+
+    found = []
+    for band in range(bands):
+        order = np.argsort(hashes[:, band], kind='stable')
+        sorted_hashes = hashes[order, band]
+        docs = keep[order]
+
+        # buckets of equal hashes
+        new = np.concatenate(([True], sorted_hashes[1:] != sorted_hashes[:-1]))
+        bucket = np.cumsum(new) - 1
+        starts = np.flatnonzero(new)
+        sizes = np.diff(np.append(starts, len(docs)))
+        big = sizes[bucket] > max_bucket
+
+        # every pair in small buckets, d apart in the sorted order
+        d = 1
+        while d < min(sizes.max(initial=0), max_bucket):
+            same = (bucket[d:] == bucket[:-d]) & ~big[d:]
+            found.append(np.stack((docs[:-d][same], docs[d:][same]), axis=1))
+            d += 1
+
+        # in big buckets, each text with the first one
+        rest = big & ~new
+        found.append(np.stack((docs[starts[bucket[rest]]], docs[rest]), axis=1))
+
+    pairs = np.concatenate(found).astype(np.int64)
+    pairs.sort(axis=1)
+    # one row per pair, whichever bands it was found in
+    codes = np.unique(pairs[:, 0] * n + pairs[:, 1])
+    return np.stack((codes // n, codes % n), axis=1)
+
+def near_duplicates(sigs: np.ndarray, threshold: float=THRESHOLD,
+                    bands: int=None, rows: int=None,
+                    max_bucket: int=MAX_BUCKET) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs (i, j) of rows of `sigs` with estimated Jaccard of at least
+    `threshold`, and their estimates. Bands and rows default to
+    `lsh_params`.
+    """
+    if bands is None or rows is None:
+        bands, rows = lsh_params(threshold, sigs.shape[1])
+
+    pairs = candidate_pairs(sigs, bands, rows, max_bucket)
+    estimates = _agreement(sigs, pairs[:, 0], pairs[:, 1])
+    similar = estimates >= threshold
+    return pairs[similar], estimates[similar]
+
+def find_near_duplicates(keys: Sequence[Hashable], texts: Iterable[str],
+                        threshold: float=THRESHOLD, num_perm: int=NUM_PERM,
+                        shingle_size: int=SHINGLE_SIZE) -> List[Pair]:
+    """
+    Near-duplicate pairs of `texts`, by their `keys`, most similar first.
+    `texts` may be an iterator, and `keys` filled as it is read.
+    """
+
+    sigs = MinHasher(num_perm, shingle_size).signatures(texts)
+    pairs, estimates = near_duplicates(sigs, threshold)
+    order = np.argsort(-estimates, kind='stable')
+    return [
+        (keys[pairs[i, 0]], keys[pairs[i, 1]], float(estimates[i])) for i in order
+    ]
+
+# ---------------------------------------------------------------------------- #
+
+class LSHIndex:
+    """
+    Signatures added one at a time, each queried against those before it
+
+    Each band maps a band hash to the first text added with it, or to a
+    list of texts once more share it.
+    """
+
+    def __init__(self, threshold: float=THRESHOLD, num_perm: int=NUM_PERM,
+                bands: int=None, rows: int=None) -> None:
+        self.threshold = threshold
+        if bands is None or rows is None:
+            bands, rows = lsh_params(threshold, num_perm)
+        self.bands = bands
+        self.rows = rows
+
+        self.keys: List[Hashable] = []
+        self._sigs = np.empty((1024, num_perm), dtype=np.uint32)
+        self._buckets: List[Dict[int, Union[int, List[int]]]] = [
+            dict() for _ in range(bands)
+        ]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def query(self, sig: np.ndarray) -> List[Tuple[Hashable, float]]:
+        """Texts added with estimated Jaccard of at least `threshold`, most similar first"""
+
+        if sig[0] == _EMPTY:
+            return []
+
+        found = set()
+        for bucket, h in zip(self._buckets, band_hashes(sig, self.bands, self.rows)[0].tolist()):
+            ids = bucket.get(h)
+            if ids is None:
+                continue
+            if isinstance(ids, int):
+                found.add(ids)
+            else:
+                found.update(ids)
+
+        if not found:
+            return []
+        ids = np.fromiter(found, dtype=np.int64, count=len(found))
+        estimates = (self._sigs[ids] == sig).mean(axis=1)
+        order = np.argsort(-estimates, kind='stable')
+        return [
+            (self.keys[ids[i]], float(estimates[i]))
+            for i in order if estimates[i] >= self.threshold
+        ]
+
+    def add(self, key: Hashable, sig: np.ndarray) -> None:
+        if sig[0] == _EMPTY:
+            return
+
+        i = len(self.keys)
+        if i == len(self._sigs):
+            self._sigs = np.concatenate((self._sigs, np.empty_like(self._sigs)))
+        self._sigs[i] = sig
+        self.keys.append(key)
+
+        for bucket, h in zip(self._buckets, band_hashes(sig, self.bands, self.rows)[0].tolist()):
+            ids = bucket.get(h)
+            if ids is None:
+                bucket[h] = i
+            elif isinstance(ids, int):
+                bucket[h] = [ids, i]
+            elif len(ids) < MAX_BUCKET:
+                ids.append(i)
+
+# ---------------------------------------------------------------------------- #
+
+def iter_summaries(store_path: str) -> Iterable[Tuple[str, str]]:
+    """(ncode, summary) of the novels in a `NovelStore`"""
+    conn = sqlite3.connect(f"file:{store_path}?mode=ro", uri=True)
+    try:
+        yield from conn.execute(
+            "SELECT ncode, summary FROM novels WHERE summary IS NOT NULL"
+        )
+    finally:
+        conn.close()
+
+def iter_chapter_texts(out_dir: str) -> Iterable[Tuple[Tuple[str, int], str]]:
+    """((ncode, chapter), text) of the `ChapterSpider` files in `out_dir`"""
+    from syosetu.search import iter_chapters
+
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith(".jsonl.gz"):
+            for ncode, chapter, text in iter_chapters(os.path.join(out_dir, name)):
+                yield (ncode, chapter), text
+
+def main(argv: List[str]=None) -> None:
+    parser = argparse.ArgumentParser(description="Find near-duplicate texts")
+    parser.add_argument('source', choices=['summaries', 'chapters'])
+    parser.add_argument('path', help="NovelStore database or ChapterSpider directory")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--num-perm', type=int, default=NUM_PERM)
+    parser.add_argument('--shingle-size', type=int, default=SHINGLE_SIZE)
+    parser.add_argument('-o', '--output', help="CSV of pairs, default stdout")
+    args = parser.parse_args(argv)
+
+    docs = iter_summaries(args.path) if args.source == 'summaries' \
+        else iter_chapter_texts(args.path)
+
+    # texts are read as they are hashed, and only their keys are kept
+    keys = []
+    def texts():
+        for key, text in docs:
+            keys.append(key)
+            yield text
+
+    start = perf_counter()
+    pairs = find_near_duplicates(
+        keys, texts(), args.threshold, args.num_perm, args.shingle_size
+    )
+    elapsed = perf_counter() - start
+
+    out = sys.stdout if args.output is None else open(args.output, 'w', newline='', encoding='utf8')
+    try:
+        writer = csv.writer(out)
+        if args.source == 'summaries':
+            writer.writerow(['ncode_a', 'ncode_b', 'jaccard'])
+            writer.writerows((a, b, f"{j:.3f}") for a, b, j in pairs)
+        else:
+            writer.writerow(['ncode_a', 'chapter_a', 'ncode_b', 'chapter_b', 'jaccard'])
+            writer.writerows((*a, *b, f"{j:.3f}") for a, b, j in pairs)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(
+        f"{len(pairs)} pairs among {len(keys)} texts in {elapsed:.2f} s",
+        file=sys.stderr
+    )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+from syosetu.seen import SeenSet, chapter_key, page_key, SEEN, SEEN_BEFORE
+from syosetu.spiders.chapters import chapter_written
+
+
+class SeenSetDupeFilter(RFPDupeFilter):
+    """
+    Dupefilter that keeps novel and chapter pages in a `SeenSet` at
+    `SEEN_SET_PATH`, so they are remembered across runs
+
+    Within a run, every page is requested once. Novel pages, which change
+    with every update, are added when requested, and only counted in the
+    `seen_set/seen_before` stat if seen in an earlier run. Chapter pages
+    are only added once `ChapterSpider` has written them, so that a
+    chapter scheduled but lost in an interrupted run is requested again.
+    Written chapters are filtered if `SEEN_SET_SKIP_CHAPTERS` is set.
+    Other requests are filtered by fingerprint, as by Scrapy's default
+    dupefilter.
+    """
+
+    def __init__(self, seen: SeenSet, skip_chapters: bool=True,
+                path: str=None, debug: bool=False, stats=None, **kwargs):
+
+        super().__init__(path, debug, **kwargs)
+        self.seen = seen
+        self.skip_chapters = skip_chapters
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        seen = SeenSet(
+            s.get('SEEN_SET_PATH', 'seen.db'),
+            capacity=s.getint('SEEN_SET_CAPACITY', 1_000_000),
+            error_rate=s.getfloat('SEEN_SET_ERROR_RATE', 1e-3),
+        )
+
+        df = cls(
+            seen, s.getbool('SEEN_SET_SKIP_CHAPTERS', True),
+            job_dir(s), s.getbool('DUPEFILTER_DEBUG'),
+            stats=crawler.stats, fingerprinter=crawler.request_fingerprinter,
+        )
+        crawler.signals.connect(df.chapter_written, signal=chapter_written)
+        return df
+
+    def _inc(self, key: str) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(f"seen_set/{key}")
+
+    def request_seen(self, request) -> bool:
+
+        res = page_key(request.url)
+        if res is None:
+            return super().request_seen(request)
+
+        key, chapter = res
+        if chapter:
+            if key in self.seen:
+                self._inc('seen_before')
+                if self.skip_chapters:
+                    self._inc('skipped_chapters')
+                    return True
+            return super().request_seen(request)
+
+        status = self.seen.visit(key)
+
+        if status == SEEN:
+            return True
+
+        self._inc('seen_before' if status == SEEN_BEFORE else 'new')
+        return False
+
+    def chapter_written(self, ncode: str, chapter: int) -> None:
+        self.seen.visit(chapter_key(ncode, chapter))
+
+    def close(self, reason: str) -> None:
+        self.logger.info(
+            f"{len(self.seen)} pages in {self.seen.path} after this run"
+        )
+        self.seen.close()
+        super().close(reason)
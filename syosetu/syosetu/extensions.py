@@ -0,0 +1,418 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import io
+import json
+import random
+import pstats
+import cProfile
+import logging
+import inspect
+import platform
+import tracemalloc
+
+from time import perf_counter
+from datetime import datetime
+from functools import wraps
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple, Any
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+
+logger = logging.getLogger(__name__)
+
+# Prometheus labels of the reported quantiles
+QUANTILES = {"p50" : "0.5", "p95" : "0.95", "p99" : "0.99"}
+
+# ---------------------------------------------------------------------------- #
+
+class Histogram:
+    """
+    Count, sum and a bounded uniform sample of observed values, from
+    which quantiles are estimated
+    """
+
+    __slots__ = ('count', 'total', 'max', 'sample', 'size', '_rng')
+
+    def __init__(self, size: int=4096, seed: int=0) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sample = []
+        self.size = size
+        self._rng = random.Random(seed)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        # reservoir sampling
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            i = self._rng.randrange(self.count)
+            if i < self.size:
+                self.sample[i] = value
+
+    def quantile(self, q: float) -> float:
+        if not self.sample:
+            return 0.0
+        values = sorted(self.sample)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count" : self.count, "total" : self.total, "max" : self.max,
+            "p50" : self.quantile(0.5), "p95" : self.quantile(0.95),
+            "p99" : self.quantile(0.99),
+        }
+
+# ---------------------------------------------------------------------------- #
+
+class ProfilingExtension:
+    """
+    Time spider callbacks, pipeline stages and chosen functions
+
+    Enabled by `PROFILING_ENABLED`. When the spider opens, the `parse*`
+    methods of its class and its rule callbacks, each pipeline's `process_item` and the
+    functions in `PROFILING_FUNCTIONS` are wrapped with timers. Times
+    are inclusive: a callback that calls another includes its time.
+    Download latency and response sizes are recorded per callback.
+
+    A `PROFILING_SAMPLE_RATE` share of calls also runs under cProfile
+    and, with `PROFILING_TRACEMALLOC`, records its peak allocation.
+
+    On close, count, total and p50/p95/p99 of every timer are added to
+    the stats under `profile/`, and a report is written to
+    `PROFILING_REPORT`, as JSON or, for a `.prom` path, in Prometheus'
+    text format.
+    """
+
+    def __init__(self, crawler, report_path: str=None,
+                functions: List[str]=None, sample_rate: float=0.0,
+                trace_memory: bool=False, top: int=20) -> None:
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.report_path = report_path
+        self.functions = list(functions or [])
+        self.sample_rate = sample_rate
+        self.trace_memory = trace_memory
+        self.top = top
+
+        # (kind, name) -> Histogram of seconds
+        self.timers: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        # (kind, name) -> Histogram of bytes
+        self.sizes: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+
+        self.profiler = cProfile.Profile()
+        self.profiled_calls = 0
+        self._in_sample = False
+        self._rng = random.Random(0)
+
+        # (owner, attribute, original or None) to put back on close
+        self._patched: List[Tuple[Any, str, Any]] = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        if not s.getbool('PROFILING_ENABLED'):
+            raise NotConfigured
+
+        ext = cls(
+            crawler,
+            report_path=s.get('PROFILING_REPORT'),
+            functions=s.getlist('PROFILING_FUNCTIONS'),
+            sample_rate=s.getfloat('PROFILING_SAMPLE_RATE', 0.0),
+            trace_memory=s.getbool('PROFILING_TRACEMALLOC'),
+            top=s.getint('PROFILING_TOP', 20),
+        )
+
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            ext.response_received, signal=signals.response_received
+        )
+        return ext
+
+    # ------------------------------------------------------------------------ #
+
+    def _start_sample(self) -> bool:
+        """Whether this call is profiled, and start profiling if so"""
+
+        if self._in_sample or (self._rng.random() >= self.sample_rate):
+            return False
+
+        self._in_sample = True
+        self.profiled_calls += 1
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.profiler.enable()
+        return True
+
+    def _stop_sample(self, key: Tuple[str, str]) -> None:
+        self.profiler.disable()
+        self._in_sample = False
+        if self.trace_memory:
+            self.sizes[(key[0] + "_alloc_peak", key[1])].add(
+                tracemalloc.get_traced_memory()[1]
+            )
+
+    def timed(self, kind: str, name: str, func: Callable) -> Callable:
+        """`func`, timed into the `kind`/`name` histogram"""
+
+        hist = self.timers[(kind, name)]
+        key = (kind, name)
+
+        if inspect.isgeneratorfunction(func):
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                # only time spent inside the generator counts
+                gen = func(*args, **kwargs)
+                elapsed = 0.0
+                sampled = self._start_sample()
+                try:
+                    while True:
+                        t0 = perf_counter()
+                        try:
+                            value = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += perf_counter() - t0
+
+                        if sampled:
+                            self.profiler.disable()
+                        yield value
+                        if sampled:
+                            self.profiler.enable()
+                finally:
+                    if sampled:
+                        self._stop_sample(key)
+                    hist.add(elapsed)
+
+            return wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sampled = self._start_sample()
+            t0 = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.add(perf_counter() - t0)
+                if sampled:
+                    self._stop_sample(key)
+
+        return wrapper
+
+    def _patch(self, owner: Any, attr: str, kind: str, name: str) -> None:
+        original = inspect.getattr_static(owner, attr)
+
+        if isinstance(original, (classmethod, staticmethod)):
+            wrapped = type(original)(self.timed(kind, name, original.__func__))
+        else:
+            wrapped = self.timed(kind, name, getattr(owner, attr))
+
+        # an attribute that came from the class is deleted again on close
+        own = attr in getattr(owner, '__dict__', {})
+
+        setattr(owner, attr, wrapped)
+        self._patched.append((owner, attr, original if own else None))
+
+    def _patch_spider(self, spider) -> None:
+
+        # wrapped on the class, so that callbacks stay bound methods that
+        # requests can be serialised with, e.g. to JOBDIR or the frontier
+        cls = type(spider)
+        for attr, _ in inspect.getmembers(cls, inspect.isfunction):
+            if attr.startswith('parse'):
+                self._patch(cls, attr, 'callback', attr)
+
+        # CrawlSpider binds rule callbacks when the spider is created
+        for rule in getattr(spider, '_rules', ()):
+            callback = getattr(rule, 'callback', None)
+            if callback is not None:
+                name = getattr(callback, '__name__', repr(callback))
+                self._patch(rule, 'callback', 'callback', name)
+
+    def _patch_pipelines(self) -> None:
+
+        try:
+            engine = self.crawler.engine
+        except (AttributeError, RuntimeError):
+            # not crawling, e.g. in tests
+            engine = None
+        itemproc = getattr(getattr(engine, 'scraper', None), 'itemproc', None)
+        methods = getattr(itemproc, 'methods', {}).get('process_item')
+
+        if methods is None:
+            logger.warning("Item pipelines could not be profiled.")
+            return
+
+        needs_spider = getattr(itemproc, '_mw_methods_requiring_spider', set())
+
+        for i, method in enumerate(methods):
+            name = type(method.__self__).__name__
+            wrapped = self.timed('pipeline', name, method)
+            methods[i] = wrapped
+
+            if method in needs_spider:
+                needs_spider.add(wrapped)
+
+    def _patch_functions(self) -> None:
+        for path in self.functions:
+            owner_path, attr = path.rsplit('.', 1)
+            try:
+                owner = load_object(owner_path)
+            except (ImportError, NameError, ValueError):
+                logger.warning(f"Cannot profile {path}: {owner_path} not found")
+                continue
+            self._patch(owner, attr, 'function', path)
+
+    # ------------------------------------------------------------------------ #
+
+    def spider_opened(self, spider):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self._patch_spider(spider)
+        self._patch_pipelines()
+        self._patch_functions()
+
+    def response_received(self, response, request, spider):
+        callback = request.callback
+        name = getattr(callback, '__name__', 'parse')
+
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.timers[('download', name)].add(latency)
+        self.sizes[('response_bytes', name)].add(len(response.body))
+
+    def spider_closed(self, spider, reason):
+
+        for owner, attr, original in reversed(self._patched):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self._patched.clear()
+
+        report = self.report()
+
+        for kind, timers in report["timers"].items():
+            for name, res in timers.items():
+                prefix = f"profile/{kind}/{name}"
+                self.stats.set_value(f"{prefix}/count", res["count"])
+                self.stats.set_value(f"{prefix}/total_s", round(res["total"], 6))
+                for q in ("p50", "p95", "p99"):
+                    self.stats.set_value(
+                        f"{prefix}/{q}_ms", round(1e3 * res[q], 3)
+                    )
+
+        for kind, sizes in report["bytes"].items():
+            for name, res in sizes.items():
+                prefix = f"profile/{kind}/{name}"
+                self.stats.set_value(f"{prefix}/total", int(res["total"]))
+                self.stats.set_value(f"{prefix}/p50", int(res["p50"]))
+                self.stats.set_value(f"{prefix}/max", int(res["max"]))
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        if self.report_path:
+            self.write_report(report, self.report_path)
+            logger.info(f"Wrote profiling report to {self.report_path}")
+
+    # ------------------------------------------------------------------------ #
+
+    def _profile_rows(self) -> List[Dict[str, Any]]:
+        """Functions with the most own time in the sampled calls"""
+
+        if not self.profiled_calls:
+            return []
+
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        rows = []
+        for (file, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+            rows.append({
+                "function" : f"{file}:{line}({func})", "calls" : nc,
+                "own_s" : tt, "cumulative_s" : ct,
+            })
+
+        rows.sort(key=lambda r: r["own_s"], reverse=True)
+        return rows[:self.top]
+
+    def _memory_rows(self) -> List[Dict[str, Any]]:
+        if not (self.trace_memory and tracemalloc.is_tracing()):
+            return []
+
+        snapshot = tracemalloc.take_snapshot()
+        return [
+            {"line" : str(stat.traceback), "bytes" : stat.size,
+            "count" : stat.count}
+            for stat in snapshot.statistics('lineno')[:self.top]
+        ]
+
+    def report(self) -> Dict[str, Any]:
+        timers, sizes = defaultdict(dict), defaultdict(dict)
+
+        for (kind, name), hist in self.timers.items():
+            if hist.count:
+                timers[kind][name] = hist.summary()
+        for (kind, name), hist in self.sizes.items():
+            if hist.count:
+                sizes[kind][name] = hist.summary()
+
+        return {
+            "meta" : {
+                "spider" : getattr(self.crawler.spider, 'name', None),
+                "timestamp" : datetime.now().isoformat(timespec='seconds'),
+                "python" : platform.python_version(),
+                "sample_rate" : self.sample_rate,
+                "profiled_calls" : self.profiled_calls,
+            },
+            "timers" : dict(timers),
+            "bytes" : dict(sizes),
+            "profile" : self._profile_rows(),
+            "memory" : self._memory_rows(),
+        }
+
+    @staticmethod
+    def to_prometheus(report: Dict[str, Any]) -> str:
+        """Timers and sizes of `report` as Prometheus summaries"""
+
+        lines = []
+
+        for metric, section, unit in (
+            ("syosetu_profile_seconds", "timers", "seconds"),
+            ("syosetu_profile_bytes", "bytes", "bytes"),
+        ):
+            lines.append(f"# HELP {metric} Crawl profile in {unit}")
+            lines.append(f"# TYPE {metric} summary")
+
+            for kind, entries in sorted(report[section].items()):
+                for name, res in sorted(entries.items()):
+                    labels = f'kind="{kind}",name="{name}"'
+                    for q, quantile in QUANTILES.items():
+                        lines.append(
+                            f'{metric}{{{labels},quantile="{quantile}"}} {res[q]:.9g}'
+                        )
+                    lines.append(f"{metric}_sum{{{labels}}} {res['total']:.9g}")
+                    lines.append(f"{metric}_count{{{labels}}} {res['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, report: Dict[str, Any], path: str) -> None:
+        with open(path, mode='w', encoding='utf8') as file:
+            if path.endswith('.prom'):
+                file.write(self.to_prometheus(report))
+            else:
+                json.dump(report, file, indent=2, ensure_ascii=False)
@@ -0,0 +1,488 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Shared request frontier for crawls split over several processes
+
+Workers are ordinary Scrapy processes whose scheduler is
+`FrontierScheduler`. Instead of a local queue, every worker pushes its
+requests into one SQLite database in WAL mode (`FRONTIER_PATH`) and
+leases batches of requests from it. A request is acknowledged by
+`FrontierMiddleware` once its callback output has been handled, and a
+lease that runs out, e.g. because its worker crashed, is queued again,
+up to `FRONTIER_MAX_ATTEMPTS` times. Since the queue is keyed by request
+fingerprint, it also filters duplicates across all workers of a run.
+
+Run N workers and print their merged stats with
+
+    python -m syosetu.frontier crawl novels --workers 4 -a max_page_cnt=50
+
+or start workers by hand with `frontier_settings`, e.g.
+
+    scrapy crawl novels -s SCHEDULER=syosetu.frontier.FrontierScheduler \\
+        -s FRONTIER_PATH=frontier.db -s FRONTIER_WORKER=w1
+
+`crawl` starts a new run: requests done or failed in earlier runs are
+crawled again, while those left queued by an interrupted run are kept,
+unless `--reset` is given. Workers started by hand join the current run.
+
+SQLite in WAL mode needs shared memory, so all workers have to run on
+the host that holds `FRONTIER_PATH`. Each worker applies its spider's
+limits, e.g. `max_novel_cnt`, to the pages it parses itself.
+"""
+
+import os
+import sys
+import time
+import pickle
+import socket
+import sqlite3
+import argparse
+import subprocess
+
+from typing import Any, Dict, List, Tuple
+
+from scrapy import signals
+from scrapy.core.scheduler import BaseScheduler
+from scrapy.utils.request import request_from_dict
+
+# ---------------------------------------------------------------------------- #
+
+QUEUED, LEASED, DONE, FAILED = 0, 1, 2, 3
+
+STATES = {QUEUED : 'queued', LEASED : 'leased', DONE : 'done', FAILED : 'failed'}
+
+class Frontier:
+    """
+    Queue of serialised requests with leases, in an SQLite database
+
+    Requests are keyed by fingerprint and handed out by priority, then
+    first in, first out. Every method is a short transaction, so any
+    number of processes can share the database.
+    """
+
+    def __init__(self, path: str, lease_seconds: float=120.0,
+                max_attempts: int=3, timeout: float=30.0) -> None:
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS frontier (\n"
+                "key TEXT PRIMARY KEY,\nurl TEXT,\npriority INTEGER,\n"
+                "payload BLOB,\nstate INTEGER,\nworker TEXT,\n"
+                "lease_until REAL,\nattempts INTEGER DEFAULT 0\n)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS frontier_queue "
+                "ON frontier (state, priority DESC)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (\n"
+                "worker TEXT,\nname TEXT,\nvalue REAL,\n"
+                "PRIMARY KEY (worker, name)\n)"
+            )
+
+    def push(self, key: str, url: str, payload: bytes, priority: int=0,
+            force: bool=False, worker: str=None) -> bool:
+        """
+        Queue a request unless its key is already in the frontier, and
+        return whether it was queued. With `force`, a known key is
+        queued again, unless another worker holds its lease.
+        """
+        with self.conn:
+            if not force:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO frontier "
+                    "(key, url, priority, payload, state) VALUES (?,?,?,?,?)",
+                    (key, url, priority, payload, QUEUED)
+                )
+                return cur.rowcount > 0
+
+            cur = self.conn.execute(
+                "INSERT INTO frontier (key, url, priority, payload, state) "
+                "VALUES (?,?,?,?,?) ON CONFLICT(key) DO UPDATE SET "
+                "priority=excluded.priority, payload=excluded.payload, "
+                "state=excluded.state, worker=NULL, lease_until=NULL "
+                "WHERE state != ? OR worker = ?",
+                (key, url, priority, payload, QUEUED, LEASED, worker)
+            )
+            return cur.rowcount > 0
+
+    def requeue_expired(self) -> int:
+        """Queue requests whose lease ran out again, or fail them"""
+
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "UPDATE frontier SET state=?, worker=NULL, lease_until=NULL "
+                "WHERE state=? AND lease_until<? AND attempts>=?",
+                (FAILED, LEASED, now, self.max_attempts)
+            )
+            cur = self.conn.execute(
+                "UPDATE frontier SET state=?, worker=NULL, lease_until=NULL "
+                "WHERE state=? AND lease_until<?",
+                (QUEUED, LEASED, now)
+            )
+        return cur.rowcount
+
+    def lease(self, worker: str, count: int=1) -> List[Tuple[str, bytes]]:
+        """Lease up to `count` queued requests as (key, payload)"""
+
+        with self.conn:
+            rows = self.conn.execute(
+                "UPDATE frontier SET state=?, worker=?, lease_until=?, "
+                "attempts=attempts+1 WHERE key IN ("
+                "SELECT key FROM frontier WHERE state=? "
+                "ORDER BY priority DESC, rowid LIMIT ?"
+                ") RETURNING key, payload, priority",
+                (LEASED, worker, time.time() + self.lease_seconds, QUEUED,
+                count)
+            ).fetchall()
+
+        rows.sort(key=lambda r: r[2], reverse=True)
+        return [(key, payload) for key, payload, _ in rows]
+
+    def renew(self, worker: str) -> None:
+        """Extend every lease held by `worker`"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE frontier SET lease_until=? WHERE state=? AND worker=?",
+                (time.time() + self.lease_seconds, LEASED, worker)
+            )
+
+    def _finish(self, key: str, worker: str, state: int,
+                retry: int=None) -> bool:
+        """
+        End a lease held by `worker` in `state`, or in `retry` while the
+        request has had fewer than `max_attempts` leases
+        """
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE frontier SET state=CASE WHEN ? IS NULL OR attempts>=? "
+                "THEN ? ELSE ? END, worker=NULL, lease_until=NULL "
+                "WHERE key=? AND state=? AND worker=?",
+                (retry, self.max_attempts, state, retry, key, LEASED, worker)
+            )
+        return cur.rowcount > 0
+
+    def ack(self, key: str, worker: str) -> bool:
+        """Mark a request leased by `worker` as done"""
+        return self._finish(key, worker, DONE)
+
+    def nack(self, key: str, worker: str) -> bool:
+        """Give a request back, or fail it after `max_attempts`"""
+        return self._finish(key, worker, FAILED, retry=QUEUED)
+
+    def has_pending(self) -> bool:
+        """Whether any request is queued or leased, by any worker"""
+        row = self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM frontier WHERE state IN (?, ?))",
+            (QUEUED, LEASED)
+        ).fetchone()
+        return bool(row[0])
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES.values(), 0)
+        for state, num in self.conn.execute(
+            "SELECT state, COUNT(*) FROM frontier GROUP BY state"
+        ):
+            counts[STATES[state]] = num
+        return counts
+
+    # ------------------------------------------------------------------------ #
+
+    def save_stats(self, worker: str, stats: Dict[str, Any]) -> None:
+        """Save the numeric stats of `worker`"""
+
+        rows = [
+            (worker, name, value) for name, value in stats.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+        with self.conn:
+            self.conn.execute("DELETE FROM stats WHERE worker=?", (worker,))
+            self.conn.executemany("INSERT INTO stats VALUES (?,?,?)", rows)
+
+    def merged_stats(self) -> Dict[str, float]:
+        """Stats of all workers, summed, or the largest for `*/max` stats"""
+
+        merged = dict()
+        for name, total, largest in self.conn.execute(
+            "SELECT name, SUM(value), MAX(value) FROM stats GROUP BY name"
+        ):
+            value = largest if name.endswith('max') else total
+            merged[name] = int(value) if float(value).is_integer() else value
+
+        return merged
+
+    def workers(self) -> List[str]:
+        return [r[0] for r in self.conn.execute(
+            "SELECT DISTINCT worker FROM stats ORDER BY worker"
+        )]
+
+    def new_run(self) -> int:
+        """
+        Forget the requests done or failed in earlier runs, so they are
+        queued again when pushed, and the stats of their workers. Requests
+        still queued or leased, e.g. by an interrupted run, are kept.
+        Returns the number of requests forgotten.
+        """
+        with self.conn:
+            cur = self.conn.execute(
+                "DELETE FROM frontier WHERE state IN (?, ?)", (DONE, FAILED)
+            )
+            self.conn.execute("DELETE FROM stats")
+        return cur.rowcount
+
+    def clear(self) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM frontier")
+            self.conn.execute("DELETE FROM stats")
+
+    def close(self) -> None:
+        self.conn.close()
+
+# ---------------------------------------------------------------------------- #
+
+def default_worker() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def open_frontier(settings) -> Frontier:
+    return Frontier(
+        settings.get('FRONTIER_PATH', 'frontier.db'),
+        lease_seconds=settings.getfloat('FRONTIER_LEASE_SECONDS', 120.0),
+        max_attempts=settings.getint('FRONTIER_MAX_ATTEMPTS', 3),
+    )
+
+
+class FrontierScheduler(BaseScheduler):
+    """
+    Scheduler that shares its queue with other workers through a
+    `Frontier`
+
+    Requests are pushed to the frontier, which drops those already
+    known to any worker, and leased from it `FRONTIER_BATCH_SIZE` at a
+    time. A leased request carries its key in `meta['frontier_key']`.
+    Requests derived from a leased one, e.g. retries and redirects,
+    replace it. The crawl ends once no worker has work left.
+
+    Replaces the dupefilter, so `DUPEFILTER_CLASS` is not used.
+    """
+
+    def __init__(self, crawler, frontier: Frontier, worker: str,
+                batch_size: int=16) -> None:
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.frontier = frontier
+        self.worker = worker
+        self.batch_size = batch_size
+
+        self.spider = None
+        self.buffer: List[Tuple[str, bytes]] = []
+        self.last_renewal = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        scheduler = cls(
+            crawler, open_frontier(s),
+            worker=s.get('FRONTIER_WORKER') or default_worker(),
+            batch_size=s.getint('FRONTIER_BATCH_SIZE', 16),
+        )
+        crawler.signals.connect(
+            scheduler.spider_closed, signal=signals.spider_closed
+        )
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        spider.logger.info(
+            f"Worker {self.worker} joined the frontier at {self.frontier.path}"
+        )
+
+    def close(self, reason):
+        # unstarted leases go back to the queue for the other workers
+        for key, _ in self.buffer:
+            self.frontier.nack(key, self.worker)
+        self.buffer.clear()
+
+    def spider_closed(self, spider, reason):
+        self.frontier.save_stats(self.worker, self.stats.get_stats())
+        self.frontier.close()
+
+    def _inc(self, name: str) -> None:
+        self.stats.inc_value(f"frontier/{name}")
+
+    # ------------------------------------------------------------------------ #
+
+    def enqueue_request(self, request) -> bool:
+        key = self.crawler.request_fingerprinter.fingerprint(request).hex()
+        payload = pickle.dumps(
+            request.to_dict(spider=self.spider), protocol=4
+        )
+
+        parent = request.meta.get('frontier_key')
+        pushed = self.frontier.push(
+            key, request.url, payload, priority=request.priority,
+            force=request.dont_filter or (parent == key), worker=self.worker
+        )
+
+        # e.g. a redirect, which replaces the request it came from
+        if (parent is not None) and (parent != key):
+            self.frontier.ack(parent, self.worker)
+
+        self._inc('enqueued' if pushed else 'duplicate')
+        return pushed
+
+    def next_request(self):
+
+        if time.monotonic() - self.last_renewal > self.frontier.lease_seconds / 3:
+            self.frontier.renew(self.worker)
+            requeued = self.frontier.requeue_expired()
+            if requeued:
+                self.stats.inc_value('frontier/requeued', requeued)
+            self.last_renewal = time.monotonic()
+
+        if not self.buffer:
+            self.buffer = self.frontier.lease(self.worker, self.batch_size)
+            self.buffer.reverse()
+            if not self.buffer:
+                return None
+
+        key, payload = self.buffer.pop()
+        request = request_from_dict(pickle.loads(payload), spider=self.spider)
+        request.meta['frontier_key'] = key
+        self._inc('leased')
+        return request
+
+    def has_pending_requests(self) -> bool:
+        if self.buffer:
+            return True
+        if self.frontier.requeue_expired():
+            self._inc('requeued')
+        return self.frontier.has_pending()
+
+    def __len__(self) -> int:
+        return len(self.buffer) + self.frontier.counts()['queued']
+
+
+def frontier_settings(path: str, worker: str=None) -> Dict[str, Any]:
+    """Settings of a worker of the frontier at `path`"""
+    return {
+        'SCHEDULER' : 'syosetu.frontier.FrontierScheduler',
+        'FRONTIER_PATH' : path,
+        'FRONTIER_WORKER' : worker,
+    }
+
+# ---------------------------------------------------------------------------- #
+
+def _parse_options(options: List[str]) -> Dict[str, str]:
+    return dict(opt.partition('=')[::2] for opt in options)
+
+def run_worker(args) -> None:
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    if args.replay:
+        from syosetu.archive import replay_settings
+        settings.setdict(replay_settings(args.replay), priority='cmdline')
+
+    settings.setdict(frontier_settings(args.path, args.worker), priority='cmdline')
+    settings.setdict(_parse_options(args.settings), priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    process.crawl(args.spider, **_parse_options(args.spargs))
+    process.start()
+
+def run_crawl(args) -> None:
+    frontier = Frontier(args.path)
+    if args.reset:
+        frontier.clear()
+    else:
+        frontier.new_run()
+
+    procs = []
+    start = time.perf_counter()
+
+    for i in range(args.workers):
+        cmd = [
+            sys.executable, '-m', 'syosetu.frontier', 'worker', args.spider,
+            '--path', args.path, '--worker', f"{socket.gethostname()}-w{i}",
+        ]
+        if args.replay:
+            cmd += ['--replay', args.replay]
+        for opt in args.spargs:
+            cmd += ['-a', opt]
+        for opt in args.settings:
+            cmd += ['-s', opt]
+
+        procs.append(subprocess.Popen(cmd))
+
+    codes = [p.wait() for p in procs]
+    elapsed = time.perf_counter() - start
+
+    stats = frontier.merged_stats()
+    counts = frontier.counts()
+    frontier.close()
+
+    for name in sorted(stats):
+        print(f"{name}: {stats[name]}")
+
+    pages = stats.get('response_received_count', 0)
+    items = stats.get('item_scraped_count', 0)
+    print(
+        f"{args.workers} workers (exit codes {codes}) crawled {pages} pages "
+        f"and scraped {items} items in {elapsed:.2f} s: "
+        f"{pages / elapsed:.1f} pages/s, {items / elapsed:.1f} items/s"
+    )
+    print(f"Frontier: {counts}")
+
+    if any(codes):
+        sys.exit(1)
+
+def main(argv: List[str]=None) -> None:
+    parser = argparse.ArgumentParser(description="Crawl with a shared frontier")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, func in (('crawl', run_crawl), ('worker', run_worker)):
+        cmd = commands.add_parser(name)
+        cmd.set_defaults(func=func)
+        cmd.add_argument('spider')
+        cmd.add_argument('--path', default='frontier.db')
+        cmd.add_argument(
+            '--replay', metavar='ARCHIVE',
+            help="serve responses from a recorded archive, see syosetu.archive"
+        )
+        cmd.add_argument(
+            '-a', dest='spargs', action='append', default=[],
+            metavar='NAME=VALUE', help="spider argument"
+        )
+        cmd.add_argument(
+            '-s', dest='settings', action='append', default=[],
+            metavar='NAME=VALUE', help="setting"
+        )
+
+    commands.choices['crawl'].add_argument('--workers', type=int, default=os.cpu_count())
+    commands.choices['crawl'].add_argument(
+        '--reset', action='store_true',
+        help="empty the frontier first, including requests left queued"
+    )
+    commands.choices['worker'].add_argument('--worker', default=None)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
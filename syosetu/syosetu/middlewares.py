@@ -3,7 +3,25 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from typing import List, Tuple, Union
+
+import regex as re
+from w3lib.url import canonicalize_url
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.misc import load_object
+
+from syosetu.archive import ArchiveWriter
+from syosetu.frontier import FrontierScheduler, open_frontier, default_worker
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -57,47 +75,487 @@ class SyosetuSpiderMiddleware:
 
 
 class SyosetuDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    """
+    HTTP cache that revalidates stale pages with conditional requests
+
+    Bodies are stored zlib-compressed under the SHA-1 of their content, so
+    identical pages are stored once. An SQLite index maps each URL to its
+    body, headers and validators (`ETag`, `Last-Modified`).
+
+    A cached page is served without a request while it is fresh, i.e.
+    younger than the lifetime of the first `SYOSETU_CACHE_POLICY` pattern
+    that matches its URL. Stale pages are requested with `If-None-Match`
+    / `If-Modified-Since`, and a `304 Not Modified` is answered from the
+    cache. Hits, misses and bytes saved are counted in the crawl stats.
+    """
+
+    STATS_PREFIX = 'syosetu_cache'
+
+    def __init__(self, cache_dir: str, policy: List[Tuple[str, float]],
+                stats=None) -> None:
+
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self.policy = [(re.compile(pat), secs) for pat, secs in policy]
+        self.stats = stats
+
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT, status INTEGER, "
+                "headers TEXT, digest TEXT, size INTEGER, stored_at REAL)"
+            )
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        settings = crawler.settings
+
+        if not settings.getbool('SYOSETU_CACHE_ENABLED'):
+            raise NotConfigured
+
+        s = cls(
+            cache_dir=settings.get('SYOSETU_CACHE_DIR', 'httpcache'),
+            policy=settings.getlist('SYOSETU_CACHE_POLICY'),
+            stats=crawler.stats,
+        )
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
+    # ------------------------------------------------------------------------ #
+
+    @staticmethod
+    def _key(request) -> str:
+        return hashlib.sha1(canonicalize_url(request.url).encode()).hexdigest()
+
+    def _lifetime(self, url: str) -> float:
+        """Seconds that a cached `url` is served without revalidation"""
+        for pattern, secs in self.policy:
+            if pattern.search(url):
+                return secs
+        return 0
+
+    def _inc(self, name: str, count: int=1) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(f"{self.STATS_PREFIX}/{name}", count)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def _load(self, key: str) -> Union[dict, None]:
+        row = self.conn.execute(
+            "SELECT url, status, headers, digest, size, stored_at "
+            "FROM responses WHERE key=?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        names = ('url', 'status', 'headers', 'digest', 'size', 'stored_at')
+        return dict(zip(names, row))
+
+    def _store(self, key: str, response) -> None:
+        body = response.body
+        digest = hashlib.sha1(body).hexdigest()
+
+        path = self._blob_path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, mode='wb') as file:
+                file.write(zlib.compress(body))
+
+        headers = json.dumps({
+            k.decode('latin1'): [v.decode('latin1') for v in vals]
+            for k, vals in response.headers.items()
+        })
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?)",
+                (key, response.url, response.status, headers, digest,
+                len(body), time.time())
+            )
+
+    def _refresh(self, key: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "UPDATE responses SET stored_at=? WHERE key=?",
+                (time.time(), key)
+            )
+
+    def _build_response(self, entry: dict, request):
+        with open(self._blob_path(entry['digest']), mode='rb') as file:
+            body = zlib.decompress(file.read())
+
+        headers = Headers(json.loads(entry['headers']))
+        respcls = responsetypes.from_args(
+            headers=headers, url=entry['url'], body=body
+        )
+
+        return respcls(
+            url=entry['url'], status=entry['status'], headers=headers,
+            body=body, request=request, flags=['cached']
+        )
+
+    # ------------------------------------------------------------------------ #
+
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+
+        if (request.method != 'GET') or request.meta.get('dont_cache'):
+            return None
+
+        key = self._key(request)
+        entry = self._load(key)
+
+        if entry is None:
+            self._inc('miss')
+            return None
+
+        age = time.time() - entry['stored_at']
+        if age < self._lifetime(request.url):
+            try:
+                response = self._build_response(entry, request)
+            except (OSError, zlib.error) as e:
+                spider.logger.warning(f"Unreadable cache entry {key}: {e}")
+                self._inc('miss')
+                return None
+
+            self._inc('hit')
+            self._inc('bytes_saved', entry['size'])
+            return response
+
+        # stale: revalidate with the stored validators
+        headers = json.loads(entry['headers'])
+        if 'Etag' in headers:
+            request.headers.setdefault('If-None-Match', headers['Etag'][0])
+        if 'Last-Modified' in headers:
+            request.headers.setdefault(
+                'If-Modified-Since', headers['Last-Modified'][0]
+            )
+
+        request.meta['_syosetu_cache'] = (key, entry)
+        self._inc('stale')
         return None
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
+        if ('cached' in response.flags) or (request.method != 'GET') or \
+            request.meta.get('dont_cache'):
+            return response
 
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        key, entry = request.meta.pop('_syosetu_cache', (None, None))
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+        if (response.status == 304) and (entry is not None):
+            try:
+                cached = self._build_response(entry, request)
+            except (OSError, zlib.error) as e:
+                spider.logger.warning(f"Unreadable cache entry {key}: {e}")
+                return response
+
+            self._refresh(key)
+            self._inc('revalidated')
+            self._inc('bytes_saved', entry['size'])
+            return cached
+
+        if response.status == 200:
+            self._store(key or self._key(request), response)
+            self._inc('stored')
+
+        return response
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+    def spider_closed(self, spider):
+        self.conn.close()
+
+
+class _HostState:
+    """AIMD state of one download slot"""
+
+    __slots__ = ('concurrency', 'delay', 'latency', 'successes',
+                'last_decrease', 'responses', 'throttled', 'errors')
+
+    def __init__(self, concurrency: int, delay: float) -> None:
+        self.concurrency = concurrency
+        self.delay = delay
+        self.latency = None
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.responses = 0
+        self.throttled = 0
+        self.errors = 0
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    AIMD control of concurrency and delay for each allowed host
+
+    Download slots of hosts in the spider's `allowed_domains` start at
+    `ADAPTIVE_START_CONCURRENCY`. Once per window of `concurrency`
+    responses that are fast enough (smoothed latency below
+    `ADAPTIVE_TARGET_LATENCY`), concurrency grows by one and the delay
+    shrinks by `ADAPTIVE_DELAY_STEP`. A 429/503, a download error or a
+    slow response halves concurrency and doubles the delay, at most
+    once per smoothed latency so one congestion event counts once.
+
+    The state of each host is kept in the stats under `adaptive/<host>/`.
+    """
+
+    THROTTLED = (429, 503)
+
+    def __init__(self, crawler) -> None:
+        s = crawler.settings
+
+        if not s.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+
+        self.target = s.getfloat('ADAPTIVE_TARGET_LATENCY', 1.0)
+        self.start = s.getint('ADAPTIVE_START_CONCURRENCY', 2)
+        self.min_conc = s.getint('ADAPTIVE_MIN_CONCURRENCY', 1)
+        self.max_conc = s.getint('ADAPTIVE_MAX_CONCURRENCY', 16)
+        self.min_delay = s.getfloat('ADAPTIVE_MIN_DELAY', 0.0)
+        self.max_delay = s.getfloat('ADAPTIVE_MAX_DELAY', 30.0)
+        self.delay_step = s.getfloat('ADAPTIVE_DELAY_STEP', 0.25)
+        self.alpha = s.getfloat('ADAPTIVE_LATENCY_SMOOTHING', 0.3)
+
+        self.domains = []
+        self.hosts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def spider_opened(self, spider):
+        self.domains = [
+            d.strip('/').lower() for d in getattr(spider, 'allowed_domains', [])
+        ]
+
+    # ------------------------------------------------------------------------ #
+
+    def _is_tracked(self, host: str) -> bool:
+        return any(
+            (host == d) or host.endswith('.' + d) for d in self.domains
+        )
+
+    def _get_slot(self, request):
+        key = request.meta.get('download_slot')
+        if key is None or not self._is_tracked(key):
+            return None, None
+
+        slots = self.crawler.engine.downloader.slots
+        return key, slots.get(key)
+
+    def _get_state(self, key: str, slot) -> _HostState:
+        state = self.hosts.get(key)
+
+        if state is None:
+            state = _HostState(
+                min(max(self.start, self.min_conc), self.max_conc),
+                max(slot.delay, self.min_delay)
+            )
+            self.hosts[key] = state
+
+        return state
+
+    def _increase(self, state: _HostState) -> None:
+        state.successes += 1
+        if state.successes < state.concurrency:
+            return
+
+        state.successes = 0
+        state.concurrency = min(state.concurrency + 1, self.max_conc)
+        state.delay = max(state.delay - self.delay_step, self.min_delay)
+
+    def _decrease(self, state: _HostState) -> None:
+        now = time.monotonic()
+        if now - state.last_decrease < (state.latency or self.target):
+            return
+
+        state.last_decrease = now
+        state.successes = 0
+        state.concurrency = max(state.concurrency // 2, self.min_conc)
+        state.delay = min(
+            max(2*state.delay, self.delay_step), self.max_delay
+        )
+
+    def _apply(self, key: str, slot, state: _HostState) -> None:
+        slot.concurrency = state.concurrency
+        slot.delay = state.delay
+
+        prefix = f"adaptive/{key}"
+        self.stats.set_value(f"{prefix}/concurrency", state.concurrency)
+        self.stats.set_value(f"{prefix}/delay", round(state.delay, 3))
+        self.stats.set_value(
+            f"{prefix}/latency", round(state.latency or 0.0, 3)
+        )
+        self.stats.set_value(f"{prefix}/responses", state.responses)
+        self.stats.set_value(f"{prefix}/throttled", state.throttled)
+        self.stats.set_value(f"{prefix}/errors", state.errors)
+
+    # ------------------------------------------------------------------------ #
+
+    def process_response(self, request, response, spider):
+
+        latency = request.meta.get('download_latency')
+        if ('cached' in response.flags) or (latency is None):
+            return response
+
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return response
+
+        state = self._get_state(key, slot)
+        state.responses += 1
+
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency += self.alpha * (latency - state.latency)
+
+        if response.status in self.THROTTLED:
+            state.throttled += 1
+            self._decrease(state)
+        elif state.latency > self.target:
+            self._decrease(state)
+        else:
+            self._increase(state)
+
+        self._apply(key, slot, state)
+        return response
+
+    def process_exception(self, request, exception, spider):
+
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return None
+
+        state = self._get_state(key, slot)
+        state.errors += 1
+        self._decrease(state)
+        self._apply(key, slot, state)
+        return None
+
+
+class ArchiveRecorderMiddleware:
+    """
+    Records every response into the WARC archive at `ARCHIVE_RECORD_PATH`
+
+    Placed before redirects and decompression are handled, so bodies and
+    headers are stored as the server sent them and a replay through
+    `syosetu.archive.ReplayDownloadHandler` runs the same middlewares.
+    Responses that `SyosetuDownloaderMiddleware` serves or revalidates
+    are recorded as well, so a cached crawl still yields a full archive.
+    """
+
+    def __init__(self, path: str, stats=None) -> None:
+        self.writer = ArchiveWriter(path)
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('ARCHIVE_RECORD_PATH')
+        if not path:
+            raise NotConfigured
+
+        s = cls(path, stats=crawler.stats)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        if 'replayed' in response.flags:
+            return response
+
+        self.writer.write_response(response)
+        if self.stats is not None:
+            self.stats.inc_value('archive/recorded')
+            self.stats.inc_value('archive/bytes', len(response.body))
+
+        return response
+
+    def spider_closed(self, spider):
+        spider.logger.info(
+            f"Recorded {self.writer.count} responses to {self.writer.path}"
+        )
+        self.writer.close()
+
+
+class FrontierMiddleware:
+    """
+    Acknowledges requests leased from the frontier of `FrontierScheduler`
+
+    As a spider middleware, placed last so it sees what every other one
+    lets through, a request is acknowledged once the output of its
+    callback has been handled, so that the requests it yields are in the
+    frontier before it leaves. As a downloader middleware, placed after
+    `RetryMiddleware`, a request that failed to download is given back
+    to the frontier for another attempt, possibly by another worker.
+    """
+
+    def __init__(self, frontier, worker: str, stats=None) -> None:
+        self.frontier = frontier
+        self.worker = worker
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        # not issubclass, which any scheduler passes for BaseScheduler
+        if FrontierScheduler not in load_object(s['SCHEDULER']).__mro__:
+            raise NotConfigured
+
+        m = cls(
+            open_frontier(s),
+            worker=s.get('FRONTIER_WORKER') or default_worker(),
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    def _ack(self, response) -> None:
+        # errback output comes with a Failure instead of a response
+        key = getattr(response, 'meta', {}).get('frontier_key')
+        if (key is not None) and self.frontier.ack(key, self.worker):
+            self.stats.inc_value('frontier/acked')
+
+    def process_spider_output(self, response, result, spider):
+        yield from result
+        self._ack(response)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for r in result:
+            yield r
+        self._ack(response)
+
+    def process_spider_exception(self, response, exception, spider):
+        # a callback that raised would raise again
+        self._ack(response)
+        return None
+
+    def process_exception(self, request, exception, spider):
+        key = request.meta.get('frontier_key')
+        if key is None:
+            return None
+
+        # dropped on purpose, e.g. offsite, so done for every worker
+        if isinstance(exception, IgnoreRequest):
+            if self.frontier.ack(key, self.worker):
+                self.stats.inc_value('frontier/acked')
+        elif self.frontier.nack(key, self.worker):
+            self.stats.inc_value('frontier/nacked')
+
+        return None
+
+    def spider_closed(self, spider):
+        self.frontier.close()
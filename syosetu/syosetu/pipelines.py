@@ -3,11 +3,310 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
+from datetime import datetime
+from typing import Dict, List, Any
+
+from scrapy.exceptions import NotConfigured
+
+from syosetu.dedup import LSHIndex, MinHasher
+from syosetu.store import NovelStore
+from syosetu.timeseries import MetricStore
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 
 class SyosetuPipeline:
     def process_item(self, item, spider):
         return item
+
+
+def novel_schema() -> 'pa.Schema':
+    """Arrow schema of `Novel` items"""
+
+    count = pa.int32()
+    return pa.schema([
+        ("ncode", pa.string()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("genre", pa.string()),
+        ("summary", pa.string()),
+        ("word_cnt", count),
+        ("post_cnt", count),
+        ("weekly_unique_cnt", count),
+        ("most_recent_update", pa.timestamp('s')),
+        ("bookmark_cnt", count),
+        ("review_cnt", count),
+        ("hyouka_cnt", count),
+        ("hyouka_pnt", count),
+        ("global_pnt", count),
+        ("url", pa.string()),
+        ("keywords", pa.list_(pa.string())),
+        ("rankings", pa.map_(pa.string(), count)),
+        ("period_pnts", pa.map_(pa.string(), count)),
+        ("near_duplicates", pa.list_(pa.string())),
+    ])
+
+
+class ParquetPipeline:
+    """
+    Buffer items into columns and write them as Parquet row groups
+
+    A row group is flushed once `PARQUET_ROW_GROUP_ROWS` items or about
+    `PARQUET_ROW_GROUP_BYTES` bytes of text are buffered, so memory use
+    does not grow with the length of the crawl. Each crawl writes one
+    file to `PARQUET_DIR`, which can be loaded with `pd.read_parquet`.
+    """
+
+    def __init__(self, out_dir: str, max_rows: int=10_000,
+                max_bytes: int=32*2**20, compression: str='zstd',
+                worker: str=None) -> None:
+
+        if pa is None:
+            raise NotConfigured("ParquetPipeline requires pyarrow.")
+
+        self.out_dir = out_dir
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.worker = worker
+
+        self.schema = novel_schema()
+        self.writer = None
+        self.path = None
+
+        self._reset()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+        return cls(
+            out_dir=s.get('PARQUET_DIR', 'output'),
+            max_rows=s.getint('PARQUET_ROW_GROUP_ROWS', 10_000),
+            max_bytes=s.getint('PARQUET_ROW_GROUP_BYTES', 32*2**20),
+            compression=s.get('PARQUET_COMPRESSION', 'zstd'),
+            worker=s.get('FRONTIER_WORKER'),
+        )
+
+    def _reset(self) -> None:
+        self.columns: Dict[str, List[Any]] = {
+            name: [] for name in self.schema.names
+        }
+        self.rows = 0
+        self.nbytes = 0
+
+    def open_spider(self, spider):
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        # workers of a distributed crawl start at the same time
+        if self.worker:
+            stamp += f"-{self.worker}"
+
+        self.path = os.path.join(
+            self.out_dir, f"{spider.name}-{stamp}.parquet"
+        )
+
+    def process_item(self, item, spider):
+
+        adapter = ItemAdapter(item)
+
+        for name, column in self.columns.items():
+            value = adapter.get(name)
+            column.append(value)
+
+            if isinstance(value, str):
+                # UTF-8 Japanese text is mostly three bytes per character
+                self.nbytes += 3*len(value)
+            elif isinstance(value, list):
+                self.nbytes += sum(3*len(v) for v in value)
+            else:
+                self.nbytes += 8
+
+        self.rows += 1
+        if (self.rows >= self.max_rows) or (self.nbytes >= self.max_bytes):
+            self.flush()
+
+        return item
+
+    def flush(self) -> None:
+        """Write buffered items as one row group"""
+
+        if not self.rows:
+            return
+
+        table = pa.Table.from_pydict(self.columns, schema=self.schema)
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.path, self.schema, compression=self.compression
+            )
+
+        self.writer.write_table(table, row_group_size=self.rows)
+        self._reset()
+
+    def close_spider(self, spider):
+        self.flush()
+
+        if self.writer is not None:
+            self.writer.close()
+            spider.logger.info(f"Saved items to {self.path}")
+
+
+class SqlitePipeline:
+    """
+    Upsert items by ncode into the `NovelStore` at `SQLITE_PATH`
+
+    Items are written in batches of `SQLITE_BATCH_SIZE`, each in one 
+    transaction. Items without an ncode are passed on unchanged.
+    """
+
+    def __init__(self, path: str, batch_size: int=500) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.store = None
+        self.batch = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        if not s.get('SQLITE_PATH'):
+            raise NotConfigured("SQLITE_PATH is not set.")
+
+        return cls(s.get('SQLITE_PATH'), s.getint('SQLITE_BATCH_SIZE', 500))
+
+    def open_spider(self, spider):
+        self.store = NovelStore(self.path)
+
+    def process_item(self, item, spider):
+
+        adapter = ItemAdapter(item)
+        if not adapter.get('ncode'):
+            return item
+
+        self.batch.append(adapter.asdict())
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+        return item
+
+    def flush(self) -> None:
+        if self.batch:
+            self.store.upsert_many(self.batch)
+            self.batch = []
+
+    def close_spider(self, spider):
+        self.flush()
+        self.store.close()
+
+
+class TimeSeriesPipeline:
+    """
+    Append the metrics of each crawl to the `MetricStore` at
+    `TIMESERIES_PATH`, as one snapshot taken when the crawl started
+
+    Items are written in batches of `TIMESERIES_BATCH_SIZE`.
+    """
+
+    def __init__(self, path: str, batch_size: int=5000) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.store = None
+        self.batch = []
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        if not s.get('TIMESERIES_PATH'):
+            raise NotConfigured("TIMESERIES_PATH is not set.")
+
+        return cls(
+            s.get('TIMESERIES_PATH'), s.getint('TIMESERIES_BATCH_SIZE', 5000)
+        )
+
+    def open_spider(self, spider):
+        self.store = MetricStore(self.path)
+        self.started = datetime.now()
+
+    def process_item(self, item, spider):
+
+        adapter = ItemAdapter(item)
+        if not adapter.get('ncode'):
+            return item
+
+        self.batch.append(adapter.asdict())
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+        return item
+
+    def flush(self) -> None:
+        if self.batch:
+            self.store.append(self.started, self.batch)
+            self.batch = []
+
+    def close_spider(self, spider):
+        self.flush()
+        self.store.close()
+
+
+class NearDuplicatePipeline:
+    """
+    Flag novels whose summary is a near duplicate of an earlier novel's
+    in the crawl, e.g. reposts and forks
+
+    Summaries with an estimated Jaccard similarity of at least
+    `DEDUP_THRESHOLD`, over shingles of `DEDUP_SHINGLE_SIZE` characters,
+    are found through an `LSHIndex`, and their ncodes are set as the
+    item's `near_duplicates`, most similar first.
+    """
+
+    def __init__(self, stats, threshold: float=0.8, num_perm: int=128,
+                shingle_size: int=5) -> None:
+        self.stats = stats
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.index = None
+        self.seen = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+
+        if s.get('DEDUP_THRESHOLD') is None:
+            raise NotConfigured("DEDUP_THRESHOLD is not set.")
+
+        return cls(
+            crawler.stats, s.getfloat('DEDUP_THRESHOLD'),
+            s.getint('DEDUP_NUM_PERM', 128), s.getint('DEDUP_SHINGLE_SIZE', 5)
+        )
+
+    def open_spider(self, spider):
+        self.index = LSHIndex(self.threshold, self.hasher.num_perm)
+
+    def process_item(self, item, spider):
+
+        adapter = ItemAdapter(item)
+        ncode = adapter.get('ncode')
+        if not ncode or not adapter.get('summary') or ncode in self.seen:
+            return item
+
+        sig = self.hasher.signature(adapter['summary'])
+        found = [other for other, _ in self.index.query(sig)]
+        if found:
+            adapter['near_duplicates'] = found
+            self.stats.inc_value('dedup/flagged')
+
+        self.index.add(ncode, sig)
+        self.seen.add(ncode)
+        return item
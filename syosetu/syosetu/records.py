@@ -0,0 +1,362 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Compact in-memory storage of `Novel` items
+
+A `Novel` is a dict of Python objects: every number is a separate int,
+and every genre and keyword a separate copy of a string that thousands
+of other novels share. `NovelRecord` holds one novel in `__slots__`,
+with its genre as a small int and its keywords as ids in `KEYWORDS`.
+`NovelTable` holds many, with the metrics, update times, genres and
+keywords of all novels in a few typed numpy arrays.
+
+Both convert to and from `Novel` without re-parsing anything.
+"""
+
+import sys
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Iterable, Iterator, List, Union
+
+from syosetu.spiders.novels_spider import Novel, NOVEL_METRIC_FIELDS
+
+# ---------------------------------------------------------------------------- #
+
+# stored for metrics that were not found
+MISSING = -1
+
+NCODE_URL = "https://ncode.syosetu.com/%s/"
+
+class StringPool:
+    """Interned strings and their int ids, in order of first use"""
+
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self, strings: Iterable[str]=()) -> None:
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = dict()
+        for s in strings:
+            self.code(s)
+
+    def code(self, s: str) -> int:
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(sys.intern(s))
+        return i
+
+    def codes(self, strings: Iterable[str]) -> List[int]:
+        return [self.code(s) for s in strings]
+
+    def __getitem__(self, i: int) -> str:
+        return self.strings[i]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+# genres and keywords of all records
+GENRES = StringPool()
+KEYWORDS = StringPool()
+
+def _url(ncode: str, url: Union[str, None]) -> Union[str, None]:
+    # most URLs follow from the ncode, and need not be stored
+    return None if url == NCODE_URL % ncode else url
+
+def _metric(value: Union[int, None]) -> int:
+    return MISSING if value is None else value
+
+def _unmetric(value: int) -> Union[int, None]:
+    return None if value == MISSING else int(value)
+
+# ---------------------------------------------------------------------------- #
+
+class NovelRecord:
+    """
+    One novel, with its genre coded in `GENRES`, its keywords as a tuple
+    of ids in `KEYWORDS` and `MISSING` for metrics that were not found
+    """
+
+    __slots__ = (
+        'ncode', 'title', 'author', 'genre', 'summary', 'url', 'keywords',
+        'most_recent_update', 'rankings', 'period_pnts', 'near_duplicates',
+    ) + NOVEL_METRIC_FIELDS
+
+    def __init__(self, ncode: str, **fields) -> None:
+        self.ncode = ncode
+        self.title = fields.get('title')
+        self.author = fields.get('author')
+        self.genre = fields.get('genre', MISSING)
+        self.summary = fields.get('summary')
+        self.url = fields.get('url')
+        self.keywords = fields.get('keywords', ())
+        self.most_recent_update = fields.get('most_recent_update')
+        self.rankings = fields.get('rankings')
+        self.period_pnts = fields.get('period_pnts')
+        self.near_duplicates = fields.get('near_duplicates')
+
+        for name in NOVEL_METRIC_FIELDS:
+            setattr(self, name, fields.get(name, MISSING))
+
+    @classmethod
+    def from_item(cls, item: Novel) -> 'NovelRecord':
+        genre = item.get('genre')
+        author = item.get('author')
+
+        record = cls(
+            item['ncode'], title=item.get('title'),
+            author=None if author is None else sys.intern(author),
+            genre=MISSING if genre is None else GENRES.code(genre),
+            summary=item.get('summary'),
+            url=_url(item['ncode'], item.get('url')),
+            keywords=tuple(KEYWORDS.codes(item.get('keywords') or ())),
+            most_recent_update=item.get('most_recent_update'),
+            rankings=item.get('rankings'),
+            period_pnts=item.get('period_pnts'),
+            near_duplicates=item.get('near_duplicates'),
+        )
+        for name in NOVEL_METRIC_FIELDS:
+            setattr(record, name, _metric(item.get(name)))
+
+        return record
+
+    def to_item(self) -> Novel:
+        item = Novel(
+            ncode=self.ncode, title=self.title, author=self.author,
+            genre=None if self.genre == MISSING else GENRES[self.genre],
+            summary=self.summary,
+            url=NCODE_URL % self.ncode if self.url is None else self.url,
+            keywords=[KEYWORDS[k] for k in self.keywords],
+            most_recent_update=self.most_recent_update,
+            **{name: _unmetric(getattr(self, name)) for name in NOVEL_METRIC_FIELDS}
+        )
+        if self.rankings is not None:
+            item['rankings'] = self.rankings
+        if self.period_pnts is not None:
+            item['period_pnts'] = self.period_pnts
+        if self.near_duplicates is not None:
+            item['near_duplicates'] = self.near_duplicates
+        return item
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, NovelRecord):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return f"NovelRecord({self.ncode}, {self.title!r})"
+
+# ---------------------------------------------------------------------------- #
+
+class NovelTable:
+    """
+    Columns of many novels
+
+    Metrics are rows of an `int32` array, update times `datetime64[s]`,
+    ncodes fixed-width bytes, genres `int16` codes and keywords one
+    `int32` array of ids with the offset of each novel's ids. Arrays grow
+    by doubling. Titles and summaries stay Python strings; authors are
+    interned, since prolific authors repeat.
+    """
+
+    NCODE_DTYPE = 'S10'
+
+    def __init__(self, capacity: int=1024, keyword_capacity: int=None) -> None:
+        self.size = 0
+
+        self.metrics = np.full(
+            (capacity, len(NOVEL_METRIC_FIELDS)), MISSING, dtype=np.int32
+        )
+        self.updates = np.full(capacity, np.datetime64('NaT'), dtype='datetime64[s]')
+        self.genres = np.full(capacity, MISSING, dtype=np.int16)
+        self.ncodes = np.zeros(capacity, dtype=self.NCODE_DTYPE)
+
+        # keyword ids of novel i are keyword_ids[offsets[i]:offsets[i+1]]
+        self.keyword_ids = np.zeros(
+            4 * capacity if keyword_capacity is None else keyword_capacity,
+            dtype=np.int32
+        )
+        self.offsets = np.zeros(capacity + 1, dtype=np.int64)
+
+        self.titles: List[str] = []
+        self.authors: List[str] = []
+        self.summaries: List[str] = []
+
+        # only URLs that cannot be derived, and rankings, period points
+        # and near duplicates where present, by row
+        self.urls: Dict[int, str] = dict()
+        self.rankings: Dict[int, Dict[str, int]] = dict()
+        self.period_pnts: Dict[int, Dict[str, int]] = dict()
+        self.near_duplicates: Dict[int, List[str]] = dict()
+
+        # row of each ncode, built on first lookup
+        self._index: Union[Dict[str, int], None] = None
+
+    @classmethod
+    def from_items(cls, items: Iterable[Novel]) -> 'NovelTable':
+        items = list(items)
+        table = cls(
+            max(len(items), 1),
+            sum(len(item.get('keywords') or ()) for item in items)
+        )
+        table.extend(items)
+        return table
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def index(self) -> Dict[str, int]:
+        if self._index is None:
+            self._index = {self.ncode(i): i for i in range(self.size)}
+        return self._index
+
+    def __contains__(self, ncode: str) -> bool:
+        return ncode in self.index
+
+    @staticmethod
+    def _grow(arr: np.ndarray, size: int, fill) -> np.ndarray:
+        if size <= len(arr):
+            return arr
+        new = np.full((max(size, 2*len(arr)),) + arr.shape[1:], fill, dtype=arr.dtype)
+        new[:len(arr)] = arr
+        return new
+
+    def append(self, item: Union[Novel, NovelRecord]) -> int:
+        """Add a novel and return its row"""
+
+        if isinstance(item, NovelRecord):
+            item = item.to_item()
+
+        i = self.size
+        self.metrics = self._grow(self.metrics, i + 1, MISSING)
+        self.updates = self._grow(self.updates, i + 1, np.datetime64('NaT'))
+        self.genres = self._grow(self.genres, i + 1, MISSING)
+        self.ncodes = self._grow(self.ncodes, i + 1, b'')
+        self.offsets = self._grow(self.offsets, i + 2, 0)
+
+        self.metrics[i] = [_metric(item.get(name)) for name in NOVEL_METRIC_FIELDS]
+
+        date = item.get('most_recent_update')
+        if date is not None:
+            self.updates[i] = np.datetime64(date, 's')
+
+        genre = item.get('genre')
+        if genre is not None:
+            self.genres[i] = GENRES.code(genre)
+
+        ids = KEYWORDS.codes(item.get('keywords') or ())
+        start = self.offsets[i]
+        self.keyword_ids = self._grow(self.keyword_ids, start + len(ids), 0)
+        self.keyword_ids[start:start + len(ids)] = ids
+        self.offsets[i + 1] = start + len(ids)
+
+        ncode = item['ncode']
+        self.ncodes[i] = code = ncode.encode('ascii')
+        if len(code) > self.ncodes.itemsize:
+            raise ValueError(f"Unexpected ncode {ncode!r}")
+
+        author = item.get('author')
+        self.titles.append(item.get('title'))
+        self.authors.append(None if author is None else sys.intern(author))
+        self.summaries.append(item.get('summary'))
+
+        url = _url(ncode, item.get('url'))
+        if url is not None:
+            self.urls[i] = url
+        if item.get('rankings') is not None:
+            self.rankings[i] = item['rankings']
+        if item.get('period_pnts') is not None:
+            self.period_pnts[i] = item['period_pnts']
+        if item.get('near_duplicates') is not None:
+            self.near_duplicates[i] = item['near_duplicates']
+
+        if self._index is not None:
+            self._index[ncode] = i
+        self.size += 1
+        return i
+
+    def extend(self, items: Iterable[Union[Novel, NovelRecord]]) -> None:
+        for item in items:
+            self.append(item)
+
+    # ------------------------------------------------------------------------ #
+
+    def ncode(self, i: int) -> str:
+        return self.ncodes[i].decode('ascii')
+
+    def keywords(self, i: int) -> List[str]:
+        ids = self.keyword_ids[self.offsets[i]:self.offsets[i + 1]]
+        return [KEYWORDS[k] for k in ids]
+
+    def metric(self, name: str) -> np.ndarray:
+        """Column of `name` for every novel, a view"""
+        return self.metrics[:self.size, NOVEL_METRIC_FIELDS.index(name)]
+
+    def record(self, i: int) -> NovelRecord:
+        update = self.updates[i]
+        record = NovelRecord(
+            self.ncode(i), title=self.titles[i], author=self.authors[i],
+            genre=int(self.genres[i]), summary=self.summaries[i],
+            url=self.urls.get(i),
+            keywords=tuple(
+                self.keyword_ids[self.offsets[i]:self.offsets[i + 1]].tolist()
+            ),
+            most_recent_update=None if np.isnat(update) else update.item(),
+            rankings=self.rankings.get(i),
+            period_pnts=self.period_pnts.get(i),
+            near_duplicates=self.near_duplicates.get(i),
+        )
+        for name, value in zip(NOVEL_METRIC_FIELDS, self.metrics[i].tolist()):
+            setattr(record, name, value)
+        return record
+
+    def item(self, i: int) -> Novel:
+        return self.record(i).to_item()
+
+    def __getitem__(self, ncode: str) -> Novel:
+        return self.item(self.index[ncode])
+
+    def __iter__(self) -> Iterator[Novel]:
+        for i in range(self.size):
+            yield self.item(i)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the numeric arrays, without the strings"""
+        return sum(a.nbytes for a in (
+            self.metrics, self.updates, self.genres, self.ncodes,
+            self.keyword_ids, self.offsets
+        ))
+
+    def to_frame(self, text: bool=False) -> pd.DataFrame:
+        """
+        Metrics, update time, genre and keyword count of every novel by
+        ncode, with title, author and summary if `text`
+        """
+        n = self.size
+        df = pd.DataFrame(
+            self.metrics[:n], columns=list(NOVEL_METRIC_FIELDS),
+            index=pd.Index(
+                np.char.decode(self.ncodes[:n], 'ascii'), name='ncode'
+            )
+        ).replace(MISSING, pd.NA)
+
+        df['most_recent_update'] = self.updates[:n]
+        df['genre'] = pd.Categorical.from_codes(
+            self.genres[:n].astype(np.int64), categories=GENRES.strings
+        ) if len(GENRES) else None
+        df['keyword_cnt'] = np.diff(self.offsets[:n + 1])
+
+        if text:
+            df['title'] = self.titles
+            df['author'] = self.authors
+            df['summary'] = self.summaries
+
+        return df
@@ -0,0 +1,667 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Full-text search over chapters and novel summaries
+
+Japanese text is not segmented into words, so `SearchIndex` indexes the
+character bigrams of each document instead: 魔法使い is 魔法, 法使, 使い.
+A document is a chapter, as written by `ChapterSpider`, or a novel's
+title, summary and keywords, as chapter `SUMMARY_CHAPTER`. Text is
+normalised by `syosetu.text.normalize` first, so punctuation, ruby
+readings and full-width forms do not matter.
+
+The index is a directory of immutable segments and a manifest. Each
+segment has a sorted array of bigrams and, for each bigram, the
+delta-encoded documents containing it and their counts as varints.
+Arrays are memory-mapped, so opening an index reads only the manifest,
+and a query reads only the postings of its bigrams. New documents are
+buffered and written as a new segment by `flush`. A document added
+again replaces the earlier one, which is masked as deleted. `merge`
+rewrites the smallest segments as one, dropping deleted documents.
+
+Queries are ranked by BM25 over their bigrams. By default a hit has
+every bigram of the query, which is nearly always a match of the query
+itself; one-character words match any bigram starting with them.
+
+    python -m syosetu.search index search_index --chapters chapters --store novels.db
+    python -m syosetu.search query search_index 魔法使い
+"""
+
+import os
+import sys
+import json
+import gzip
+import shutil
+import sqlite3
+import argparse
+import numpy as np
+
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from syosetu.text import normalize
+
+# ---------------------------------------------------------------------------- #
+
+# chapter number of a novel's title, summary and keywords
+SUMMARY_CHAPTER = 0
+
+# documents buffered before `add` writes a segment
+SEGMENT_DOCS = 20000
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+MANIFEST = "manifest.json"
+
+# ncode, chapter, score
+Hit = Tuple[str, int, float]
+
+# a bigram is two code points of 21 bits each
+_CHAR_BITS = np.uint64(21)
+_SPACE = 32
+
+def _codes(text: str) -> np.ndarray:
+    text = normalize(text, collapse=True).lower() + ' '
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+
+def bigrams(text: str) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Distinct bigrams of `text` as sorted uint64 keys, their counts, and
+    the number of bigrams in all. The last character of a run is paired
+    with the space after it, so every character starts a bigram.
+    """
+    codes = _codes(text)
+    first, second = codes[:-1], codes[1:]
+    keep = first != _SPACE
+
+    keys, counts = np.unique(
+        ((first << _CHAR_BITS) | second)[keep], return_counts=True
+    )
+    return keys, counts, int(keep.sum())
+
+def _query_terms(query: str) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+    """
+    Key ranges of the bigrams of `query` and their counts. A bigram is
+    the range of its key alone; a one-character word is the range of
+    every bigram starting with it.
+    """
+    words = normalize(query, collapse=True).lower().split()
+
+    counts: Dict[Tuple[int, int], int] = dict()
+    for word in words:
+        if len(word) == 1:
+            lo = ord(word) << 21
+            terms = [(lo, lo + (1 << 21))]
+        else:
+            keys = [(ord(a) << 21) | ord(b) for a, b in zip(word, word[1:])]
+            terms = [(key, key + 1) for key in keys]
+
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+
+    return list(counts), np.array(list(counts.values()), dtype=np.float64)
+
+# ---------------------------------------------------------------------------- #
+
+def _encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """LEB128 bytes of unsigned `values`, and where each value ends"""
+
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+
+    ends = np.cumsum(nbytes)
+    pos = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - nbytes, nbytes)
+    out = (np.repeat(values, nbytes) >> (7 * pos).astype(np.uint64)) & np.uint64(0x7F)
+    out = out.astype(np.uint8)
+    # continuation bit on all but the last byte of each value
+    out[pos < np.repeat(nbytes - 1, nbytes)] |= 0x80
+    return out, ends
+
+def _decode_varints(buf: np.ndarray) -> np.ndarray:
+    buf = np.asarray(buf, dtype=np.uint8)
+    if not len(buf):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    pos = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7F).astype(np.uint64) << (7 * pos).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+def _decode_docs(buf: np.ndarray, df: np.ndarray) -> np.ndarray:
+    """Documents of consecutive postings lists with `df` documents each"""
+
+    deltas = _decode_varints(buf).astype(np.int64)
+    total = np.cumsum(deltas)
+    starts = np.concatenate(([0], np.cumsum(df)[:-1])).astype(np.int64)
+    # each list restarts from its first, absolute, document
+    base = total[starts] - deltas[starts]
+    return total - np.repeat(base, df)
+
+# ---------------------------------------------------------------------------- #
+
+def _save(path: str, name: str, array: np.ndarray) -> None:
+    np.save(os.path.join(path, name + ".npy"), array)
+
+def _write_segment(path: str, keys: np.ndarray, docs: np.ndarray,
+                tfs: np.ndarray, ncodes: np.ndarray, chapters: np.ndarray,
+                lengths: np.ndarray, deleted: np.ndarray) -> None:
+    """Write the postings (`keys`, `docs`, `tfs`) of a segment to `path`"""
+
+    order = np.lexsort((docs, keys))
+    keys, docs, tfs = keys[order], docs[order].astype(np.int64), tfs[order]
+
+    terms, starts, df = np.unique(keys, return_index=True, return_counts=True)
+    deltas = docs.copy()
+    deltas[1:] -= docs[:-1]
+    deltas[starts] = docs[starts]
+
+    bounds = np.append(starts, len(keys))
+    doc_bytes, doc_ends = _encode_varints(deltas)
+    tf_bytes, tf_ends = _encode_varints(tfs)
+
+    tmp = path + ".tmp"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    _save(tmp, "terms", terms.astype(np.uint64))
+    _save(tmp, "df", df.astype(np.uint32))
+    _save(tmp, "doc_offsets", np.append(0, doc_ends)[bounds].astype(np.uint64))
+    _save(tmp, "tf_offsets", np.append(0, tf_ends)[bounds].astype(np.uint64))
+    _save(tmp, "ncodes", np.asarray(ncodes, dtype='S10'))
+    _save(tmp, "chapters", np.asarray(chapters, dtype=np.int32))
+    _save(tmp, "lengths", np.asarray(lengths, dtype=np.int32))
+    _save(tmp, "deleted", np.asarray(deleted, dtype=bool))
+    doc_bytes.tofile(os.path.join(tmp, "postings.bin"))
+    tf_bytes.tofile(os.path.join(tmp, "tfs.bin"))
+
+    os.replace(tmp, path)
+
+def _map_bytes(path: str) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+class Segment:
+    """An immutable segment of the index, memory-mapped, with its deletions"""
+
+    __slots__ = ('path', 'terms', 'df', 'doc_offsets', 'tf_offsets',
+                'postings', 'tfs', 'ncodes', 'chapters', 'lengths', 'deleted',
+                '_live_length')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+        self.terms = load("terms")
+        self.df = load("df")
+        self.doc_offsets = load("doc_offsets")
+        self.tf_offsets = load("tf_offsets")
+        self.ncodes = load("ncodes")
+        self.chapters = load("chapters")
+        self.lengths = load("lengths")
+        self.postings = _map_bytes(os.path.join(path, "postings.bin"))
+        self.tfs = _map_bytes(os.path.join(path, "tfs.bin"))
+
+        # rewritten when documents are replaced, so not mapped
+        self.deleted = np.load(os.path.join(path, "deleted.npy"))
+        self._live_length = None
+
+    def __len__(self) -> int:
+        return len(self.ncodes)
+
+    @property
+    def live(self) -> int:
+        return len(self.deleted) - int(self.deleted.sum())
+
+    @property
+    def live_length(self) -> int:
+        if self._live_length is None:
+            self._live_length = int(self.lengths[~self.deleted].sum(dtype=np.int64))
+        return self._live_length
+
+    def delete(self, docs: np.ndarray) -> None:
+        deleted = self.deleted.copy()
+        deleted[docs] = True
+
+        tmp = os.path.join(self.path, "deleted.tmp.npy")
+        np.save(tmp, deleted)
+        os.replace(tmp, os.path.join(self.path, "deleted.npy"))
+
+        self.deleted = deleted
+        self._live_length = None
+
+    def term_range(self, lo: int, hi: int) -> Tuple[int, int]:
+        """Indices of the terms with keys in [`lo`, `hi`)"""
+        i, j = np.searchsorted(self.terms, np.array([lo, hi], dtype=np.uint64))
+        return int(i), int(j)
+
+    def df_of(self, lo: int, hi: int) -> int:
+        i, j = self.term_range(lo, hi)
+        return int(self.df[i:j].sum())
+
+    def postings_of(self, i: int, j: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted documents with any of the terms `i` to `j`, and their counts"""
+
+        if i == j:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        docs = _decode_docs(
+            self.postings[self.doc_offsets[i]:self.doc_offsets[j]], self.df[i:j]
+        )
+        tfs = _decode_varints(
+            self.tfs[self.tf_offsets[i]:self.tf_offsets[j]]
+        ).astype(np.int64)
+
+        if j - i > 1:
+            docs, inverse = np.unique(docs, return_inverse=True)
+            tfs = np.bincount(inverse, weights=tfs).astype(np.int64)
+        return docs, tfs
+
+    def all_postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Keys, documents and counts of every posting"""
+        df = np.asarray(self.df, dtype=np.int64)
+        return (
+            np.repeat(np.asarray(self.terms), df),
+            _decode_docs(self.postings, df),
+            _decode_varints(self.tfs).astype(np.int64),
+        )
+
+# ---------------------------------------------------------------------------- #
+
+class SearchIndex:
+    """
+    Bigram index of chapters and summaries in the directory `path`
+
+    Documents are identified by ncode and chapter. `add` buffers them
+    and writes a segment every `segment_docs` documents; `flush` writes
+    the rest. Use it as a context manager, so the buffer is flushed.
+    """
+
+    def __init__(self, path: str, segment_docs: int=SEGMENT_DOCS) -> None:
+        self.path = path
+        self.segment_docs = segment_docs
+        os.makedirs(path, exist_ok=True)
+
+        self.manifest = {"segments" : [], "next" : 0, "sources" : {}}
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, mode='r', encoding='utf8') as file:
+                self.manifest.update(json.load(file))
+
+        self.segments = [
+            Segment(os.path.join(path, name)) for name in self.manifest["segments"]
+        ]
+        self._reset()
+
+    def _reset(self) -> None:
+        self._keys: List[np.ndarray] = []
+        self._tfs: List[np.ndarray] = []
+        self._ncodes: List[str] = []
+        self._chapters: List[int] = []
+        self._lengths: List[int] = []
+        # buffered document of each (ncode, chapter)
+        self._buffered: Dict[Tuple[str, int], int] = dict()
+        # source offsets, saved with the segment of their documents
+        self._sources: Dict[str, int] = dict()
+
+    def __enter__(self) -> 'SearchIndex':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return sum(seg.live for seg in self.segments)
+
+    # ------------------------------------------------------------------------ #
+
+    def add(self, ncode: str, chapter: int, text: str) -> None:
+        """Index `text` as chapter `chapter` of `ncode`, replacing any earlier"""
+
+        keys, tfs, length = bigrams(text)
+        self._buffered[(ncode, chapter)] = len(self._ncodes)
+        self._keys.append(keys)
+        self._tfs.append(tfs)
+        self._ncodes.append(ncode)
+        self._chapters.append(chapter)
+        self._lengths.append(length)
+
+        if len(self._ncodes) >= self.segment_docs:
+            self.flush()
+
+    def add_many(self, docs: Iterable[Tuple[str, int, str]]) -> int:
+        """Index (ncode, chapter, text) documents; returns how many"""
+        n = 0
+        for ncode, chapter, text in docs:
+            self.add(ncode, chapter, text)
+            n += 1
+        return n
+
+    def source_offset(self, name: str) -> int:
+        """Bytes of the source file `name` already indexed"""
+        return self._sources.get(name, self.manifest["sources"].get(name, 0))
+
+    def set_source_offset(self, name: str, offset: int) -> None:
+        """Record `offset` of `name` as indexed, with the next segment"""
+        self._sources[name] = offset
+
+    def _save_manifest(self) -> None:
+        path = os.path.join(self.path, MANIFEST)
+        with open(path + ".tmp", mode='w', encoding='utf8') as file:
+            json.dump(self.manifest, file, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _new_segment_path(self) -> Tuple[str, str]:
+        name = f"seg-{self.manifest['next']:06d}"
+        self.manifest["next"] += 1
+        return name, os.path.join(self.path, name)
+
+    def flush(self) -> None:
+        """Write the buffered documents as a new segment"""
+
+        if not self._ncodes:
+            if self._sources:
+                self.manifest["sources"].update(self._sources)
+                self._save_manifest()
+                self._sources = dict()
+            return
+
+        n = len(self._ncodes)
+        sizes = [len(k) for k in self._keys]
+        deleted = np.ones(n, dtype=bool)
+        deleted[list(self._buffered.values())] = False
+
+        name, path = self._new_segment_path()
+        _write_segment(
+            path,
+            np.concatenate(self._keys),
+            np.repeat(np.arange(n, dtype=np.int64), sizes),
+            np.concatenate(self._tfs).astype(np.int64),
+            self._ncodes, self._chapters, self._lengths, deleted
+        )
+
+        replaced = self._buffered
+        ncodes = np.unique(np.array(list({k[0] for k in replaced}), dtype='S10'))
+
+        self.manifest["segments"].append(name)
+        self.manifest["sources"].update(self._sources)
+        self._save_manifest()
+
+        # older copies of the new documents; a crash before this leaves
+        # them searchable, but never loses a document
+        for seg in self.segments:
+            candidates = np.flatnonzero(np.isin(seg.ncodes, ncodes))
+            docs = [
+                doc for doc in candidates
+                if (seg.ncodes[doc].decode(), int(seg.chapters[doc])) in replaced
+                and not seg.deleted[doc]
+            ]
+            if docs:
+                seg.delete(np.array(docs, dtype=np.int64))
+
+        self.segments.append(Segment(path))
+        self._reset()
+
+    def merge(self, max_segments: int=1) -> None:
+        """
+        Rewrite the smallest segments as one, so at most `max_segments`
+        remain, without their deleted documents. Postings of the merged
+        segments are held in memory while merging.
+        """
+        self.flush()
+        if len(self.segments) <= max(max_segments, 1):
+            return
+
+        by_size = sorted(self.segments, key=len)
+        merged = by_size[:len(self.segments) - max(max_segments, 1) + 1]
+
+        keys, docs, tfs = [], [], []
+        ncodes, chapters, lengths = [], [], []
+        base = 0
+        for seg in merged:
+            live = ~seg.deleted
+            # new document numbers, without the deleted ones
+            renumber = np.cumsum(live) - 1 + base
+
+            seg_keys, seg_docs, seg_tfs = seg.all_postings()
+            keep = live[seg_docs]
+            keys.append(seg_keys[keep])
+            docs.append(renumber[seg_docs[keep]])
+            tfs.append(seg_tfs[keep])
+
+            ncodes.append(np.asarray(seg.ncodes)[live])
+            chapters.append(np.asarray(seg.chapters)[live])
+            lengths.append(np.asarray(seg.lengths)[live])
+            base += int(live.sum())
+
+        name, path = self._new_segment_path()
+        _write_segment(
+            path, np.concatenate(keys), np.concatenate(docs),
+            np.concatenate(tfs), np.concatenate(ncodes),
+            np.concatenate(chapters), np.concatenate(lengths),
+            np.zeros(base, dtype=bool)
+        )
+
+        old = {seg.path for seg in merged}
+        self.segments = [seg for seg in self.segments if seg.path not in old]
+        self.segments.append(Segment(path))
+        self.manifest["segments"] = [
+            os.path.basename(seg.path) for seg in self.segments
+        ]
+        self._save_manifest()
+
+        # unmapped first, for Windows
+        del merged, by_size, seg
+        for seg_path in old:
+            shutil.rmtree(seg_path, ignore_errors=True)
+
+    def close(self) -> None:
+        self.flush()
+
+    # ------------------------------------------------------------------------ #
+
+    def search(self, query: str, top: int=10, require_all: bool=True) -> List[Hit]:
+        """
+        The `top` documents by BM25 score for `query`. With
+        `require_all`, only documents with every bigram of the query.
+        """
+        terms, qtf = _query_terms(query)
+        segments = [seg for seg in self.segments if seg.live]
+        if not terms or not segments:
+            return []
+
+        n_docs = sum(seg.live for seg in segments)
+        avg_length = max(sum(seg.live_length for seg in segments) / n_docs, 1.)
+
+        df = np.array([
+            sum(seg.df_of(lo, hi) for seg in segments) for lo, hi in terms
+        ], dtype=np.float64)
+        if require_all and not df.all():
+            return []
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)) * qtf
+
+        found_scores, found_segs, found_docs = [], [], []
+        for s, seg in enumerate(segments):
+            scored = self._search_segment(seg, terms, idf, avg_length, require_all)
+            if scored is None:
+                continue
+            docs, scores = scored
+            found_scores.append(scores)
+            found_docs.append(docs)
+            found_segs.append(np.full(len(docs), s))
+
+        if not found_scores:
+            return []
+
+        scores = np.concatenate(found_scores)
+        segs = np.concatenate(found_segs)
+        docs = np.concatenate(found_docs)
+
+        if len(scores) > top:
+            best = np.argpartition(-scores, top - 1)[:top]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.lexsort((docs[best], segs[best], -scores[best]))]
+
+        return [
+            (segments[segs[i]].ncodes[docs[i]].decode(),
+            int(segments[segs[i]].chapters[docs[i]]), float(scores[i]))
+            for i in best
+        ]
+
+    @staticmethod
+    def _search_segment(seg: Segment, terms: List[Tuple[int, int]],
+                        idf: np.ndarray, avg_length: float,
+                        require_all: bool) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+
+        ranges = [seg.term_range(lo, hi) for lo, hi in terms]
+        if require_all and any(i == j for i, j in ranges):
+            return None
+
+        # rarest first, so the candidates shrink fastest
+        order = sorted(range(len(terms)), key=lambda t: seg.df[ranges[t][0]:ranges[t][1]].sum())
+        postings = {t: seg.postings_of(*ranges[t]) for t in order}
+
+        def weight(t: int, docs: np.ndarray, tfs: np.ndarray) -> np.ndarray:
+            norm = 1 - BM25_B + BM25_B * seg.lengths[docs] / avg_length
+            return idf[t] * tfs * (BM25_K1 + 1) / (tfs + BM25_K1 * norm)
+
+        if require_all:
+            docs = postings[order[0]][0]
+            for t in order[1:]:
+                term_docs = postings[t][0]
+                idx = np.minimum(np.searchsorted(term_docs, docs), len(term_docs) - 1)
+                docs = docs[term_docs[idx] == docs]
+                if not len(docs):
+                    return None
+
+            scores = np.zeros(len(docs))
+            for t in order:
+                term_docs, tfs = postings[t]
+                scores += weight(t, docs, tfs[np.searchsorted(term_docs, docs)])
+        else:
+            all_docs = np.concatenate([postings[t][0] for t in order])
+            all_scores = np.concatenate([weight(t, *postings[t]) for t in order])
+            docs, inverse = np.unique(all_docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=all_scores)
+
+        live = ~seg.deleted[docs]
+        if not live.any():
+            return None
+        return docs[live], scores[live]
+
+# ---------------------------------------------------------------------------- #
+
+def iter_chapters(path: str, start: int=0,
+                end: int=None) -> Iterator[Tuple[str, int, str]]:
+    """
+    (ncode, chapter, text) of a `ChapterSpider` output file, between
+    the gzip members at byte `start` and `end`, with the subtitle as the
+    first line of the text
+    """
+    with open(path, mode='rb') as file:
+        file.seek(start)
+        data = file.read(-1 if end is None else end - start)
+
+    for line in gzip.decompress(data).splitlines():
+        record = json.loads(line)
+        text = f"{record.get('title') or ''}\n{record.get('text') or ''}"
+        yield record['ncode'], record['chapter'], text
+
+def index_chapters(index: SearchIndex, out_dir: str) -> int:
+    """
+    Index the chapters in `out_dir` written since this was last run.
+    Files are read up to their checkpoint, so chapters being written are
+    left for the next run. Returns the number of chapters indexed.
+    """
+    n = 0
+    for name in sorted(os.listdir(out_dir)):
+        if not name.endswith(".jsonl.gz"):
+            continue
+        path = os.path.join(out_dir, name)
+
+        end = os.path.getsize(path)
+        ckpt = path[:-len(".jsonl.gz")] + ".checkpoint.json"
+        if os.path.isfile(ckpt):
+            with open(ckpt, mode='r', encoding='utf8') as file:
+                end = min(end, json.load(file)["offset"])
+
+        start = index.source_offset(name)
+        if end <= start:
+            continue
+
+        n += index.add_many(iter_chapters(path, start, end))
+        index.set_source_offset(name, end)
+    return n
+
+def index_summaries(index: SearchIndex, store_path: str) -> int:
+    """Index the title, summary and keywords of the novels in a `NovelStore`"""
+
+    conn = sqlite3.connect(f"file:{store_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT ncode, title, summary, keywords FROM novels")
+        n = 0
+        for ncode, title, summary, keywords in rows:
+            keywords = json.loads(keywords) if keywords else []
+            text = "\n".join([title or '', summary or '', " ".join(keywords)])
+            index.add(ncode, SUMMARY_CHAPTER, text)
+            n += 1
+    finally:
+        conn.close()
+    return n
+
+# ---------------------------------------------------------------------------- #
+
+def main(argv: List[str]=None) -> None:
+    parser = argparse.ArgumentParser(description="Search chapters and summaries")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('index', help="index new chapters and summaries")
+    build.add_argument('index')
+    build.add_argument('--chapters', help="ChapterSpider output directory")
+    build.add_argument('--store', help="NovelStore database")
+    build.add_argument('--merge', type=int, metavar='N',
+                    help="then merge down to N segments")
+
+    query = commands.add_parser('query', help="search the index")
+    query.add_argument('index')
+    query.add_argument('query')
+    query.add_argument('--top', type=int, default=10)
+    query.add_argument('--any', action='store_true',
+                    help="match documents with any bigram of the query")
+    args = parser.parse_args(argv)
+
+    with SearchIndex(args.index) as index:
+        if args.command == 'index':
+            n = 0
+            if args.store:
+                n += index_summaries(index, args.store)
+            if args.chapters:
+                n += index_chapters(index, args.chapters)
+            index.flush()
+            if args.merge:
+                index.merge(args.merge)
+            print(f"Indexed {n} documents, {len(index)} in {len(index.segments)} segments")
+        else:
+            start = perf_counter()
+            hits = index.search(args.query, args.top, require_all=not args.any)
+            elapsed = perf_counter() - start
+            for ncode, chapter, score in hits:
+                print(f"{score:8.3f}  {ncode}  {chapter}")
+            print(f"{len(hits)} hits in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,340 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""Persistent set of seen novels and chapters, keyed by packed ncode"""
+
+import os
+import mmap
+import math
+import sqlite3
+import logging
+import numpy as np
+import regex as re
+
+from typing import Iterable, Tuple, Union
+
+# ---------------------------------------------------------------------------- #
+
+# novel and chapter pages, e.g. https://ncode.syosetu.com/n6093en/12/
+PAGE_URL_REGEX = r"ncode\.syosetu\.com\/(n\d{4}[a-z]{1,2})\/(?:(\d+)\/?)?$"
+
+_PAGE_URL = re.compile(PAGE_URL_REGEX)
+_NCODE = re.compile(r"n(\d{4})([a-z]{1,2})")
+
+# suffixes 'a'-'z' and 'aa'-'zz' in bijective base 26
+_SUFFIXES = 26 + 26*26 + 1
+
+# bits for the chapter number in a page key
+CHAPTER_BITS = 20
+
+# results of `SeenSet.visit`
+NEW, SEEN, SEEN_BEFORE = 0, 1, 2
+
+_MASK = 2**64 - 1
+
+# ---------------------------------------------------------------------------- #
+
+def pack_ncode(ncode: str) -> int:
+    """Pack an ncode into an int below 2**23, e.g. n0001a -> 704"""
+
+    m = _NCODE.fullmatch(ncode)
+    if m is None:
+        raise ValueError(f"{ncode} is not an ncode.")
+
+    suffix = 0
+    for c in m.group(2):
+        suffix = 26*suffix + ord(c) - 96
+
+    return int(m.group(1)) * _SUFFIXES + suffix
+
+def unpack_ncode(key: int) -> str:
+    num, suffix = divmod(key, _SUFFIXES)
+
+    letters = ''
+    while suffix:
+        suffix, c = divmod(suffix - 1, 26)
+        letters = chr(c + 97) + letters
+
+    return f"n{num:04d}{letters}"
+
+def page_key(url: str) -> Union[Tuple[int, int], None]:
+    """
+    Key of a novel (chapter 0) or chapter page, and its chapter number.
+    None for other URLs.
+    """
+    m = _PAGE_URL.search(url)
+    if m is None:
+        return None
+
+    chapter = 0 if m.group(2) is None else int(m.group(2))
+    if chapter >= 2**CHAPTER_BITS:
+        return None
+
+    return chapter_key(m.group(1), chapter), chapter
+
+def chapter_key(ncode: str, chapter: int) -> int:
+    """Key of a chapter of `ncode`, or of its novel page for chapter 0"""
+    return (pack_ncode(ncode) << CHAPTER_BITS) | chapter
+
+# ---------------------------------------------------------------------------- #
+
+def _mix(x: int) -> int:
+    """splitmix64 finaliser"""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK
+    return x ^ (x >> 31)
+
+def _mix_array(x: np.ndarray) -> np.ndarray:
+    """`_mix` of every element, with uint64 arithmetic wrapping like `_MASK`"""
+
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+class BloomFilter:
+    """
+    Bloom filter of int keys in a memory-mapped bit array
+
+    Bit positions use double hashing of the key's splitmix64 hash. The
+    array is created at `path` if missing, and written back by `flush`
+    and `close`.
+    """
+
+    def __init__(self, path: str, num_bits: int, num_hashes: int) -> None:
+        self.path = path
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+
+        size = (num_bits + 7) // 8
+
+        # a new or resized file is empty, and has to be refilled
+        self.created = not (
+            os.path.isfile(path) and (os.path.getsize(path) == size)
+        )
+        if self.created:
+            with open(path, mode='wb') as file:
+                file.truncate(size)
+
+        # indexing an mmap is much faster than indexing an np.memmap
+        with open(path, mode='r+b') as file:
+            self.mmap = mmap.mmap(file.fileno(), size)
+
+        self.bits = np.frombuffer(self.mmap, dtype=np.uint8)
+
+    @staticmethod
+    def size_for(capacity: int, error_rate: float) -> Tuple[int, int]:
+        """Number of bits and hashes for `capacity` keys at `error_rate`"""
+
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2)**2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return num_bits, num_hashes
+
+    def _positions(self, key: int) -> Iterable[int]:
+        h1 = _mix(key)
+        h2 = _mix(h1) | 1
+        m = self.num_bits
+        return ((h1 + i*h2) % m for i in range(self.num_hashes))
+
+    def add(self, key: int) -> bool:
+        """Add `key`, returning whether it may have been added before"""
+
+        bits = self.mmap
+        found = True
+        for pos in self._positions(key):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                found = False
+
+        return found
+
+    def __contains__(self, key: int) -> bool:
+        bits = self.mmap
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add_many(self, keys: np.ndarray) -> None:
+        """Add an array of keys at once, e.g. to rebuild the filter"""
+
+        h1 = _mix_array(np.asarray(keys, dtype=np.uint64))
+        h2 = _mix_array(h1) | np.uint64(1)
+        m = np.uint64(self.num_bits)
+
+        # (h1 + i*h2) % m as in `_positions`, step by step so that the
+        # sums stay below 2**64
+        pos, h2 = h1 % m, h2 % m
+        for i in range(self.num_hashes):
+            if i:
+                pos = (pos + h2) % m
+            np.bitwise_or.at(
+                self.bits, (pos >> np.uint64(3)).astype(np.int64),
+                (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8))
+            )
+
+    def clear(self) -> None:
+        self.bits[:] = 0
+
+    def flush(self) -> None:
+        self.mmap.flush()
+
+    def close(self) -> None:
+        # the array view has to go before the mmap can be closed
+        self.bits = None
+        self.mmap.close()
+
+# ---------------------------------------------------------------------------- #
+
+class SeenSet:
+    """
+    Keys seen in this and earlier runs, saved at `path`
+
+    An SQLite table is the exact store, with the first and last run each
+    key was seen in. A Bloom filter at `path + '.bloom'` answers most
+    lookups of new keys without touching the table, and keys of the
+    current run are written in batches of `batch_size`. Only the Bloom
+    filter, a few MB for a million keys, is held in memory.
+    """
+
+    def __init__(self, path: str, capacity: int=1_000_000,
+                error_rate: float=1e-3, batch_size: int=1000) -> None:
+
+        self.path = path
+        self.batch_size = batch_size
+        self.capacity = capacity
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen (\n"
+                "key INTEGER PRIMARY KEY,\nfirst_run INTEGER,\nlast_run INTEGER\n)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)"
+            )
+
+        meta = dict(self.conn.execute("SELECT name, value FROM meta"))
+        self.run = int(meta.get('run', 0)) + 1
+
+        num_bits, num_hashes = BloomFilter.size_for(capacity, error_rate)
+        self.bloom = BloomFilter(path + '.bloom', num_bits, num_hashes)
+        self.count = self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+        # the filter is only trusted if it was saved with every stored key
+        if self.bloom.created or (meta.get('bloom_bits') != num_bits) or \
+            (meta.get('bloom_hashes') != num_hashes) or \
+            (meta.get('bloom_count') != self.count):
+            self._rebuild()
+
+        self._set_meta(run=self.run, bloom_count=None)
+
+        # keys of this run not yet written
+        self.pending = set()
+
+    def _set_meta(self, **values) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO meta (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+                list(values.items())
+            )
+
+    def _rebuild(self) -> None:
+        logging.info(f"Rebuilding Bloom filter of {self.count} keys in {self.path}")
+
+        self.bloom.clear()
+        cur = self.conn.execute("SELECT key FROM seen")
+        while True:
+            rows = cur.fetchmany(100_000)
+            if not rows:
+                break
+            self.bloom.add_many(np.fromiter(
+                (r[0] for r in rows), dtype=np.uint64, count=len(rows)
+            ))
+
+        self.bloom.flush()
+        self._set_meta(
+            bloom_bits=self.bloom.num_bits,
+            bloom_hashes=self.bloom.num_hashes
+        )
+
+    def _last_run(self, key: int) -> Union[int, None]:
+        row = self.conn.execute(
+            "SELECT last_run FROM seen WHERE key=?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def visit(self, key: int) -> int:
+        """
+        Mark `key` as seen in this run. Returns `NEW` for a key never
+        seen before, `SEEN` if it was already seen in this run and
+        `SEEN_BEFORE` if it was only seen in earlier runs.
+        """
+
+        if key in self.pending:
+            return SEEN
+
+        if not self.bloom.add(key):
+            status = NEW
+        else:
+            last_run = self._last_run(key)
+            if last_run is None:
+                # false positive
+                status = NEW
+            elif last_run == self.run:
+                return SEEN
+            else:
+                status = SEEN_BEFORE
+
+        if status == NEW:
+            self.count += 1
+            if self.count == self.capacity + 1:
+                logging.warning(
+                    f"{self.path} holds more than {self.capacity} keys, "
+                    f"its false positive rate will rise."
+                )
+
+        self.pending.add(key)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return status
+
+    def __contains__(self, key: int) -> bool:
+        if key in self.pending:
+            return True
+        return (key in self.bloom) and (self._last_run(key) is not None)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        run = self.run
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO seen (key, first_run, last_run) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET last_run=excluded.last_run",
+                [(key, run, run) for key in self.pending]
+            )
+        self.pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.bloom.flush()
+        self.bloom.close()
+        self._set_meta(bloom_count=self.count)
+        self.conn.close()
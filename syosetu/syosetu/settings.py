@@ -19,6 +19,10 @@ NEWSPIDER_MODULE = 'syosetu.spiders'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
+# Parser for search result boxes: 'selector' runs Scrapy selector queries,
+# 'lxml' walks each box's element tree once. Both give the same items.
+SYOSETU_BOX_PARSER = 'lxml'
+
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 #CONCURRENT_REQUESTS = 32
 
@@ -44,27 +48,139 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    'syosetu.middlewares.SyosetuSpiderMiddleware': 543,
-#}
+    'syosetu.middlewares.FrontierMiddleware': 10,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'syosetu.middlewares.SyosetuDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'syosetu.middlewares.FrontierMiddleware': 40,
+    'syosetu.middlewares.ArchiveRecorderMiddleware': 890,
+    'syosetu.middlewares.SyosetuDownloaderMiddleware': 900,
+    'syosetu.middlewares.AdaptiveConcurrencyMiddleware': 950,
+}
+
+# AIMD control of per-host concurrency and delay by AdaptiveConcurrencyMiddleware.
+# Concurrency grows by one per window of responses faster than
+# ADAPTIVE_TARGET_LATENCY (seconds), and halves on 429/503, errors or slow
+# responses, while the delay doubles. Replaces AutoThrottle for the hosts
+# in NovelSpider.allowed_domains.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_TARGET_LATENCY = 1.0
+ADAPTIVE_START_CONCURRENCY = 2
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 16
+ADAPTIVE_MAX_DELAY = 30.0
+
+# Conditional-request cache of SyosetuDownloaderMiddleware. Pages are served
+# from SYOSETU_CACHE_DIR without revalidation for the lifetime (in seconds)
+# of the first matching URL pattern, and revalidated with ETag or
+# Last-Modified afterwards.
+SYOSETU_CACHE_ENABLED = True
+SYOSETU_CACHE_DIR = 'httpcache'
+SYOSETU_CACHE_POLICY = [
+    # search results
+    (r"yomou\.syosetu\.com/search", 15 * 60),
+    # chapters
+    (r"ncode\.syosetu\.com/n\d{4}[a-z]{2}/\d+/?$", 30 * 24 * 3600),
+    # novel index pages
+    (r"ncode\.syosetu\.com/n\d{4}[a-z]{2}/?$", 6 * 3600),
+]
+
+# With ARCHIVE_RECORD_PATH set, ArchiveRecorderMiddleware writes every response
+# to that gzipped WARC file. An archive is replayed offline, e.g. for
+# benchmarks, with `python -m syosetu.archive <archive> <spider>`, or by
+# setting ARCHIVE_REPLAY_PATH and DOWNLOAD_HANDLERS as in
+# syosetu.archive.replay_settings.
+ARCHIVE_RECORD_PATH = None
+
+# Dupefilter that remembers novel and chapter pages across runs in a SQLite
+# seen-set behind a Bloom filter sized for SEEN_SET_CAPACITY pages at
+# SEEN_SET_ERROR_RATE (about 1.8 MB for a million). With
+# SEEN_SET_SKIP_CHAPTERS, chapters written by ChapterSpider in an earlier
+# run are not requested again.
+DUPEFILTER_CLASS = 'syosetu.dupefilters.SeenSetDupeFilter'
+SEEN_SET_PATH = 'seen.db'
+SEEN_SET_CAPACITY = 1000000
+SEEN_SET_ERROR_RATE = 0.001
+SEEN_SET_SKIP_CHAPTERS = True
+
+# Crawl with several worker processes sharing one SQLite frontier, e.g.
+# `python -m syosetu.frontier crawl novels --workers 4`. Workers lease
+# FRONTIER_BATCH_SIZE requests at a time for FRONTIER_LEASE_SECONDS, and
+# requests whose lease runs out are queued again up to FRONTIER_MAX_ATTEMPTS
+# times. FrontierMiddleware is only enabled with SCHEDULER set to
+# syosetu.frontier.FrontierScheduler.
+FRONTIER_PATH = 'frontier.db'
+FRONTIER_BATCH_SIZE = 16
+FRONTIER_LEASE_SECONDS = 120
+FRONTIER_MAX_ATTEMPTS = 3
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'syosetu.extensions.ProfilingExtension': 500,
+}
+
+# ProfilingExtension times spider callbacks, item pipelines and the functions
+# in PROFILING_FUNCTIONS, and adds count, total and p50/p95/p99 of each to the
+# stats under profile/. PROFILING_SAMPLE_RATE of calls also run under cProfile
+# (and tracemalloc with PROFILING_TRACEMALLOC). PROFILING_REPORT is written at
+# close, as Prometheus text for a .prom path and as JSON otherwise.
+PROFILING_ENABLED = False
+PROFILING_REPORT = 'profile.json'
+PROFILING_SAMPLE_RATE = 0.01
+PROFILING_TRACEMALLOC = False
+PROFILING_FUNCTIONS = [
+    'syosetu.spiders.novels_spider.FindNovelMetrics.scan',
+    'syosetu.spiders.novels_spider.NovelSpider._parse_box',
+    'syosetu.spiders.novels_spider.NovelSpider._parse_box_lxml',
+    'syosetu.spiders.novels_spider._find_update_date',
+]
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
+ITEM_PIPELINES = {
 #    'syosetu.pipelines.SyosetuPipeline': 300,
-#}
+    'syosetu.pipelines.NearDuplicatePipeline': 600,
+    'syosetu.pipelines.SqlitePipeline': 700,
+    'syosetu.pipelines.ParquetPipeline': 800,
+    'syosetu.pipelines.TimeSeriesPipeline': 850,
+}
+
+# SQLite store of novels, upserted by ncode in batches of SQLITE_BATCH_SIZE.
+# With SYOSETU_SKIP_UNCHANGED, novel pages are not requested again when the
+# update time on the search page is the same as in the store.
+SQLITE_PATH = 'novels.db'
+SQLITE_BATCH_SIZE = 500
+SYOSETU_SKIP_UNCHANGED = True
+
+# Metric history across crawls (see syosetu/timeseries.py): points, bookmarks,
+# weekly users, ratings and period scores that changed since the last crawl are
+# appended to TIMESERIES_PATH, in batches of TIMESERIES_BATCH_SIZE items.
+# Disabled unless set, e.g. `-s TIMESERIES_PATH=metrics.db` on nightly crawls.
+TIMESERIES_PATH = None
+TIMESERIES_BATCH_SIZE = 5000
+
+# Near-duplicate summaries (see syosetu/dedup.py): novels whose summary has an
+# estimated Jaccard similarity of at least DEDUP_THRESHOLD, over shingles of
+# DEDUP_SHINGLE_SIZE characters, to an earlier novel's in the crawl get the
+# ncodes of those novels in `near_duplicates`, with DEDUP_NUM_PERM hashes per
+# summary. Disabled unless set, e.g. `-s DEDUP_THRESHOLD=0.8`. Stored summaries
+# and chapters can be compared with `python -m syosetu.dedup` instead.
+DEDUP_THRESHOLD = None
+DEDUP_NUM_PERM = 128
+DEDUP_SHINGLE_SIZE = 5
+
+# Output of ParquetPipeline: one file per crawl, flushed in row groups of at
+# most PARQUET_ROW_GROUP_ROWS items or about PARQUET_ROW_GROUP_BYTES bytes
+PARQUET_DIR = 'output'
+PARQUET_ROW_GROUP_ROWS = 10000
+PARQUET_ROW_GROUP_BYTES = 32 * 2**20
+PARQUET_COMPRESSION = 'zstd'
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,4 +1,339 @@
 # Copyright (c) 2022 Delbert Yip
-# 
+#
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
+
+import os
+import json
+import gzip
+from typing import List, Dict, Union, Iterator, Tuple
+
+import scrapy
+import regex as re
+from scrapy import signals
+
+from syosetu.spiders.novels_spider import get_ncode
+
+# ---------------------------------------------------------------------------- #
+
+NOVEL_URL = "https://ncode.syosetu.com/%s/"
+
+CHAPTER_URL_REGEX = r"\/(n[\d]{4}[a-z]{2})\/(\d+)\/$"
+
+# chapter page markup, before and after the 2023 redesign
+SUBTITLE_XPATH = (
+    "//p[@class='novel_subtitle'] | "
+    "//h1[contains(concat(' ', @class, ' '), ' p-novel__title ')]"
+)
+BODY_LINES_XPATH = (
+    "//div[@id='novel_honbun']/p | "
+    "//div[contains(concat(' ', @class, ' '), ' p-novel__text ') and "
+    "not(contains(concat(' ', @class, ' '), ' p-novel__text--preface ')) and "
+    "not(contains(concat(' ', @class, ' '), ' p-novel__text--afterword '))]/p"
+)
+
+_CHAPTER_URL = re.compile(CHAPTER_URL_REGEX)
+
+# sent with `ncode` and `chapter` once a chapter is written and checkpointed
+chapter_written = object()
+
+# ---------------------------------------------------------------------------- #
+
+def _line_text(p) -> str:
+    """
+    Text of a body line, with ruby written as `|base《reading》` as in
+    syosetu's own input format
+    """
+    out = [] if p.text is None else [p.text]
+
+    for child in p:
+        if child.tag == 'ruby':
+            base = ''.join(child.xpath("./text() | ./rb//text()"))
+            reading = ''.join(child.xpath("./rt//text()"))
+            out.append(f"|{base}《{reading}》")
+        elif isinstance(child.tag, str):
+            out.append(''.join(child.itertext()))
+
+        if child.tail is not None:
+            out.append(child.tail)
+
+    return ''.join(out)
+
+def parse_chapter_text(response) -> Dict[str, str]:
+    """Subtitle and body of a chapter page"""
+
+    title = response.xpath(f"normalize-space(({SUBTITLE_XPATH})[1])").get()
+    lines = [_line_text(p.root) for p in response.xpath(BODY_LINES_XPATH)]
+    return {"title" : title, "text" : "\n".join(lines)}
+
+
+class _NovelState:
+    """Chapters of one novel that are still to be fetched or written"""
+
+    __slots__ = (
+        'ncode', 'toc', 'queue', 'buffer', 'requested', 'last', 'missing'
+    )
+
+    def __init__(self, ncode: str, last: int, missing: List[int]=()) -> None:
+        self.ncode = ncode
+        # chapter numbers found in the table of contents
+        self.toc = set()
+        # chapters in write order, not yet requested
+        self.queue = []
+        # fetched chapters waiting for the chapters before them
+        self.buffer = dict()
+        # requested and not yet written, in write order
+        self.requested = []
+        # last chapter written
+        self.last = last
+        # chapters before `last` that failed or were dropped
+        self.missing = set(missing)
+
+# ---------------------------------------------------------------------------- #
+
+class ChapterSpider(scrapy.Spider):
+    """
+    Stream the chapters of novels into `<out_dir>/<ncode>.jsonl.gz`
+
+    Each novel's table of contents is walked from its index page. At
+    most `window` chapters per novel are in flight, and chapters are
+    appended in order, one gzip member per chapter, as soon as all
+    earlier chapters are written. So memory does not depend on the
+    length of a novel.
+
+    After every chapter, `<ncode>.checkpoint.json` records the last
+    chapter and the file size, and `chapter_written` is sent. A restarted
+    crawl truncates any partly written chapter and only requests the
+    chapters after the checkpoint. Chapters that fail, or that the
+    scheduler drops, are skipped and kept in the checkpoint as `missing`.
+    A restarted crawl requests them again, so they may be written after
+    later chapters.
+
+    ## Arguments
+    `ncodes` = comma-separated ncodes or novel URLs
+    `ncode_file` = file with one ncode or novel URL per line
+    `out_dir` = where chapters and checkpoints are written
+    `window` = chapters in flight per novel
+    """
+    name = 'chapters'
+    allowed_domains = ['ncode.syosetu.com']
+
+    def __init__(self, ncodes: Union[str, List[str]]=None,
+                ncode_file: str=None, out_dir: str="chapters",
+                window: int=4, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        if isinstance(ncodes, str):
+            ncodes = ncodes.split(',')
+        ncodes = list(ncodes or [])
+
+        if ncode_file is not None:
+            with open(ncode_file, mode='r', encoding='utf8') as file:
+                ncodes.extend(line for line in file)
+
+        self.ncodes = []
+        for code in ncodes:
+            code = code.strip()
+            if not code:
+                continue
+
+            ncode = get_ncode(code if code.endswith('/') else code + '/')
+            ncode = code if (ncode is None) else ncode
+            if ncode not in self.ncodes:
+                self.ncodes.append(ncode)
+
+        self.out_dir = out_dir
+        self.window = max(int(window), 1)
+        self.novels: Dict[str, _NovelState] = dict()
+
+        os.makedirs(out_dir, exist_ok=True)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(
+            spider.chapter_dropped, signal=signals.request_dropped
+        )
+        return spider
+
+    # ------------------------------------------------------------------------ #
+
+    def _path(self, ncode: str) -> str:
+        return os.path.join(self.out_dir, f"{ncode}.jsonl.gz")
+
+    def _checkpoint_path(self, ncode: str) -> str:
+        return os.path.join(self.out_dir, f"{ncode}.checkpoint.json")
+
+    def load_checkpoint(self, ncode: str) -> Tuple[int, List[int]]:
+        """
+        Last chapter written for `ncode`, and the chapters skipped before
+        it. Anything written after it, e.g. by an interrupted write, is
+        truncated.
+        """
+        path = self._checkpoint_path(ncode)
+
+        if os.path.isfile(path):
+            with open(path, mode='r', encoding='utf8') as file:
+                ckpt = json.load(file)
+        else:
+            ckpt = {"chapter" : 0, "offset" : 0}
+
+        out = self._path(ncode)
+        if os.path.isfile(out) and os.path.getsize(out) > ckpt["offset"]:
+            with open(out, mode='r+b') as file:
+                file.truncate(ckpt["offset"])
+
+        return ckpt["chapter"], ckpt.get("missing", [])
+
+    def _save_checkpoint(self, state: _NovelState, offset: int) -> None:
+        path = self._checkpoint_path(state.ncode)
+
+        with open(path + ".tmp", mode='w', encoding='utf8') as file:
+            json.dump({
+                "ncode" : state.ncode, "chapter" : state.last,
+                "offset" : offset, "toc" : len(state.toc),
+                "missing" : sorted(state.missing)
+            }, file)
+
+        os.replace(path + ".tmp", path)
+
+    def _write(self, state: _NovelState, num: int,
+                chapter: Union[Dict[str, str], None]) -> None:
+        """Append `chapter` and move the checkpoint past it"""
+
+        out = self._path(state.ncode)
+
+        # missing chapters are skipped, and checkpointed for a retry
+        if chapter is None:
+            state.missing.add(num)
+        else:
+            state.missing.discard(num)
+            record = dict(ncode=state.ncode, chapter=num, **chapter)
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+
+            with gzip.open(out, mode='ab') as file:
+                file.write(line.encode('utf8'))
+
+            self.crawler.stats.inc_value('chapters/written')
+
+        # retried chapters come before the last one
+        state.last = max(state.last, num)
+        offset = os.path.getsize(out) if os.path.isfile(out) else 0
+        self._save_checkpoint(state, offset)
+
+        if chapter is not None:
+            self.crawler.signals.send_catch_log(
+                chapter_written, ncode=state.ncode, chapter=num
+            )
+
+    # ------------------------------------------------------------------------ #
+
+    async def start(self):
+        # Scrapy 2.13+ no longer falls back to `start_requests`
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+
+        for ncode in self.ncodes:
+            self.novels[ncode] = _NovelState(ncode, *self.load_checkpoint(ncode))
+
+            yield scrapy.Request(
+                NOVEL_URL % ncode, callback=self.parse_index,
+                cb_kwargs=dict(ncode=ncode)
+            )
+
+    def parse_index(self, response, ncode: str):
+        """Collect chapter numbers, following index pages if paginated"""
+
+        state = self.novels[ncode]
+
+        for href in response.xpath("//a/@href").getall():
+            m = _CHAPTER_URL.search(response.urljoin(href))
+            if (m is not None) and (m.group(1) == ncode):
+                state.toc.add(int(m.group(2)))
+
+        next_page = response.xpath(
+            "//a[contains(concat(' ', @class, ' '), ' c-pager__item--next ')]"
+            "/@href"
+        ).get()
+        if next_page is not None:
+            yield response.follow(
+                next_page, callback=self.parse_index,
+                cb_kwargs=dict(ncode=ncode)
+            )
+            return
+
+        if not state.toc and response.xpath(BODY_LINES_XPATH):
+            # short stories have their text on the index page
+            if state.last < 1:
+                self._write(state, 1, parse_chapter_text(response))
+            return
+
+        # chapters no longer in the table of contents are not retried
+        state.missing &= state.toc
+        state.queue = sorted(
+            n for n in state.toc if (n > state.last) or (n in state.missing)
+        )
+        self.logger.info(
+            f"{ncode}: {len(state.toc)} chapters, {len(state.queue)} to fetch"
+        )
+
+        yield from self._fill_window(state)
+
+    def _fill_window(self, state: _NovelState) -> Iterator[scrapy.Request]:
+
+        while state.queue and (len(state.requested) < self.window):
+            num = state.queue.pop(0)
+            state.requested.append(num)
+
+            yield scrapy.Request(
+                f"{NOVEL_URL % state.ncode}{num}/",
+                callback=self.parse_chapter, errback=self.chapter_failed,
+                cb_kwargs=dict(ncode=state.ncode, num=num)
+            )
+
+    def _flush(self, state: _NovelState) -> Iterator[scrapy.Request]:
+        """Write buffered chapters in order, then request more"""
+
+        while state.requested and (state.requested[0] in state.buffer):
+            num = state.requested.pop(0)
+            self._write(state, num, state.buffer.pop(num))
+
+        yield from self._fill_window(state)
+
+    def parse_chapter(self, response, ncode: str, num: int):
+        state = self.novels[ncode]
+        state.buffer[num] = parse_chapter_text(response)
+        yield from self._flush(state)
+
+    def chapter_failed(self, failure):
+        kwargs = failure.request.cb_kwargs
+        state = self.novels[kwargs['ncode']]
+
+        self.logger.warning(
+            f"Skipping chapter {kwargs['num']} of {state.ncode}: {failure.value}"
+        )
+        self.crawler.stats.inc_value('chapters/failed')
+
+        state.buffer[kwargs['num']] = None
+        yield from self._flush(state)
+
+    def chapter_dropped(self, request, spider=None):
+        """
+        A chapter the scheduler did not take, e.g. because the dupefilter
+        has it as written in an earlier run. It leaves the window, so the
+        chapters after it are still written and requested.
+        """
+        kwargs = request.cb_kwargs
+        state = self.novels.get(kwargs.get('ncode'))
+        if (state is None) or (kwargs.get('num') not in state.requested):
+            return
+
+        self.logger.info(f"Skipping dropped chapter {kwargs['num']} of {state.ncode}")
+        self.crawler.stats.inc_value('chapters/dropped')
+
+        state.buffer[kwargs['num']] = None
+        for req in self._flush(state):
+            self.crawler.engine.crawl(req)
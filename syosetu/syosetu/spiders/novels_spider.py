@@ -6,36 +6,87 @@
 # https://opensource.org/licenses/MIT
 
 import scrapy 
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.spiders import CrawlSpider
 from scrapy.spiders import Rule 
 from scrapy.linkextractors import LinkExtractor
 
 from datetime import datetime 
-from typing import Callable, List, Dict, Union, Tuple, Any
+from typing import Callable, List, Dict, Union, Tuple, Any, Iterable, Iterator
 
+import time 
 import logging
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree 
 from scrapy.utils.trackref import NoneType 
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.misc import load_object
 import validators
 
 import regex as re 
 
+from syosetu.store import NovelStore
+from syosetu.frontier import FrontierScheduler
+
 # ---------------------------------------------------------------------------- #
 
 SEARCH_RESULTS_XPATH = r"//div[@id='main_search'][1]/div[@class='searchkekka_box'][1]"
 
+# novel index pages, e.g. https://ncode.syosetu.com/n6093en/
+NCODE_URL_REGEX = r"\/(n[\d]{4}[a-z]{2})\/$"
+
+# results per search page, used to turn positions into ranks 
+SEARCH_PAGE_SIZE = 20
+
+# lxml equivalent of `response.css("div.searchkekka_box")`
+SEARCH_BOXES_XPATH = etree.XPath(
+    "descendant-or-self::div[@class and contains("
+    "concat(' ', normalize-space(@class), ' '), ' searchkekka_box ')]"
+)
+
+# novel link of a search result box 
+BOX_LINK_XPATH = "./div[@class='novel_h']/a[@class='tl']/@href"
+_BOX_LINK = etree.XPath(BOX_LINK_XPATH)
+
 JAPANESE_SCRIPT_REGEX = "\p{Han}\p{Katakana}\p{Hiragana}"
 
 REMOVE_PUNCT_REGEX = re.compile(
     f"[^{JAPANESE_SCRIPT_REGEX}\s\n\w\d]*"
 )
+
+NON_DIGIT_REGEX = re.compile("\D+")
+
+_NCODE_URL = re.compile(NCODE_URL_REGEX)
+
+# `Novel` fields that are read from the search result metrics table 
+NOVEL_METRIC_FIELDS = (
+    'word_cnt', 'post_cnt', 'weekly_unique_cnt', 'bookmark_cnt', 
+    'review_cnt', 'hyouka_cnt', 'hyouka_pnt', 'global_pnt'
+)
+
+# ranking periods of the `<period>間pt` scores, e.g. 年間pt 
+RANK_PERIODS = {'日' : 'daily', '週' : 'weekly', '月' : 'monthly', '年' : 'yearly'}
     
 # ---------------------------------------------------------------------------- #
 
 def to_int(number: str) -> int:
-    return int( re.sub("\D*", '', number) )
+    return int( NON_DIGIT_REGEX.sub('', number) )
+
+def period_points(rank: List[Tuple[str, int]]) -> Dict[str, int]:
+    """Scores of `FindNovelMetrics` 'rank' by period name"""
+    return {RANK_PERIODS.get(period, period) : pnt for period, pnt in rank}
+
+def get_ncode(url: str) -> Union[str, NoneType]:
+    """Novel code in a novel index URL"""
+    m = _NCODE_URL.search(url)
+    return None if m is None else m.group(1)
 
 class Novel(scrapy.Item):
     """Novel information"""
+    ncode: str = scrapy.Field()
     title: str = scrapy.Field()
     author: str = scrapy.Field()
     genre: str = scrapy.Field()
@@ -51,6 +102,50 @@ class Novel(scrapy.Item):
     global_pnt: int = scrapy.Field()
     url: str = scrapy.Field()
     keywords: List[str] = scrapy.Field()
+    # rank of the novel in each search order it was found under
+    rankings: Dict[str, int] = scrapy.Field()
+    # points in each ranking period shown, e.g. {'yearly' : 344938}
+    period_pnts: Dict[str, int] = scrapy.Field()
+    # ncodes of earlier novels with a near-identical summary, set by
+    # `NearDuplicatePipeline`
+    near_duplicates: List[str] = scrapy.Field()
+
+def _digits_to_int(number: str) -> int:
+    """`to_int` of a `[\d,]*` match, which only needs its commas removed"""
+    return int(number.replace(',', ''))
+
+def _compile_metric_scanner(
+    patterns: Dict[str, Any], metrics: Dict[str, List[tuple]]
+) -> Tuple[re.Pattern, Dict[str, Tuple[re.Pattern, str]], Dict[str, str]]:
+    """
+    Build a single alternation that visits every metric in one pass
+
+    Every alternative starts with a literal so that the scan can skip
+    ahead between metrics; leading numbers and rank periods are read
+    back with lookbehinds instead. Fixed-format metrics (word/post
+    counts, rank, date and the `numbers`) are captured directly by the
+    scanner, the `numbers` in a lookahead so that a label without a
+    value does not consume the next one. Labels of the `words` only
+    mark where a value starts, because e.g. the genre value runs over
+    the keyword label. Their values are matched in place with the
+    returned anchored patterns.
+    """
+    anchored = {}
+    for jp, eng in metrics['words']:
+        anchored[jp[0]] = (re.compile(patterns['words'] % jp), eng)
+
+    numbers = {jp : eng for jp, eng in metrics['numbers']}
+
+    scanner = re.compile("|".join([
+        r"(?<=(?P<word_cnt>[\d,]+))文字",
+        r"\(全(?P<post_cnt>\d*)部分\)",
+        r"(?<=(?P<period>\p{Han}{1,2}))間pt[\s\D\W]{1,5}(?P<score>[\d,]*)pt",
+        r"最終更新日[\s\D\W](?P<date>\d{4}\/\d{2}\/\d{2}\s\d{2}:\d{2})",
+        r"(?P<number>%s)(?=[\s\D\W]{1,5}(?P<value>[\d,]*))" % "|".join(numbers),
+        "(?P<label>%s)" % "|".join(anchored),
+    ]))
+
+    return scanner, anchored, numbers
 
 class FindNovelMetrics:
     patterns = {
@@ -79,12 +174,15 @@ class FindNovelMetrics:
                     ("評価ポイント", "hyouka_pnt")],
     }
     
+    scanner, anchored, numbered = _compile_metric_scanner(patterns, metrics)
+
     ERR_MSG = "Could not extract data for metric < {m} >\n{e}"
-    
-    data: Dict[str, Union[str, int, List[str]]] = dict()
+
+    data: Dict[str, Union[str, int, List[str]]]
     
     def __init__(self, text: str) -> None:
         self.text = text
+        self.data = dict()
         # self.logger = logger 
 
     @staticmethod
@@ -126,10 +224,114 @@ class FindNovelMetrics:
         
         return data 
     
+    @classmethod
+    def scan(cls, text: str) -> Dict[str, Any]:
+        """Extract every metric from `text` in a single pass of `scanner`"""
+        
+        word_cnt = post_cnt = date = None 
+        rank = [] 
+        found = {eng: [] for eng in cls.numbered.values()}
+        found.update((eng, []) for _, eng in cls.anchored.values())
+        
+        for m in cls.scanner.finditer(text):
+            kind = m.lastgroup
+            
+            if kind == 'value':
+                found[cls.numbered[m.group('number')]].append(m.group('value'))
+            elif kind == 'label':
+                pattern, eng = cls.anchored[m.group('label')]
+                res = pattern.match(text, m.start())
+                if res is not None:
+                    found[eng].append(res.group(1))
+            elif kind == 'score':
+                rank.append((m.group('period'), _digits_to_int(m.group('score'))))
+            elif kind == 'word_cnt':
+                word_cnt = word_cnt or m.group('word_cnt')
+            elif kind == 'post_cnt':
+                post_cnt = m.group('post_cnt') if post_cnt is None else post_cnt
+            elif date is None:
+                date = m.group('date')
+        
+        data = dict()
+        for name, num in (('word_cnt', word_cnt), ('post_cnt', post_cnt)):
+            if num is None:
+                logging.error(cls.ERR_MSG.format(m=name, e="no match"))
+                data[name] = None
+            else:
+                data[name] = to_int(num)
+        
+        data['rank'] = rank
+        
+        # the same key as `_findPerMetric` when there is no date
+        if date is None:
+            logging.error(cls.ERR_MSG.format(m='dates', e="no match"))
+            data['dates'] = None
+        else:
+            # fixed `%Y/%m/%d %H:%M` layout, so skip `strptime` 
+            data['most_recent_update'] = datetime(
+                int(date[:4]), int(date[5:7]), int(date[8:10]), 
+                int(date[11:13]), int(date[14:16])
+            )
+        
+        for _, eng in cls.metrics['words']:
+            data[eng] = cls._filterSearchByType(found[eng])
+        for _, eng in cls.metrics['numbers']:
+            data[eng] = cls._filterSearchByType(
+                found[eng], serializer=_digits_to_int
+            )
+        
+        return data 
+    
     def find(self) -> None:
+        self.data.update(self.scan(self.text))
+    
+    @classmethod
+    def find_many(
+        cls, texts: Iterable[str], workers: int=1, chunksize: int=256
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield `scan` results for `texts` in input order
+        
+        With `workers > 1`, `texts` are streamed to a process pool in 
+        chunks of `chunksize`. At most two chunks per worker are in 
+        flight, so arbitrarily long iterables are never held in memory.
+        Throughput is logged once all texts have been processed.
+        """
+        start = time.perf_counter()
+        cnt = 0 
+        
+        if workers <= 1:
+            for text in texts:
+                cnt += 1 
+                yield cls.scan(text)
+        else:
+            texts = iter(texts)
+            pending = deque()
+            
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                while True:
+                    while len(pending) < 2*workers:
+                        chunk = list(islice(texts, chunksize))
+                        if not chunk: break 
+                        pending.append(pool.submit(_scan_chunk, chunk))
+                    
+                    if not pending: break 
+                    
+                    for data in pending.popleft().result():
+                        cnt += 1 
+                        yield data 
+        
+        elapsed = time.perf_counter() - start 
+        logging.info(
+            f"Extracted metrics from {cnt} texts in {elapsed:.2f} s "
+            f"({cnt / max(elapsed, 1e-9):.0f} texts/s, {workers} workers)"
+        )
+    
+    def _findPerMetric(self) -> Dict[str, Any]:
+        """Reference extraction that runs one regex search per metric"""
         
         T = self.text 
-        data = self.data 
+        data = dict() 
         
         for name in ['word_cnt', 'post_cnt']:
             num = self.patterns[name].search(T).group(1)
@@ -170,7 +372,7 @@ class FindNovelMetrics:
             # 'words' and 'numbers' 
             data = self._findContextSpecific(data, group, names)
                             
-        return 
+        return data 
     
     def replace_data(self, new_text: str) -> None:
         self.text = new_text 
@@ -184,6 +386,11 @@ class FindNovelMetrics:
         return "\n".join(output)
 
 
+def _scan_chunk(texts: List[str]) -> List[Dict[str, Any]]:
+    """Process pool task for `FindNovelMetrics.find_many`"""
+    return [FindNovelMetrics.scan(text) for text in texts]
+
+
 def get_search_order(order: str) -> str:
     """
     Return `yomou.syosetu` search page ordered by `order`
@@ -205,50 +412,231 @@ def get_search_order(order: str) -> str:
     `quarterpoint` = per quarter
     `yearlypoint` = per year 
     """
-    return f"https://yomou.syosetu.com/search.php?&order_former=search&order={order}&notnizi=1&p=%d"
+    return f"https://yomou.syosetu.com/search.php?order_former=search&order={order}&notnizi=1&p=%d"
+
+
+def _direct_text(el: etree._Element) -> List[str]:
+    """Text nodes that are children of `el`, i.e. `el.xpath('./text()')`"""
+    texts = [] if el.text is None else [el.text]
+    texts.extend(child.tail for child in el if child.tail is not None)
+    return texts 
 
+def _find_update_date(texts: List[str]) -> datetime.date:
+    """Most recent update, given the texts that follow the status cell"""
+    date = ''.join(''.join(a.strip() for a in texts).split())
+    date = re.search("最終更新日.(.*)週", date).group(1)
+    return datetime.strptime(date, "%Y/%m/%d%H:%M") 
 
 def format_novel_metric_string(txt: List[str]) -> str:
     out = re.sub('[\n\s]*', '', ''.join(txt))
     return out 
     
+class _SearchStream:
+    """Pagination state of one search order"""
+    
+    __slots__ = ('order', 'url', 'next_page', 'in_flight', 'done')
+    
+    def __init__(self, order: str, url: str) -> None:
+        self.order = order 
+        self.url = url 
+        self.next_page = 1 
+        self.in_flight = 0 
+        self.done = False 
+
+
 class NovelSpider(CrawlSpider):
     name = 'novels'    
-    allowed_domains = ['yomou.syosetu.com/', 
-                    'ncode.syosetu.com/']
+    allowed_domains = ['yomou.syosetu.com', 
+                    'ncode.syosetu.com']
     
     rules = (
         # novel 
-        Rule(LinkExtractor(allow=(r"\/(n[\d]{4}[a-z]{2})\/$",),), callback='parse'),
+        Rule(LinkExtractor(allow=(NCODE_URL_REGEX,),), callback='parse_novel',
+            process_request='_filter_novel_request'),
     )
     
+    # how each search result box is parsed, see `parse`
+    box_parsers = {'selector' : '_parse_box', 'lxml' : '_parse_box_lxml'}
+    box_parser = 'selector'
+    
+    # `NovelStore` of the previous runs, used to skip unchanged novels 
+    store = None 
+    
+    # whether search pages come from a frontier shared with other workers 
+    shared_frontier = False 
+    
     def __init__(self, max_novel_cnt: int=20, max_page_cnt: int=10,
                 order: Union[str, List[str]]="favnovelcnt", 
-                *args, **kwargs
+                prefetch: int=2, *args, **kwargs
         ):
+        """
+        Search pages of each order in `order`, a list or a comma-separated
+        string, are requested one after another, with at most `prefetch`
+        in flight per order. An order stops when its page has no results
+        or after `max_page_cnt` pages, and all orders stop once 
+        `max_novel_cnt` unique novels are found. A count of 0 or less 
+        means no limit.
+        """
         
         super().__init__(*args, **kwargs)
         
-        self.max_novel_cnt = max_novel_cnt
-        self.get_start_URLs(order, max_page_cnt)
+        # spider arguments from the command line are strings 
+        self.max_novel_cnt = int(max_novel_cnt)
+        self.max_page_cnt = int(max_page_cnt)
+        self.prefetch = max(int(prefetch), 1)
+        
+        # ncode -> {order: rank}, shared by all orders 
+        self.rankings: Dict[str, Dict[str, int]] = dict()
+        
+        # ncodes of accepted novels, see `parse_start_url`
+        self.emitted = set()
+        
+        # novels held until every order is done, see `parse_start_url`
+        self.pending: List[Novel] = [] 
+        
+        # ncodes whose novel page was requested 
+        self.followed = set()
+        
+        self.get_start_URLs(order, self.max_page_cnt)
         self.finder = FindNovelMetrics('')
+        
+        # ncodes on parsed search pages whose update time is unchanged 
+        self.unchanged = set()
+        
+        if self.box_parser not in self.box_parsers:
+            raise ValueError(f"Unknown box parser {self.box_parser}.")
     
-    def get_start_URLs(self, order: str, max_page_cnt: int):
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        
+        if 'box_parser' not in kwargs:
+            kwargs['box_parser'] = crawler.settings.get(
+                'SYOSETU_BOX_PARSER', cls.box_parser
+            )
+        
+        spider = super().from_crawler(crawler, *args, **kwargs)
         
-        first_page = get_search_order(order=order)
+        path = crawler.settings.get('SQLITE_PATH')
+        if path and crawler.settings.getbool('SYOSETU_SKIP_UNCHANGED'):
+            spider.store = NovelStore(path)
+            crawler.signals.connect(
+                spider.store.close, signal=signals.spider_closed
+            )
+        
+        crawler.signals.connect(
+            spider._page_dropped, signal=signals.request_dropped
+        )
+        crawler.signals.connect(spider._spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(
+            spider._spider_closed, signal=signals.spider_closed
+        )
+        
+        # other workers of a distributed crawl parse search pages too, 
+        # so the counts in `streams` cannot tell when the search is done.
+        # `issubclass` would match any scheduler, see `BaseSchedulerMeta`
+        scheduler = load_object(crawler.settings.get('SCHEDULER'))
+        spider.shared_frontier = FrontierScheduler in scheduler.__mro__
+        return spider
+    
+    def get_start_URLs(self, order: Union[str, List[str]], max_page_cnt: int):
+        """
+        Set up one search stream per order. Only the first `prefetch` 
+        pages of each are start URLs, the others are requested as pages
+        are parsed.
+        """
         
-        if not validators.url(first_page):
-            raise ValueError(f"{first_page} is an invalid URL.")
+        orders = order.split(',') if isinstance(order, str) else order 
+        orders = [o.strip() for o in orders if o.strip()]
+        
+        if not orders:
+            raise ValueError("No search order given.")
+        
+        self.streams: Dict[str, _SearchStream] = dict()
+        for order in orders:
+            first_page = get_search_order(order=order)
+            
+            if not validators.url(first_page % 1):
+                raise ValueError(f"{first_page} is an invalid URL.")
+            
+            self.streams[order] = _SearchStream(order, first_page)
+        
+        num_start = self.prefetch
+        if max_page_cnt > 0:
+            num_start = min(num_start, max_page_cnt)
         
         self.start_urls = [
-            first_page % d for d in range(1, max_page_cnt+1)
+            first_page % d for first_page in 
+            (stream.url for stream in self.streams.values())
+            for d in range(1, num_start+1)
         ]
-        
-        if not validators.url(self.start_urls[0]):
-            raise ValueError(f"Search page URLs are invalid. Tested\n{self.start_urls[0]}")
+    
+    @property
+    def pages_done(self) -> bool:
+        return all(stream.done for stream in self.streams.values())
     
     def start_requests(self):
-        return super().start_requests()
+        return self._request_pages()
+    
+    async def start(self):
+        # Scrapy 2.13+ no longer falls back to `start_requests`
+        for request in self.start_requests():
+            yield request
+    
+    def _request_pages(self) -> Iterator[scrapy.Request]:
+        """Request search pages until `prefetch` are in flight per order"""
+        
+        if self.quota_reached():
+            for stream in self.streams.values():
+                stream.done = True 
+        
+        for stream in self.streams.values():
+            
+            while (not stream.done) and (stream.in_flight < self.prefetch):
+                
+                if (self.max_page_cnt > 0) and \
+                    (stream.next_page > self.max_page_cnt):
+                    stream.done = True 
+                    break 
+                
+                page = stream.next_page
+                stream.next_page += 1 
+                stream.in_flight += 1 
+                
+                # `_parse` is CrawlSpider's callback, which applies `rules`
+                yield scrapy.Request(
+                    stream.url % page, callback=self._parse, 
+                    errback=self._page_failed, 
+                    cb_kwargs=dict(order=stream.order, page=page)
+                )
+    
+    def _page_dropped(self, request, spider):
+        """
+        A search page the scheduler did not take, e.g. because another
+        worker of a distributed crawl already has it
+        """
+        stream = self.streams.get(request.cb_kwargs.get('order'))
+        if (stream is not None) and ('page' in request.cb_kwargs):
+            stream.in_flight = max(stream.in_flight - 1, 0)
+    
+    def _page_failed(self, failure):
+        """
+        A search page that failed after its retries, or was not found, 
+        e.g. past the last page. Its order stops, as without pages to 
+        parse and no `max_page_cnt` it would never be done.
+        """
+        kwargs = failure.request.cb_kwargs
+        stream = self.streams[kwargs['order']]
+        stream.in_flight = max(stream.in_flight - 1, 0)
+        stream.done = True 
+        
+        self.logger.warning(
+            f"Search page {kwargs['page']} of {kwargs['order']} failed, "
+            f"stopping {kwargs['order']}: {failure.value}"
+        )
+        self.crawler.stats.inc_value('novels/search_failed')
+        
+        yield from self._request_pages()
+        yield from self._release_pending()
     
     @staticmethod 
     def _find_substring_index(lst: List[str]) -> int:
@@ -259,11 +647,10 @@ class NovelSpider(CrawlSpider):
     @staticmethod
     def _parse_date(box: scrapy.Selector) -> datetime.date:
         date = box.xpath("./table//td/following-sibling::*/text()").getall()
-        date = ''.join(''.join(a.strip() for a in date).split())
-        date = re.search("最終更新日.(.*)週", date).group(1)
-        return datetime.strptime(date, "%Y/%m/%d%H:%M") 
+        return _find_update_date(date)
         
-    def _parse(self, box: scrapy.Selector) -> Novel:
+    def _parse_box(self, box: scrapy.Selector) -> Novel:
+        """Parse one `div.searchkekka_box` of a search results page"""
         
         header = box.xpath("./div[@class='novel_h']")
         title = header.xpath("./a[@class='tl']/text()").get()
@@ -274,31 +661,133 @@ class NovelSpider(CrawlSpider):
         genre = tags[0]
         tags = tags[1:]
         
-        data = header.xpath(a + "/*//*[not(text()='\n')]/text()").getall()
+        summary = box.css("td div.ex::text").get()
         
-        status = data[1] 
-        summary = data[2] 
-        post_cnt = re.search(r"\(全(\d*)部分\)", data[2]).group(1)
-        
-        ind = data.index(tags[-1]) + 1
-        word_cnt = re.search("(\d*)(?:文字)", data[ind])
-        
-        metrics = {} 
-        for metric in data[ind+1:]:
-            colon = metric.index(r"：")
-            name = metric[:colon].strip()
-            value = to_int(metric[colon:])
-            metrics[name] = value 
+        tbl = self._format_tbl_str(box.xpath("./table//text()").getall())
+        metrics = self.finder.scan(' '.join(filter(None, tbl)))
         
         date = self._parse_date(box)
         
         return Novel(
-            title=title, author=author, url=link,
+            ncode=get_ncode(link), title=title, author=author, url=link,
             genre=genre, keywords=tags, most_recent_update=date,
-            status=status, summary=summary, post_cnt=post_cnt, 
-            word_cnt=word_cnt, **metrics
+            summary=summary, period_pnts=period_points(metrics['rank']),
+            **{name: metrics[name] for name in NOVEL_METRIC_FIELDS}
         )
         
+    @staticmethod
+    def _walk_tbl(table: etree._Element, tags: List[str], 
+                tbl: List[str], dates: List[str]) -> Union[str, NoneType]:
+        """
+        Walk a metrics table once, in document order
+        
+        Appends link texts to `tags`, all texts to `tbl` and the texts 
+        after the status cell to `dates`. Returns the summary, if any.
+        """
+        summary = None 
+        td_depth = 0 
+        
+        # whether each open element already had a `td` child 
+        after_td = [] 
+        
+        for event, el in etree.iterwalk(
+            table, events=('start', 'end', 'comment', 'pi')
+        ):
+            if event == 'start':
+                tag = el.tag 
+                
+                if el.text is not None: 
+                    tbl.append(el.text)
+                
+                if after_td:
+                    if after_td[-1]: 
+                        dates.extend(_direct_text(el))
+                    if tag == 'td': 
+                        after_td[-1] = True 
+                
+                after_td.append(False)
+                
+                if tag == 'td':
+                    td_depth += 1 
+                elif tag == 'a':
+                    tags.extend(_direct_text(el))
+                elif (tag == 'div') and td_depth and (summary is None) and \
+                    ('ex' in el.get('class', '').split()):
+                    
+                    texts = _direct_text(el)
+                    summary = texts[0] if texts else None 
+            
+            elif event == 'end':
+                after_td.pop()
+                
+                if el.tag == 'td': 
+                    td_depth -= 1 
+                if after_td and (el.tail is not None): 
+                    tbl.append(el.tail)
+            
+            # comments and processing instructions only end text nodes 
+            elif el.tail is not None:
+                tbl.append(el.tail)
+        
+        return summary 
+    
+    def _parse_box_lxml(self, box: etree._Element) -> Novel:
+        """
+        Same as `_parse_box`, but for the box's lxml element. The box 
+        is walked once instead of being queried for every field.
+        """
+        
+        header = title = link = author = summary = None 
+        tags, tbl, dates = [], [], []
+        
+        for child in box:
+            
+            if not isinstance(child.tag, str): 
+                continue 
+            
+            if header is not None:
+                # following siblings of the header 
+                if author is None:
+                    texts = _direct_text(child)
+                    author = texts[0] if texts else None 
+                
+                if child.tag != 'table':
+                    for a in child.iterdescendants('a'):
+                        tags.extend(_direct_text(a))
+            
+            elif (child.tag == 'div') and (child.get('class') == 'novel_h'):
+                header = child
+                
+                for a in child:
+                    if (a.tag != 'a') or (a.get('class') != 'tl'): 
+                        continue 
+                    if link is None: 
+                        link = a.get('href')
+                    if title is None:
+                        texts = _direct_text(a)
+                        title = texts[0] if texts else None 
+                
+                continue 
+            
+            if child.tag == 'table':
+                res = self._walk_tbl(
+                    child, tags if (header is not None) else [], tbl, dates
+                )
+                summary = res if summary is None else summary
+        
+        genre = tags[0]
+        tags = tags[1:]
+        
+        metrics = self.finder.scan(' '.join(' '.join(tbl).split()))
+        date = _find_update_date(dates)
+        
+        return Novel(
+            ncode=get_ncode(link), title=title, author=author, url=link,
+            genre=genre, keywords=tags, most_recent_update=date,
+            summary=summary, period_pnts=period_points(metrics['rank']),
+            **{name: metrics[name] for name in NOVEL_METRIC_FIELDS}
+        )
+    
     @staticmethod
     def _format_tbl_str(boxes: List[str]) -> str:
         """Format table strings containng novel metrics"""
@@ -309,17 +798,169 @@ class NovelSpider(CrawlSpider):
             boxes[i] = box 
         return boxes 
     
+    def _iter_boxes(self, response) -> Iterator[Tuple[str, Any]]:
+        """ncode and `box_parser` input of each search result box"""
+        
+        if self.box_parser == 'lxml':
+            for box in SEARCH_BOXES_XPATH(response.selector.root):
+                link = _BOX_LINK(box)
+                yield (get_ncode(link[0]) if link else None), box 
+        else:
+            for box in response.css("div.searchkekka_box"):
+                link = box.xpath(BOX_LINK_XPATH).get()
+                yield (None if link is None else get_ncode(link)), box 
+    
+    def _check_unchanged(self, novel: Novel) -> None:
+        # checked before the item reaches the pipelines, which may 
+        # store its new update time
+        if (self.store is not None) and self.store.is_unchanged(
+            novel['ncode'], novel['most_recent_update']
+        ):
+            self.unchanged.add(novel['ncode'])
+    
     def parse(self, response, **kwargs):
+        """
+        Parse search results with `box_parser`, which is set by the
+        `SYOSETU_BOX_PARSER` setting. Both parsers give the same items.
+        """
         
-        for box in response.css("div.searchkekka_box"):
+        parse_box = getattr(self, self.box_parsers[self.box_parser])
+        
+        for _, box in self._iter_boxes(response):
+            novel = parse_box(box)
+            self._check_unchanged(novel)
+            yield novel
+    
+    def parse_start_url(self, response, order: str=None, page: int=None, 
+                        **kwargs):
+        """
+        Parse the novels of a search page that were not found before, 
+        up to `max_novel_cnt`, and request the next pages.
+        
+        Novels found again, on this or another order, are not parsed 
+        again; only their rank is added to `rankings`. With one order,
+        novels are yielded at once. With several, they are held until 
+        all orders are done, so their `rankings` are complete.
+        """
+        
+        order = next(iter(self.streams)) if order is None else order 
+        if page is not None:
+            # pages requested by another worker were not counted here, 
+            # and the pages before them may be parsed by another worker 
+            stream = self.streams[order]
+            stream.in_flight = max(stream.in_flight - 1, 0)
+            stream.next_page = max(stream.next_page, page + 1)
+        
+        parse_box = getattr(self, self.box_parsers[self.box_parser])
+        first_rank = 1 if page is None else (page - 1)*SEARCH_PAGE_SIZE + 1 
+        
+        found = 0 
+        for rank, (ncode, box) in enumerate(
+            self._iter_boxes(response), start=first_rank
+        ):
+            found += 1 
             
+            if ncode in self.rankings:
+                self.rankings[ncode].setdefault(order, rank)
+                self.crawler.stats.inc_value('novels/duplicate')
+                continue 
             
-            summary = box.css("td div.ex::text").get()
-            tbl = box.xpath("./table//text()").getall()
-            tbl = self._format_tbl_str(tbl)
-            self.finder.replace_data(tbl)
+            if self.quota_reached():
+                continue 
             
-            itm = self.finder.create_novel_item()
+            novel = parse_box(box)
+            self._check_unchanged(novel)
             
-    def parse_novel(self):
+            ncode = novel['ncode']
+            self.rankings[ncode] = novel['rankings'] = {order : rank}
+            self.emitted.add(ncode)
+            
+            if len(self.streams) > 1:
+                self.pending.append(novel)
+            else:
+                yield novel
+        
+        if not found:
+            self.logger.info(
+                f"No results on page {page} of {order}, stopping {order}."
+            )
+            self.streams[order].done = True 
+        
+        self.crawler.stats.inc_value('novels/search_pages')
+        yield from self._request_pages()
+        yield from self._release_pending()
+    
+    def _release_pending(self) -> Iterator[Novel]:
+        """Yield held novels once no search page is left to parse"""
+        
+        if not self.pending or not self.pages_done:
+            return 
+        if any(stream.in_flight for stream in self.streams.values()):
+            return 
+        if self.shared_frontier:
+            return 
+        
+        self.logger.info(f"Search done, releasing {len(self.pending)} novels")
+        
+        pending, self.pending = self.pending, []
+        yield from pending
+    
+    def _spider_idle(self, spider):
+        """
+        Release held novels once no request is queued, leased or in 
+        flight, in the shared frontier too when the crawl is distributed
+        """
+        if not self.pending:
+            return 
+        
+        self.logger.info(f"Crawl idle, releasing {len(self.pending)} novels")
+        
+        pending, self.pending = self.pending, []
+        scraper = self.crawler.engine.scraper
+        for novel in pending:
+            deferred_from_coro(
+                scraper.start_itemproc_async(novel, response=None)
+            )
+        
+        # the items are processed on the next loop iteration 
+        raise DontCloseSpider
+    
+    def _spider_closed(self, spider, reason):
+        if not self.pending:
+            return 
+        
+        self.logger.warning(
+            f"Closed ({reason}) with {len(self.pending)} novels held back"
+        )
+        self.crawler.stats.set_value('novels/pending_dropped', len(self.pending))
+    
+    def quota_reached(self) -> bool:
+        return (self.max_novel_cnt > 0) and \
+            (len(self.emitted) >= self.max_novel_cnt)
+    
+    def _filter_novel_request(self, request, response):
+        """
+        Follow each novel once, and only if it was accepted, i.e. not 
+        past `max_novel_cnt`, and changed since the last run
+        """
+        
+        ncode = get_ncode(request.url)
+        if (ncode not in self.emitted) or (ncode in self.followed):
+            return None 
+        
+        self.followed.add(ncode)
+        return self._skip_unchanged(request, response)
+    
+    def _skip_unchanged(self, request, response):
+        """Drop requests for novels not updated since the last run"""
+        
+        ncode = get_ncode(request.url)
+        if ncode not in self.unchanged: 
+            return request 
+        
+        self.unchanged.discard(ncode)
+        self.crawler.stats.inc_value('novels/unchanged_skipped')
+        return None 
+    
+    def parse_novel(self, response, **kwargs):
         pass 
@@ -0,0 +1,141 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""SQLite storage of `Novel` items keyed by ncode"""
+
+import json
+import sqlite3
+from datetime import datetime
+from typing import Iterable, List, Dict, Union, Any
+
+# `Novel` fields stored as columns, besides the `ncode` primary key
+COLUMNS = (
+    'title', 'author', 'genre', 'summary', 'word_cnt', 'post_cnt',
+    'weekly_unique_cnt', 'most_recent_update', 'bookmark_cnt', 'review_cnt',
+    'hyouka_cnt', 'hyouka_pnt', 'global_pnt', 'url', 'keywords', 'rankings',
+    'period_pnts', 'near_duplicates'
+)
+
+# columns stored as JSON text
+JSON_COLUMNS = ('keywords', 'rankings', 'period_pnts', 'near_duplicates')
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class NovelStore:
+    """
+    Novels in a SQLite database, one row per ncode
+
+    Rows are upserted in batches inside a single write transaction.
+    `is_unchanged` is a primary key lookup, so it stays fast for
+    catalogues of hundreds of thousands of novels.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+
+        # readers (e.g. the spider) don't block the pipeline's writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        cols = ",\n".join(COLUMNS)
+        with self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS novels (\n"
+                f"ncode TEXT PRIMARY KEY,\n{cols},\n"
+                f"first_seen TEXT,\nlast_seen TEXT\n)"
+            )
+            
+            # databases from before a column was added 
+            found = {
+                row[1] for row in 
+                self.conn.execute("PRAGMA table_info(novels)")
+            }
+            for col in COLUMNS + ('first_seen', 'last_seen'):
+                if col not in found:
+                    self.conn.execute(f"ALTER TABLE novels ADD COLUMN {col}")
+
+        updates = ", ".join(
+            f"{c}=excluded.{c}" for c in COLUMNS + ('last_seen',)
+        )
+        self._upsert = (
+            f"INSERT INTO novels (ncode, {', '.join(COLUMNS)}, "
+            f"first_seen, last_seen) "
+            f"VALUES ({', '.join(['?'] * (len(COLUMNS) + 3))}) "
+            f"ON CONFLICT(ncode) DO UPDATE SET {updates}"
+        )
+
+    @staticmethod
+    def _to_row(ncode: str, item: Dict[str, Any], now: str) -> tuple:
+        row = [ncode]
+        for col in COLUMNS:
+            val = item.get(col)
+            if col in JSON_COLUMNS and val is not None:
+                val = json.dumps(val, ensure_ascii=False)
+            elif isinstance(val, datetime):
+                val = val.strftime(DATE_FORMAT)
+            row.append(val)
+
+        row.extend((now, now))
+        return tuple(row)
+
+    def upsert_many(self, items: Iterable[Dict[str, Any]]) -> int:
+        """Insert or update `items` by their `ncode` in one transaction"""
+
+        now = datetime.now().strftime(DATE_FORMAT)
+        rows = [self._to_row(item['ncode'], item, now) for item in items]
+
+        with self.conn:
+            self.conn.executemany(self._upsert, rows)
+
+        return len(rows)
+
+    def get_update(self, ncode: str) -> Union[datetime, None]:
+        """Stored `most_recent_update` of `ncode`, if any"""
+
+        row = self.conn.execute(
+            "SELECT most_recent_update FROM novels WHERE ncode=?", (ncode,)
+        ).fetchone()
+
+        if (row is None) or (row[0] is None):
+            return None
+
+        return datetime.strptime(row[0], DATE_FORMAT)
+
+    def is_unchanged(self, ncode: str, most_recent_update: datetime) -> bool:
+        """Whether `ncode` is stored with the same `most_recent_update`"""
+
+        row = self.conn.execute(
+            "SELECT 1 FROM novels WHERE ncode=? AND most_recent_update=?",
+            (ncode, most_recent_update.strftime(DATE_FORMAT))
+        ).fetchone()
+
+        return row is not None
+
+    def load(self, ncodes: List[str]) -> List[Dict[str, Any]]:
+        """Stored rows of `ncodes`, as dicts"""
+
+        cur = self.conn.execute(
+            f"SELECT * FROM novels WHERE ncode IN "
+            f"({', '.join(['?'] * len(ncodes))})", ncodes
+        )
+        names = [d[0] for d in cur.description]
+
+        rows = []
+        for row in cur:
+            row = dict(zip(names, row))
+            for col in JSON_COLUMNS:
+                if row[col] is not None:
+                    row[col] = json.loads(row[col])
+            if row['most_recent_update'] is not None:
+                row['most_recent_update'] = datetime.strptime(
+                    row['most_recent_update'], DATE_FORMAT
+                )
+            rows.append(row)
+
+        return rows
+
+    def close(self) -> None:
+        self.conn.close()
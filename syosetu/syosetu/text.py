@@ -0,0 +1,205 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Normalise chapter text for counting and indexing
+
+`normalize` gives the same text as
+
+    format_novel_metric_string([REMOVE_PUNCT_REGEX.sub('', text)])
+
+but in one `str.translate` pass, with two steps of its own:
+
+- ruby is dropped and its base kept, from `|base《reading》` (as
+  written by `ChapterSpider`) or a kanji run directly followed by a
+  kana `《reading》`
+- NFKC, so full- and half-width forms are folded, e.g. ＡＢ to AB and
+  ｶﾞ to ガ
+
+The translate table maps each character to its NFKC form, less what
+the two regexes delete. It is filled from the regexes themselves, once
+per distinct character. Text with characters that NFKC may compose
+with their neighbours, like ﾞ, is normalised as a whole instead.
+`iter_normalized` and `normalize_file` work on chunks, so long novels
+are never held in memory as a whole:
+
+    python -m syosetu.text chapters.txt clean.txt
+"""
+
+import sys
+import gzip
+import unicodedata
+
+from typing import Dict, Iterable, Iterator, Union
+
+import regex as re
+
+from syosetu.spiders.novels_spider import REMOVE_PUNCT_REGEX
+
+# ---------------------------------------------------------------------------- #
+
+WHITESPACE_REGEX = re.compile(r"[\n\s]")
+
+RUBY_REGEX = re.compile(
+    r"[|｜]([^|｜《》\n]{1,20})《[^《》\n]{1,20}》"
+    r"|(?<=\p{Han})《[\p{Hiragana}\p{Katakana}ー]{1,20}》"
+)
+
+SPACES_REGEX = re.compile(" {2,}")
+
+_TRAILING_HAN = re.compile(r"\p{Han}{1,20}$")
+
+# a ruby marker or reading that is not closed yet
+_OPEN_RUBY = re.compile(r"[|｜《][^》]*$")
+
+# longest text a ruby group can span, with its marker and brackets
+RUBY_SPAN = 44
+
+CHUNK_SIZE = 2**20
+
+# half-width voiced sound marks, which compose with the kana before them
+_HALFWIDTH_MARKS = 'ﾞﾟ'
+
+# marks the characters that NFKC may compose with their neighbours
+_COMPOSES = '\x00'
+
+def _composes(c: str) -> bool:
+    # combining marks, Hangul jamo and the few other composing starters
+    return bool(unicodedata.combining(c)) or (0x1100 <= ord(c) <= 0x11FF) or (
+        c in '\u09be\u09d7\u0b3e\u0b56\u0b57\u0bbe\u0bd7\u0cc2\u0cd5'
+        '\u0cd6\u0d3e\u0d57\u0dcf\u0ddf\u102e\u1b35'
+    )
+
+class _KeepTable(dict):
+    """
+    `str.translate` table deleting what the regexes delete, after NFKC
+    of each character if `fold`. The rule is applied once per character,
+    the first time it is looked up.
+    """
+
+    def __init__(self, collapse: bool, fold: bool) -> None:
+        super().__init__()
+        self.collapse = collapse
+        self.fold = fold
+
+    def _keep(self, c: str) -> str:
+        if WHITESPACE_REGEX.match(c):
+            return ' ' if self.collapse else ''
+        return '' if REMOVE_PUNCT_REGEX.fullmatch(c) else c
+
+    def __missing__(self, code: int) -> Union[str, None]:
+        c = chr(code)
+        folded = unicodedata.normalize('NFKC', c) if self.fold else c
+
+        if self.fold and any(_composes(x) for x in c + folded):
+            value = _COMPOSES
+        else:
+            value = ''.join(self._keep(x) for x in folded) or None
+
+        self[code] = value
+        return value
+
+# by `collapse`, with per-character NFKC and without
+_FOLD_TABLES: Dict[bool, _KeepTable] = {
+    collapse : _KeepTable(collapse, fold=True) for collapse in (False, True)
+}
+_TABLES: Dict[bool, _KeepTable] = {
+    collapse : _KeepTable(collapse, fold=False) for collapse in (False, True)
+}
+
+# ---------------------------------------------------------------------------- #
+
+def _strip_ruby(text: str) -> str:
+    if '《' not in text:
+        return text
+    return RUBY_REGEX.sub(lambda m: m.group(1) or '', text)
+
+def _clean(text: str, collapse: bool) -> str:
+    text = _strip_ruby(text)
+    out = text.translate(_FOLD_TABLES[collapse])
+
+    # NFKC of the whole text only if some characters may compose
+    if _COMPOSES in out:
+        out = unicodedata.normalize('NFKC', text).translate(_TABLES[collapse])
+
+    if collapse and '  ' in out:
+        out = SPACES_REGEX.sub(' ', out)
+    return out
+
+def normalize(text: str, collapse: bool=False) -> str:
+    """
+    `text` without punctuation, ruby readings and whitespace, or with
+    whitespace runs as one space if `collapse`
+    """
+    return _clean(text, collapse)
+
+def _safe_end(chunk: str) -> int:
+    """
+    Where `chunk` can be cut without splitting a composing sequence or a
+    ruby group; the rest is carried over to the next chunk
+    """
+    # the last starter is always carried, with the marks, jamo or vowel
+    # signs after it, as it may compose with what follows
+    end = len(chunk) - 1
+    while (end > 0) and (_composes(chunk[end]) or chunk[end] in _HALFWIDTH_MARKS):
+        end -= 1
+
+    # an open ruby group, or kanji that a reading may follow
+    start = max(end - RUBY_SPAN, 0)
+    tail = chunk[start:end]
+    m = _OPEN_RUBY.search(tail)
+    if m is not None:
+        tail = tail[:m.start()]
+
+    m = _TRAILING_HAN.search(tail)
+    return start + (len(tail) if m is None else m.start())
+
+def iter_normalized(chunks: Iterable[str], collapse: bool=False) -> Iterator[str]:
+    """`normalize` over `chunks` of one text, chunk by chunk"""
+
+    carry = ''
+    space = False
+    for chunk in chunks:
+        chunk = carry + chunk
+        end = _safe_end(chunk)
+        out, carry = _clean(chunk[:end], collapse), chunk[end:]
+
+        # one space for a run that continues over the cut
+        if space and out.startswith(' '):
+            out = out[1:]
+        if out:
+            space = collapse and out.endswith(' ')
+            yield out
+
+    out = _clean(carry, collapse)
+    if space and out.startswith(' '):
+        out = out[1:]
+    if out:
+        yield out
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+def normalize_file(src: str, dst: str, collapse: bool=False,
+                chunk_size: int=CHUNK_SIZE) -> int:
+    """
+    Normalise the text file `src` into `dst`, either may be gzipped.
+    Returns the number of characters written.
+    """
+    written = 0
+    with _open(src, 'r') as fin, _open(dst, 'w') as fout:
+        chunks = iter(lambda: fin.read(chunk_size), '')
+        for out in iter_normalized(chunks, collapse):
+            written += fout.write(out)
+    return written
+
+# ---------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m syosetu.text SRC DST")
+    print(f"Wrote {normalize_file(sys.argv[1], sys.argv[2])} characters")
@@ -0,0 +1,322 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Time series of novel metrics across crawls
+
+Every crawl is a snapshot of the metrics of the novels it found.
+`MetricStore` keeps only the metrics that changed since a novel was last
+seen, in a SQLite database, twice:
+
+- by novel, as blocks of up to `BLOCK_SIZE` (time, value) points, for the
+  history of one novel, e.g. its bookmarks over the last 90 days
+- by snapshot, as the change of every novel that changed, for what all
+  novels did over a period, e.g. the top movers of the week
+
+Both are delta-encoded int64 columns, byte-shuffled and compressed with
+zlib. A novel's first value starts its history and is not a change.
+Times are Unix seconds.
+
+`TimeSeriesPipeline` appends each crawl to `TIMESERIES_PATH`.
+"""
+
+import zlib
+import sqlite3
+import numpy as np
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple, Union, Any
+
+# ---------------------------------------------------------------------------- #
+
+# `Novel` fields tracked, besides the `period_pnts` scores
+METRICS = (
+    'global_pnt', 'bookmark_cnt', 'weekly_unique_cnt', 'hyouka_cnt',
+    'hyouka_pnt'
+)
+
+# points per block of a novel's history
+BLOCK_SIZE = 64
+
+# `IN (...)` lookups per query, below SQLite's variable limit
+QUERY_BATCH = 500
+
+Time = Union[datetime, int, float]
+
+def to_ts(t: Time) -> int:
+    return int(t.timestamp()) if isinstance(t, datetime) else int(t)
+
+def item_metrics(item: Dict[str, Any]) -> Dict[str, int]:
+    """Tracked metrics of a `Novel`, with period scores as e.g. 'yearly_pnt'"""
+
+    metrics = {
+        name: item[name] for name in METRICS if item.get(name) is not None
+    }
+    for period, pnt in (item.get('period_pnts') or {}).items():
+        if pnt is not None:
+            metrics[f"{period}_pnt"] = pnt
+    return metrics
+
+def _pack(*columns) -> bytes:
+    # bytes of the same significance together, mostly zeros for deltas
+    data = np.concatenate(columns, dtype='<i8')
+    return zlib.compress(data.view(np.uint8).reshape(-1, 8).T.tobytes())
+
+def _unpack(data: bytes, n: int, k: int) -> List[np.ndarray]:
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    data = raw.reshape(8, k*n).T.copy().view('<i8').ravel()
+    return [data[i*n:(i + 1)*n] for i in range(k)]
+
+def _unpack_points(data: bytes, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    dts, dvs = _unpack(data, n, 2)
+    return np.cumsum(dts), np.cumsum(dvs)
+
+# ---------------------------------------------------------------------------- #
+
+class MetricStore:
+    """
+    Changes of novel metrics over time, in a SQLite database
+
+    `append` adds one snapshot. `history`, `value_at` and `growth` read
+    one novel's blocks through the primary key; `movers` sums the
+    changes of the snapshots in a period, so it reads only those.
+    """
+
+    def __init__(self, path: str, block_size: int=BLOCK_SIZE) -> None:
+        self.path = path
+        self.block_size = block_size
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS novels (
+                    id INTEGER PRIMARY KEY,
+                    ncode TEXT UNIQUE NOT NULL
+                );
+                -- last point and open block of each series
+                CREATE TABLE IF NOT EXISTS heads (
+                    novel INTEGER, metric TEXT, t INTEGER, value INTEGER,
+                    block_t INTEGER, block_n INTEGER,
+                    PRIMARY KEY (novel, metric)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS blocks (
+                    novel INTEGER, metric TEXT, start_t INTEGER,
+                    end_t INTEGER, end_value INTEGER, n INTEGER, data BLOB,
+                    PRIMARY KEY (novel, metric, start_t)
+                ) WITHOUT ROWID;
+                -- changes of all novels in one snapshot
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    id INTEGER PRIMARY KEY, metric TEXT, t INTEGER,
+                    n INTEGER, data BLOB
+                );
+                CREATE INDEX IF NOT EXISTS snapshots_metric_t
+                    ON snapshots (metric, t);
+            """)
+
+    def _select_in(self, sql: str, keys: List[Any]) -> Iterable[tuple]:
+        for i in range(0, len(keys), QUERY_BATCH):
+            batch = keys[i:i + QUERY_BATCH]
+            yield from self.conn.execute(
+                sql % ", ".join(['?'] * len(batch)), batch
+            )
+
+    def _novel_ids(self, ncodes: List[str], create: bool=False) -> Dict[str, int]:
+        if create:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO novels (ncode) VALUES (?)",
+                [(ncode,) for ncode in ncodes]
+            )
+        return dict(self._select_in(
+            "SELECT ncode, id FROM novels WHERE ncode IN (%s)", ncodes
+        ))
+
+    # ------------------------------------------------------------------------ #
+
+    def append(self, t: Time, items: Iterable[Dict[str, Any]]) -> int:
+        """
+        Add the metrics of `items`, novels seen at time `t`, that changed
+        since their last snapshot. Returns the number of points added.
+        """
+        t = to_ts(t)
+        snapshot = {
+            item['ncode'] : item_metrics(item) for item in items
+            if item.get('ncode')
+        }
+        if not snapshot:
+            return 0
+
+        with self.conn:
+            ids = self._novel_ids(list(snapshot), create=True)
+
+            # last point and open block of every series of these novels
+            heads = {
+                (novel, metric) : rest for novel, metric, *rest in
+                self._select_in(
+                    "SELECT h.novel, h.metric, h.t, h.value, h.block_t, "
+                    "h.block_n, b.data FROM heads h JOIN blocks b "
+                    "ON b.novel = h.novel AND b.metric = h.metric "
+                    "AND b.start_t = h.block_t WHERE h.novel IN (%s)",
+                    list(ids.values())
+                )
+            }
+
+            blocks, changes = [], dict()
+            for ncode, metrics in snapshot.items():
+                novel = ids[ncode]
+                for metric, value in metrics.items():
+                    head = heads.get((novel, metric))
+
+                    if head is None:
+                        blocks.append(self._block(novel, metric, t, value))
+                    elif (head[1] != value) and (t > head[0]):
+                        blocks.append(self._block(novel, metric, t, value, head))
+                        changes.setdefault(metric, []).append(
+                            (novel, value - head[1])
+                        )
+
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                blocks
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO heads VALUES (?, ?, ?, ?, ?, ?)",
+                [(b[0], b[1], b[3], b[4], b[2], b[5]) for b in blocks]
+            )
+
+            for metric, deltas in changes.items():
+                deltas.sort()
+                novels, deltas = np.array(deltas, dtype=np.int64).T
+                self.conn.execute(
+                    "INSERT INTO snapshots (metric, t, n, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    (metric, t, len(novels),
+                    _pack(np.diff(novels, prepend=0), deltas))
+                )
+
+        return len(blocks)
+
+    def _block(self, novel: int, metric: str, t: int, value: int,
+            head: tuple=None) -> tuple:
+        """Row of the open block of a series, with the point added"""
+
+        if (head is None) or (head[3] >= self.block_size):
+            return (novel, metric, t, t, value, 1, _pack([t], [value]))
+
+        # points are stored as deltas, so the new one goes at the end
+        last_t, last_value, block_t, n, data = head
+        dts, dvs = _unpack(data, n, 2)
+        return (
+            novel, metric, block_t, t, value, n + 1,
+            _pack(dts, [t - last_t], dvs, [value - last_value])
+        )
+
+    # ------------------------------------------------------------------------ #
+
+    def history(self, ncode: str, metric: str, start: Time=None,
+                end: Time=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Times and values of `metric` of `ncode` from `start` to `end`,
+        starting with the value carried over from before `start`
+        """
+        start = -2**62 if start is None else to_ts(start)
+        end = 2**62 if end is None else to_ts(end)
+
+        blocks = self.conn.execute(
+            "SELECT b.start_t, b.n, b.data FROM blocks b "
+            "JOIN novels ON novels.id = b.novel "
+            "WHERE novels.ncode=? AND b.metric=? AND b.start_t <= ? "
+            "AND b.end_t >= coalesce(("
+            "   SELECT max(p.end_t) FROM blocks p WHERE p.novel = b.novel "
+            "   AND p.metric = b.metric AND p.end_t <= ?"
+            "), ?) ORDER BY b.start_t",
+            (ncode, metric, end, start, start)
+        ).fetchall()
+
+        if not blocks:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        ts, values = map(np.concatenate, zip(*(
+            _unpack_points(data, n) for _, n, data in blocks
+        )))
+
+        # the last point at or before `start`, then those up to `end`
+        first = max(np.searchsorted(ts, start, side='right') - 1, 0)
+        last = np.searchsorted(ts, end, side='right')
+        return ts[first:last], values[first:last]
+
+    def value_at(self, ncode: str, metric: str, t: Time) -> Union[int, None]:
+        """Value of `metric` of `ncode` at time `t`, if it was seen by then"""
+
+        t = to_ts(t)
+        row = self.conn.execute(
+            "SELECT b.start_t, b.end_t, b.end_value, b.n, b.data FROM blocks b "
+            "JOIN novels ON novels.id = b.novel "
+            "WHERE novels.ncode=? AND b.metric=? AND b.start_t <= ? "
+            "ORDER BY b.start_t DESC LIMIT 1", (ncode, metric, t)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        start_t, end_t, end_value, n, data = row
+        if end_t <= t:
+            return end_value
+
+        ts, values = _unpack_points(data, n)
+        return int(values[np.searchsorted(ts, t, side='right') - 1])
+
+    def growth(self, ncode: str, metric: str, start: Time,
+            end: Time) -> Union[int, None]:
+        """
+        Change of `metric` of `ncode` from `start` to `end`, or since it
+        was first seen if that is after `start`
+        """
+        ts, values = self.history(ncode, metric, start, end)
+        if not len(ts):
+            return None
+        return int(values[-1] - values[0])
+
+    def movers(self, metric: str, start: Time, end: Time,
+            top: int=10) -> List[Tuple[str, int]]:
+        """
+        The `top` novels by change of `metric` from `start` to `end`,
+        as (ncode, change), largest first
+        """
+        rows = self.conn.execute(
+            "SELECT n, data FROM snapshots WHERE metric=? AND t > ? AND t <= ?",
+            (metric, to_ts(start), to_ts(end))
+        ).fetchall()
+
+        if not rows:
+            return []
+
+        novels, deltas = [], []
+        for n, data in rows:
+            ids, changes = _unpack(data, n, 2)
+            novels.append(np.cumsum(ids))
+            deltas.append(changes)
+
+        novels, inverse = np.unique(np.concatenate(novels), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(deltas))
+
+        best = np.argsort(-totals, kind='stable')[:top]
+        best = best[totals[best] > 0]
+        names = dict(self._select_in(
+            "SELECT id, ncode FROM novels WHERE id IN (%s)",
+            novels[best].tolist()
+        ))
+        return [(names[novels[i]], int(totals[i])) for i in best]
+
+    def metrics(self) -> List[str]:
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT metric FROM heads ORDER BY metric"
+        )]
+
+    def close(self) -> None:
+        self.conn.close()
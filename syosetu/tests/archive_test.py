@@ -0,0 +1,194 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import gzip
+import json
+import asyncio
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from syosetu.archive import ArchiveWriter, ArchiveReader, ReplayDownloadHandler
+from syosetu.middlewares import ArchiveRecorderMiddleware
+from syosetu.spiders.chapters import ChapterSpider
+from syosetu.spiders.novels_spider import NovelSpider, get_search_order
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+HTML = [("Content-Type", "text/html; charset=utf-8")]
+
+def read_html(name: str) -> bytes:
+    with open(TESTPATH + name, mode='rb') as file:
+        return file.read()
+
+# ---------------------------------------------------------------------------- #
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "crawl.warc.gz")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        writer = ArchiveWriter(self.path)
+        writer.write("https://ncode.syosetu.com/n0001aa/", 200, HTML, b"old")
+        writer.write("https://ncode.syosetu.com/n0001aa/1/", 404, [], b"")
+        writer.write("https://ncode.syosetu.com/n0001aa/", 200, HTML, b"new")
+        writer.close()
+
+        # an interrupted write leaves a partial record
+        with open(self.path, mode='ab') as file:
+            file.write(gzip.compress(b"WARC/1.0\r\n")[:10])
+
+        reader = ArchiveReader(self.path)
+        self.assertEqual(len(reader), 2)
+        self.assertIn("https://ncode.syosetu.com/n0001aa/1/", reader)
+
+        status, headers, body = reader.get("https://ncode.syosetu.com/n0001aa/")
+        self.assertEqual((status, headers, body), (200, HTML, b"new"))
+        self.assertEqual(
+            reader.get("https://ncode.syosetu.com/n0001aa/1/")[0], 404
+        )
+        self.assertIsNone(reader.get("https://ncode.syosetu.com/n0002aa/"))
+        reader.close()
+
+        # members are standard gzip, readable as one stream
+        with gzip.open(self.path, mode='rb') as file:
+            self.assertTrue(file.read(8).startswith(b"WARC/1.0"))
+
+    def test_recorder_and_replay(self):
+        crawler = get_crawler(NovelSpider, settings_dict={
+            'ARCHIVE_RECORD_PATH' : self.path,
+            'ARCHIVE_REPLAY_PATH' : self.path,
+        })
+        spider = NovelSpider.from_crawler(crawler)
+
+        url = get_search_order("favnovelcnt") % 1
+        req = Request(url)
+        recorded = HtmlResponse(
+            url=url, body=read_html("search_results.html"),
+            headers={"Content-Type" : "text/html; charset=utf-8"}, request=req
+        )
+
+        recorder = ArchiveRecorderMiddleware.from_crawler(crawler)
+        recorder.process_response(req, recorded, spider)
+        recorder.spider_closed(spider)
+        self.assertEqual(crawler.stats.get_value('archive/recorded'), 1)
+
+        handler = ReplayDownloadHandler.from_crawler(crawler)
+        replayed = asyncio.run(handler.download_request(req))
+        missing = asyncio.run(handler.download_request(Request(url + "0")))
+        asyncio.run(handler.close())
+
+        self.assertIsInstance(replayed, HtmlResponse)
+        self.assertIn('replayed', replayed.flags)
+        self.assertEqual(replayed.body, recorded.body)
+        self.assertEqual(missing.status, 404)
+        self.assertEqual(crawler.stats.get_value('replay/missing'), 1)
+
+        # replayed responses are not recorded again
+        recorder = ArchiveRecorderMiddleware.from_crawler(crawler)
+        recorder.process_response(req, replayed, spider)
+        recorder.spider_closed(spider)
+        self.assertEqual(crawler.stats.get_value('archive/recorded'), 1)
+
+        self.assertEqual(
+            [dict(i) for i in NovelSpider().parse(recorded)],
+            [dict(i) for i in NovelSpider().parse(replayed)]
+        )
+
+    def test_offline_chapter_crawl(self):
+        """A full crawl, through every middleware, from an archive"""
+
+        index = "https://ncode.syosetu.com/n0001aa/"
+        chapter = gzip.compress(read_html("novel_chapter.html"))
+
+        writer = ArchiveWriter(self.path)
+        writer.write(index, 200, HTML, read_html("novel_index.html"))
+        for i in range(1, 7):
+            # bodies are stored as sent, here gzip-encoded
+            writer.write(
+                f"{index}{i}/", 200, HTML + [("Content-Encoding", "gzip")],
+                chapter
+            )
+        writer.close()
+
+        out_dir = os.path.join(self.tmp.name, "chapters")
+        proc = subprocess.run(
+            [sys.executable, "-m", "syosetu.archive", self.path,
+            ChapterSpider.name, "-a", f"ncodes={index}",
+            "-a", f"out_dir={out_dir}", "-s", "LOG_LEVEL=WARNING",
+            "-s", f"SQLITE_PATH={self.tmp.name}/novels.db",
+            "-s", f"PARQUET_DIR={self.tmp.name}/output"],
+            cwd="./syosetu/", capture_output=True, text=True, timeout=120
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn("Replayed 7 pages (0 missing)", proc.stdout)
+
+        with gzip.open(os.path.join(out_dir, "n0001aa.jsonl.gz"), 'rt') as file:
+            chapters = [json.loads(line) for line in file]
+
+        self.assertEqual([c["chapter"] for c in chapters], list(range(1, 7)))
+        self.assertEqual(chapters[0]["title"], "第1話　始まり")
+
+    def test_replay_is_repeatable(self):
+        """Replaying twice gives the same items and writes no stores"""
+
+        writer = ArchiveWriter(self.path)
+        writer.write(
+            get_search_order("favnovelcnt") % 1, 200, HTML,
+            read_html("search_results.html")
+        )
+        # novel pages, skipped on a second run if unchanged novels were
+        for i in range(1, 11):
+            writer.write(
+                f"https://ncode.syosetu.com/n{i:04d}aa/", 200, HTML,
+                read_html("novel_index.html")
+            )
+        writer.close()
+
+        # outside the project, so that its stores are not touched
+        run_dir = os.path.join(self.tmp.name, "run")
+        os.makedirs(run_dir)
+        env = dict(
+            os.environ, SCRAPY_SETTINGS_MODULE="syosetu.settings",
+            PYTHONPATH=os.path.abspath("./syosetu/")
+        )
+
+        runs = []
+        for run in range(2):
+            feed = os.path.join(self.tmp.name, f"items{run}.jsonl")
+            proc = subprocess.run(
+                [sys.executable, "-m", "syosetu.archive", self.path,
+                NovelSpider.name, "-a", "max_page_cnt=1",
+                "-s", "LOG_LEVEL=WARNING",
+                "-s", f'FEEDS={{"{feed}": {{"format": "jsonlines"}}}}'],
+                cwd=run_dir, env=env, capture_output=True, text=True,
+                timeout=120
+            )
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+
+            with open(feed, encoding='utf8') as file:
+                items = sorted(file.read().splitlines())
+            pages = proc.stdout.split(" and ")[0]
+            runs.append((pages, items))
+
+        self.assertEqual(runs[0], runs[1])
+        self.assertIn("Replayed 11 pages", runs[0][0])
+        self.assertEqual(len(runs[0][1]), 10)
+        self.assertEqual(os.listdir(run_dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
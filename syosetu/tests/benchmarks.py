@@ -0,0 +1,276 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""
+Offline benchmarks for the syosetu parsing hot paths
+
+Every case runs on the saved fixtures in `syosetu/tests/data`, so no
+network access is needed. Run from the repository root:
+
+    python ./syosetu/tests/benchmarks.py [--update-baseline]
+
+Results are written as JSON. The run fails (exit code 1) when a case is
+slower, or uses more memory, than the stored baseline by more than
+`--tolerance`.
+"""
+
+import sys
+import os
+import gc
+import json
+import time
+import logging
+import platform
+import argparse
+import tracemalloc
+
+from datetime import datetime
+from statistics import quantiles
+from typing import Callable, Dict, List, Tuple, Any
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy.http import HtmlResponse
+import syosetu.spiders.novels_spider as nspider
+
+# ---------------------------------------------------------------------------- #
+
+TESTPATH = "./syosetu/tests/data/"
+BASELINE = TESTPATH + "benchmark_baseline.json"
+OUTPUT = "./syosetu/tests/benchmark_results.json"
+
+FILE_OPTS = dict(mode='r', encoding='utf8')
+
+SEARCH_URL = nspider.get_search_order("favnovelcnt") % 1
+
+# absolute slack for peak memory, which is noisy for small cases
+MEM_SLACK_KB = 64
+
+# (function, number of operations per call)
+Case = Tuple[Callable[[], Any], int]
+
+# ---------------------------------------------------------------------------- #
+
+def _read_texts() -> List[str]:
+    texts = []
+    for i in range(1, 11):
+        with open(TESTPATH + f"_testtxt{i}.txt", **FILE_OPTS) as file:
+            texts.append(file.read().rstrip())
+    return texts
+
+def _read_response() -> HtmlResponse:
+    with open(TESTPATH + "search_results.html", mode='rb') as file:
+        body = file.read()
+    return HtmlResponse(url=SEARCH_URL, body=body, encoding='utf-8')
+
+def build_cases() -> Dict[str, Case]:
+    """Benchmark cases keyed by name"""
+
+    texts = _read_texts()
+    response = _read_response()
+    spider = nspider.NovelSpider()
+    lxml_spider = nspider.NovelSpider(box_parser='lxml')
+    finder = nspider.FindNovelMetrics('')
+
+    boxes = response.css("div.searchkekka_box")
+    box_elements = [box.root for box in boxes]
+    tables = [box.xpath("./table//text()").getall() for box in boxes]
+    numbers = [
+        s for s in ' '.join(texts).split() if any(c.isdigit() for c in s)
+    ]
+
+    def find():
+        for text in texts:
+            finder.replace_data(text)
+            finder.find()
+
+    def scan():
+        for text in texts: nspider.FindNovelMetrics.scan(text)
+
+    def find_per_metric():
+        # the one-regex-per-metric extraction `scan` replaced
+        for text in texts:
+            finder.replace_data(text)
+            finder._findPerMetric()
+
+    def parse():
+        # fresh response, so that selector caching is measured as well
+        for _ in spider.parse(_read_response()): pass
+
+    def parse_lxml():
+        for _ in lxml_spider.parse(_read_response()): pass
+
+    def parse_box():
+        for box in boxes: spider._parse_box(box)
+
+    def parse_box_lxml():
+        for box in box_elements: lxml_spider._parse_box_lxml(box)
+
+    def parse_date():
+        for box in boxes: spider._parse_date(box)
+
+    def to_int():
+        for num in numbers: nspider.to_int(num)
+
+    def format_metric_string():
+        for tbl in tables: nspider.format_novel_metric_string(tbl)
+
+    return {
+        "FindNovelMetrics.find" : (find, len(texts)),
+        "FindNovelMetrics.scan" : (scan, len(texts)),
+        "FindNovelMetrics._findPerMetric" : (find_per_metric, len(texts)),
+        "NovelSpider.parse" : (parse, len(boxes)),
+        "NovelSpider.parse[lxml]" : (parse_lxml, len(boxes)),
+        "NovelSpider._parse_box" : (parse_box, len(boxes)),
+        "NovelSpider._parse_box_lxml" : (parse_box_lxml, len(boxes)),
+        "NovelSpider._parse_date" : (parse_date, len(boxes)),
+        "to_int" : (to_int, len(numbers)),
+        "format_novel_metric_string" : (format_metric_string, len(tables)),
+    }
+
+# ---------------------------------------------------------------------------- #
+
+def measure(func: Callable[[], Any], ops: int,
+            min_time: float=0.5, min_calls: int=20) -> Dict[str, float]:
+    """
+    Time `func` until both `min_time` seconds and `min_calls` calls
+    have passed. Latencies are per operation, i.e. per call / `ops`.
+    """
+    func() # warm up
+
+    gc.collect()
+    gc.disable()
+    try:
+        latencies = []
+        start = time.perf_counter()
+        while (len(latencies) < min_calls) or \
+            (time.perf_counter() - start < min_time):
+
+            t0 = time.perf_counter_ns()
+            func()
+            latencies.append((time.perf_counter_ns() - t0) / ops)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    pct = quantiles(latencies, n=100, method='inclusive')
+    total = sum(latencies)
+
+    return {
+        "ops" : ops * len(latencies),
+        "ops_per_sec" : 1e9 * len(latencies) / total,
+        "p50_us" : pct[49] / 1e3,
+        "p99_us" : pct[98] / 1e3,
+        "peak_mem_kb" : peak / 1024,
+    }
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            tolerance: float) -> List[str]:
+    """Return a message for every case that regressed past `baseline`"""
+
+    regressions = []
+    for name, ref in baseline.items():
+
+        if name not in results:
+            regressions.append(f"{name}: missing from results")
+            continue
+
+        res = results[name]
+
+        if res["ops_per_sec"] < ref["ops_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {res['ops_per_sec']:.0f} ops/s, "
+                f"baseline {ref['ops_per_sec']:.0f} ops/s"
+            )
+
+        max_mem = ref["peak_mem_kb"] * (1 + tolerance) + MEM_SLACK_KB
+        if res["peak_mem_kb"] > max_mem:
+            regressions.append(
+                f"{name}: {res['peak_mem_kb']:.1f} KiB peak, "
+                f"baseline {ref['peak_mem_kb']:.1f} KiB"
+            )
+
+    return regressions
+
+def format_table(results: Dict[str, dict]) -> str:
+    width = max(len(name) for name in results)
+    lines = [
+        f"{'case':<{width}}  {'ops/s':>12}  {'p50 us':>10}  "
+        f"{'p99 us':>10}  {'peak KiB':>10}"
+    ]
+    for name, res in results.items():
+        lines.append(
+            f"{name:<{width}}  {res['ops_per_sec']:>12.0f}  "
+            f"{res['p50_us']:>10.2f}  {res['p99_us']:>10.2f}  "
+            f"{res['peak_mem_kb']:>10.1f}"
+        )
+    return "\n".join(lines)
+
+# ---------------------------------------------------------------------------- #
+
+def main(argv: List[str]=None) -> int:
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default=OUTPUT,
+                        help="where to write the JSON results")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative regression")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="minimum seconds spent timing each case")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="overwrite the baseline with these results")
+    parser.add_argument("-k", dest="keyword", default='',
+                        help="only run cases whose name contains this")
+    args = parser.parse_args(argv)
+
+    # metric extraction logs every value it cannot convert
+    logging.disable(logging.CRITICAL)
+    try:
+        results = {
+            name : measure(func, ops, min_time=args.min_time)
+            for name, (func, ops) in build_cases().items()
+            if args.keyword in name
+        }
+    finally:
+        logging.disable(logging.NOTSET)
+
+    print(format_table(results))
+
+    report = {
+        "meta" : {
+            "timestamp" : datetime.now().isoformat(timespec='seconds'),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+        },
+        "results" : results,
+    }
+
+    out = args.baseline if args.update_baseline else args.output
+    with open(out, mode='w', encoding='utf8') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+
+    if args.update_baseline or not os.path.isfile(args.baseline):
+        return 0
+
+    with open(args.baseline, **FILE_OPTS) as file:
+        baseline = json.load(file)["results"]
+
+    if args.keyword:
+        baseline = {k: v for k, v in baseline.items() if args.keyword in k}
+
+    regressions = compare(results, baseline, args.tolerance)
+    for msg in regressions:
+        print(f"REGRESSION {msg}", file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import gzip
+import json
+import tempfile
+import unittest
+import subprocess
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from syosetu.archive import ArchiveWriter
+from syosetu.spiders.chapters import ChapterSpider, parse_chapter_text
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+def read_html(name: str) -> bytes:
+    with open(TESTPATH + name, mode='rb') as file:
+        return file.read()
+
+def respond(request: Request, body: bytes) -> HtmlResponse:
+    return HtmlResponse(
+        url=request.url, body=body, encoding='utf-8', request=request
+    )
+
+def read_chapters(path: str) -> list:
+    with gzip.open(path, mode='rt', encoding='utf8') as file:
+        return [json.loads(line) for line in file]
+
+# ---------------------------------------------------------------------------- #
+
+class ChapterSpiderTest(unittest.TestCase):
+
+    index = read_html("novel_index.html")
+    chapter = read_html("novel_chapter.html")
+
+    def make_spider(self, out_dir: str, **kwargs) -> ChapterSpider:
+        crawler = get_crawler(ChapterSpider)
+        spider = ChapterSpider.from_crawler(
+            crawler, ncodes="https://ncode.syosetu.com/n0001aa/",
+            out_dir=out_dir, **kwargs
+        )
+        crawler.spider = spider
+        return spider
+
+    def crawl_index(self, spider: ChapterSpider) -> list:
+        index_req, = spider.start_requests()
+        return list(index_req.callback(
+            respond(index_req, self.index), **index_req.cb_kwargs
+        ))
+
+    def answer(self, request: Request) -> list:
+        return list(request.callback(
+            respond(request, self.chapter), **request.cb_kwargs
+        ))
+
+    def test_parse_chapter_text(self):
+
+        req = Request("https://ncode.syosetu.com/n0001aa/1/")
+        chapter = parse_chapter_text(respond(req, self.chapter))
+
+        self.assertEqual(chapter["title"], "第1話　始まり")
+        self.assertEqual(
+            chapter["text"],
+            "　|魔法《まほう》の世界。\n\n「こんにちは」と|彼《かれ》は言った。"
+        )
+
+    def test_window_and_order(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            spider = self.make_spider(tmp, window=2)
+            pending = self.crawl_index(spider)
+
+            self.assertEqual(spider.ncodes, ["n0001aa"])
+            self.assertEqual([r.cb_kwargs["num"] for r in pending], [1, 2])
+
+            # chapter 2 arrives first and waits for chapter 1
+            self.assertEqual(self.answer(pending[1]), [])
+            self.assertEqual(spider.novels["n0001aa"].last, 0)
+
+            pending = self.answer(pending[0])
+            self.assertEqual([r.cb_kwargs["num"] for r in pending], [3, 4])
+
+            for req in pending:
+                pending.extend(self.answer(req))
+
+            path = os.path.join(tmp, "n0001aa.jsonl.gz")
+            chapters = read_chapters(path)
+
+            self.assertEqual([c["chapter"] for c in chapters], list(range(1, 7)))
+            self.assertEqual(chapters[0]["title"], "第1話　始まり")
+
+            with open(os.path.join(tmp, "n0001aa.checkpoint.json")) as file:
+                ckpt = json.load(file)
+
+            self.assertEqual(ckpt["chapter"], 6)
+            self.assertEqual(ckpt["offset"], os.path.getsize(path))
+            self.assertEqual(spider.crawler.stats.get_value('chapters/written'), 6)
+
+    def test_resume(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            spider = self.make_spider(tmp, window=3)
+            pending = self.crawl_index(spider)
+
+            # chapters 1 and 2 are written, chapter 3 is lost
+            self.answer(pending[0])
+            self.answer(pending[1])
+
+            path = os.path.join(tmp, "n0001aa.jsonl.gz")
+            size = os.path.getsize(path)
+
+            # an interrupted write leaves trailing garbage
+            with open(path, mode='ab') as file:
+                file.write(b"\x1f\x8b partial")
+
+            spider = self.make_spider(tmp, window=3)
+            pending = self.crawl_index(spider)
+
+            self.assertEqual(os.path.getsize(path), size)
+            self.assertEqual([r.cb_kwargs["num"] for r in pending], [3, 4, 5])
+
+            for req in pending:
+                pending.extend(self.answer(req))
+
+            chapters = read_chapters(path)
+            self.assertEqual([c["chapter"] for c in chapters], list(range(1, 7)))
+
+    def test_failed_chapter_is_retried(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            spider = self.make_spider(tmp, window=2)
+            pending = self.crawl_index(spider)
+
+            class Failure:
+                request = pending[0]
+                value = "404"
+
+            pending = list(spider.chapter_failed(Failure)) + pending[1:]
+            for req in pending:
+                pending.extend(self.answer(req))
+
+            path = os.path.join(tmp, "n0001aa.jsonl.gz")
+            chapters = read_chapters(path)
+            self.assertEqual([c["chapter"] for c in chapters], list(range(2, 7)))
+            self.assertEqual(spider.novels["n0001aa"].last, 6)
+
+            with open(os.path.join(tmp, "n0001aa.checkpoint.json")) as file:
+                self.assertEqual(json.load(file)["missing"], [1])
+
+            # a restarted crawl requests only the skipped chapter
+            spider = self.make_spider(tmp, window=2)
+            pending = self.crawl_index(spider)
+            self.assertEqual([r.cb_kwargs["num"] for r in pending], [1])
+            self.assertEqual(self.answer(pending[0]), [])
+
+            chapters = read_chapters(path)
+            self.assertEqual([c["chapter"] for c in chapters], [2, 3, 4, 5, 6, 1])
+            self.assertEqual(spider.novels["n0001aa"].missing, set())
+            self.assertEqual(spider.novels["n0001aa"].last, 6)
+
+            with open(os.path.join(tmp, "n0001aa.checkpoint.json")) as file:
+                ckpt = json.load(file)
+            self.assertEqual(ckpt["missing"], [])
+            self.assertEqual(ckpt["offset"], os.path.getsize(path))
+
+    def test_dropped_chapter_leaves_window(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            spider = self.make_spider(tmp, window=2)
+            scheduled = []
+            spider.crawler.engine = SimpleNamespace(crawl=scheduled.append)
+            pending = self.crawl_index(spider)
+
+            # chapter 1 was written in an earlier run the checkpoint missed
+            spider.chapter_dropped(pending[0])
+            self.assertEqual(spider.novels["n0001aa"].requested, [2, 3])
+            self.assertEqual([r.cb_kwargs["num"] for r in scheduled], [3])
+
+            # index pages and chapters no longer in flight are ignored
+            spider.chapter_dropped(pending[0])
+            spider.chapter_dropped(Request("https://ncode.syosetu.com/n0001aa/"))
+
+            pending = pending[1:] + scheduled
+            for req in pending:
+                pending.extend(self.answer(req))
+
+            chapters = read_chapters(os.path.join(tmp, "n0001aa.jsonl.gz"))
+            self.assertEqual([c["chapter"] for c in chapters], list(range(2, 7)))
+            self.assertEqual(spider.crawler.stats.get_value('chapters/dropped'), 1)
+
+            # and is requested again by a restarted crawl
+            self.assertEqual(spider.novels["n0001aa"].missing, {1})
+            spider = self.make_spider(tmp, window=2)
+            pending = self.crawl_index(spider)
+            self.assertEqual([r.cb_kwargs["num"] for r in pending], [1])
+
+    def test_crawl_resumes_missing_chapter(self):
+        """Two crawls, through the engine, from archives"""
+
+        index = "https://ncode.syosetu.com/n0001aa/"
+        html = [("Content-Type", "text/html; charset=utf-8")]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            out_dir = os.path.join(tmp, "chapters")
+
+            # chapter 3 is not found the first time
+            for run, skip in enumerate([{3}, set()]):
+                archive = os.path.join(tmp, f"crawl{run}.warc.gz")
+                writer = ArchiveWriter(archive)
+                writer.write(index, 200, html, self.index)
+                for i in set(range(1, 7)) - skip:
+                    writer.write(f"{index}{i}/", 200, html, self.chapter)
+                writer.close()
+
+                proc = subprocess.run(
+                    [sys.executable, "-m", "syosetu.archive", archive,
+                    ChapterSpider.name, "-a", f"ncodes={index}",
+                    "-a", f"out_dir={out_dir}", "-s", "LOG_LEVEL=ERROR"],
+                    cwd="./syosetu/", capture_output=True, text=True,
+                    timeout=120
+                )
+                self.assertEqual(proc.returncode, 0, proc.stderr)
+
+            self.assertIn("Replayed 2 pages", proc.stdout)
+
+            chapters = read_chapters(os.path.join(out_dir, "n0001aa.jsonl.gz"))
+            self.assertEqual([c["chapter"] for c in chapters], [1, 2, 4, 5, 6, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import logging
+import unittest
+import itertools
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from syosetu.dedup import (
+    LSHIndex, MinHasher, find_near_duplicates, jaccard, lsh_params,
+    near_duplicates, shingle_hashes
+)
+from syosetu.pipelines import NearDuplicatePipeline
+from syosetu.spiders.novels_spider import NovelSpider, get_search_order
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+SAMPLE = "./test/testing_data/northern_front_c1_sample1.txt"
+
+def read_items() -> list:
+    with open(TESTPATH + "search_results.html", mode='rb') as file:
+        response = HtmlResponse(
+            url=get_search_order("favnovelcnt") % 1, body=file.read(),
+            encoding='utf-8'
+        )
+
+    logging.disable(logging.CRITICAL)
+    try:
+        return list(NovelSpider().parse(response))
+    finally:
+        logging.disable(logging.NOTSET)
+
+def make_texts(n: int, planted: int, seed: int=0) -> list:
+    """
+    `n` texts of random 300 character pieces of the sample, and copies of
+    the first `planted` with two characters changed
+    """
+    with open(SAMPLE, mode='r', encoding='utf8') as file:
+        sample = file.read().strip()
+
+    rng = np.random.default_rng(seed)
+    texts = []
+    for start in rng.integers(0, len(sample) - 300, n):
+        texts.append(sample[start:start + 300])
+
+    for text in texts[:planted]:
+        chars = list(text)
+        for i in rng.integers(0, len(chars), 2):
+            chars[i] = "〇"
+        texts.append("".join(chars))
+    return texts
+
+# ---------------------------------------------------------------------------- #
+
+class MinHashTest(unittest.TestCase):
+
+    def test_estimates(self):
+        texts = make_texts(40, 20)
+        shingles = [shingle_hashes(t) for t in texts]
+        sigs = MinHasher().signatures(texts)
+
+        errors = [
+            abs((sigs[i] == sigs[j]).mean() - jaccard(shingles[i], shingles[j]))
+            for i, j in itertools.combinations(range(len(texts)), 2)
+        ]
+        self.assertLess(np.mean(errors), 0.03)
+        self.assertLess(max(errors), 0.2)
+
+        # one text at a time, or many
+        hasher = MinHasher()
+        self.assertTrue(np.array_equal(hasher.signature(texts[3]), sigs[3]))
+
+    def test_streamed_blocks(self):
+        # more texts than the first buffer, and one longer than a block
+        texts = make_texts(1500, 100, seed=2)
+        texts[700] = "".join(texts[:200])
+        hasher = MinHasher()
+
+        sigs = hasher.signatures(text for text in texts)
+        self.assertEqual(sigs.shape, (1600, 128))
+        for i in (0, 699, 700, 701, 1599):
+            self.assertTrue(np.array_equal(hasher.signature(texts[i]), sigs[i]))
+
+        # keys filled as the texts are read, as by `main`
+        keys = []
+        def docs():
+            for i, text in enumerate(texts):
+                keys.append(i)
+                yield text
+
+        found = find_near_duplicates(keys, docs(), threshold=0.8)
+        self.assertTrue({(i, 1500 + i) for i in range(100)} <= {(a, b) for a, b, _ in found})
+
+    def test_short_and_empty(self):
+        sigs = MinHasher().signatures(["", "。、", "魔", "魔法", "", "魔法"])
+        pairs, estimates = near_duplicates(sigs)
+        self.assertEqual(pairs.tolist(), [[3, 5]])
+        self.assertEqual(estimates.tolist(), [1.])
+
+        self.assertEqual(len(near_duplicates(sigs[:1])[0]), 0)
+
+    def test_lsh_params(self):
+        bands, rows = lsh_params(0.8, 128)
+        self.assertLessEqual(bands * rows, 128)
+        # the S-curve rises around the threshold
+        self.assertAlmostEqual((1 / bands)**(1 / rows), 0.8, delta=0.1)
+
+class NearDuplicatesTest(unittest.TestCase):
+
+    def test_same_as_brute_force(self):
+        texts = make_texts(400, 40)
+        shingles = [shingle_hashes(t) for t in texts]
+        exact = {
+            (i, j) : jaccard(shingles[i], shingles[j])
+            for i, j in itertools.combinations(range(len(texts)), 2)
+        }
+
+        found = find_near_duplicates(range(len(texts)), texts, threshold=0.8)
+        pairs = {(a, b) for a, b, _ in found}
+
+        # the planted copies, and nearly all pairs well above the threshold
+        self.assertTrue({(i, 400 + i) for i in range(40)} <= pairs)
+        for j, recall in ((0.9, 0.97), (0.95, 1.)):
+            similar = {pair for pair, jac in exact.items() if jac >= j}
+            self.assertGreaterEqual(len(similar & pairs) / len(similar), recall)
+        self.assertGreater(min(exact[pair] for pair in pairs), 0.6)
+
+        estimates = [j for _, _, j in found]
+        self.assertEqual(estimates, sorted(estimates, reverse=True))
+
+    def test_same_as_index(self):
+        texts = make_texts(500, 50, seed=1)
+        sigs = MinHasher().signatures(texts)
+        pairs, _ = near_duplicates(sigs, 0.8)
+
+        index = LSHIndex(0.8)
+        online = set()
+        for i, sig in enumerate(sigs):
+            online.update((j, i) for j, _ in index.query(sig))
+            index.add(i, sig)
+
+        self.assertEqual(online, set(map(tuple, pairs.tolist())))
+        self.assertEqual(len(index), 550)
+
+    def test_big_buckets(self):
+        texts = make_texts(50, 0) + ["同じ定型文のあらすじです"] * 200
+        pairs, _ = near_duplicates(MinHasher().signatures(texts))
+        # each copy with the first, not every pair of copies
+        copies = pairs[pairs[:, 1] >= 50]
+        self.assertEqual(len(copies), 199)
+        self.assertTrue((copies[:, 0] == 50).all())
+
+class NearDuplicatePipelineTest(unittest.TestCase):
+
+    def test_flagged(self):
+        items = read_items()
+        copies = []
+        for item in items[:3]:
+            copy = item.copy()
+            copy['ncode'] = "n9" + item['ncode'][2:]
+            copy['summary'] = item['summary'].replace("。", "！", 1) + "\n転載"
+            copies.append(copy)
+
+        crawler = get_crawler(NovelSpider, settings_dict={'DEDUP_THRESHOLD' : 0.7})
+        crawler.stats.open_spider()
+        pipeline = NearDuplicatePipeline.from_crawler(crawler)
+        pipeline.open_spider(None)
+
+        out = [pipeline.process_item(item, None) for item in items + copies + items[:1]]
+        self.assertFalse(any(item.get('near_duplicates') for item in out[:len(items)]))
+        self.assertEqual(
+            [item.get('near_duplicates') for item in out[len(items):]],
+            [[item['ncode']] for item in items[:3]] + [None]
+        )
+        self.assertEqual(crawler.stats.get_value('dedup/flagged'), 3)
+
+        crawler = get_crawler(NovelSpider)
+        with self.assertRaises(NotConfigured):
+            NearDuplicatePipeline.from_crawler(crawler)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.request import request_from_dict
+from scrapy.utils.test import get_crawler
+from syosetu.extensions import Histogram, ProfilingExtension
+from syosetu.spiders import novels_spider
+from syosetu.spiders.novels_spider import NovelSpider, FindNovelMetrics
+
+# ---------------------------------------------------------------------------- #
+
+class HistogramTest(unittest.TestCase):
+
+    def test_quantiles(self):
+        hist = Histogram()
+        for x in range(1, 101):
+            hist.add(x)
+
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.total, 5050)
+        self.assertEqual(hist.quantile(0.5), 51)
+        self.assertEqual(hist.quantile(0.99), 100)
+
+    def test_reservoir_is_bounded(self):
+        hist = Histogram(size=10)
+        for x in range(1000):
+            hist.add(x)
+
+        self.assertEqual(len(hist.sample), 10)
+        self.assertEqual(hist.count, 1000)
+        self.assertEqual(hist.max, 999)
+
+# ---------------------------------------------------------------------------- #
+
+class ProfilingExtensionTest(unittest.TestCase):
+
+    def make_ext(self, **settings):
+        settings = dict(PROFILING_ENABLED=True, **settings)
+        crawler = get_crawler(NovelSpider, settings_dict=settings)
+        spider = NovelSpider.from_crawler(crawler)
+        crawler.spider = spider
+        return ProfilingExtension.from_crawler(crawler), spider
+
+    def test_disabled(self):
+        crawler = get_crawler(NovelSpider)
+        with self.assertRaises(NotConfigured):
+            ProfilingExtension.from_crawler(crawler)
+
+    def test_callbacks_and_functions(self):
+        path = "syosetu.spiders.novels_spider.FindNovelMetrics.scan"
+        ext, spider = self.make_ext(
+            PROFILING_FUNCTIONS=[path], PROFILING_SAMPLE_RATE=1.0,
+            PROFILING_TRACEMALLOC=True
+        )
+        scan = FindNovelMetrics.scan
+        parse = vars(NovelSpider)["parse"]
+        ext.spider_opened(spider)
+
+        req = Request("https://yomou.syosetu.com/search.php?p=1")
+        response = HtmlResponse(url=req.url, body=b"<html></html>", request=req)
+        list(spider.parse(response))
+
+        # classmethods stay classmethods
+        FindNovelMetrics.scan("")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ext.report_path = os.path.join(tmp, "profile.json")
+            ext.spider_closed(spider, "finished")
+
+            with open(ext.report_path, encoding='utf8') as file:
+                report = json.load(file)
+
+        self.assertEqual(report["timers"]["callback"]["parse"]["count"], 1)
+        self.assertEqual(report["timers"]["function"][path]["count"], 1)
+        self.assertTrue(report["profile"])
+        self.assertIn("callback_alloc_peak", report["bytes"])
+
+        stats = spider.crawler.stats
+        self.assertEqual(stats.get_value("profile/callback/parse/count"), 1)
+        self.assertIsNotNone(stats.get_value("profile/callback/parse/p95_ms"))
+
+        # everything is put back on close
+        self.assertEqual(FindNovelMetrics.scan, scan)
+        self.assertIs(vars(NovelSpider)["parse"], parse)
+
+    def test_requests_serialise(self):
+        ext, spider = self.make_ext()
+        ext.spider_opened(spider)
+
+        # as the frontier and JOBDIR queues do
+        try:
+            req = Request("https://yomou.syosetu.com/search.php?p=1",
+                        callback=spider.parse, errback=spider._page_failed)
+            copy = request_from_dict(req.to_dict(spider=spider), spider=spider)
+        finally:
+            ext.spider_closed(spider, "finished")
+
+        self.assertEqual(copy.callback.__name__, "parse")
+        self.assertEqual(copy.errback, spider._page_failed)
+
+    def test_generator_time_excludes_consumer(self):
+        ext, spider = self.make_ext()
+
+        def gen():
+            yield 1
+            yield 2
+
+        timed = ext.timed("callback", "gen", gen)
+        self.assertEqual(list(timed()), [1, 2])
+        self.assertEqual(ext.timers[("callback", "gen")].count, 1)
+
+    def test_prometheus(self):
+        ext, spider = self.make_ext()
+        ext.timers[("callback", "parse")].add(0.5)
+
+        text = ext.to_prometheus(ext.report())
+
+        self.assertIn("# TYPE syosetu_profile_seconds summary", text)
+        self.assertIn(
+            'syosetu_profile_seconds{kind="callback",name="parse",quantile="0.5"} 0.5',
+            text
+        )
+        self.assertIn(
+            'syosetu_profile_seconds_count{kind="callback",name="parse"} 1', text
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import time
+import tempfile
+import unittest
+import subprocess
+
+import regex as re
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from syosetu.archive import ArchiveWriter
+from syosetu.frontier import Frontier, FrontierScheduler, frontier_settings
+from syosetu.middlewares import FrontierMiddleware
+from syosetu.spiders.novels_spider import NovelSpider, get_search_order
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+# ---------------------------------------------------------------------------- #
+
+class FrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "frontier.db")
+        self.frontier = Frontier(self.path, max_attempts=2)
+
+    def tearDown(self):
+        self.frontier.close()
+        self.tmp.cleanup()
+
+    def test_push_and_lease(self):
+        f = self.frontier
+
+        self.assertTrue(f.push("a", "url/a", b"a"))
+        self.assertTrue(f.push("b", "url/b", b"b", priority=5))
+        self.assertFalse(f.push("a", "url/a", b"a"))
+
+        # higher priority first, then first in, first out
+        self.assertEqual(f.lease("w1", 1), [("b", b"b")])
+        self.assertEqual(f.lease("w2", 5), [("a", b"a")])
+        self.assertEqual(f.lease("w2", 5), [])
+
+        # only the holder of a lease can acknowledge it
+        self.assertFalse(f.ack("b", "w2"))
+        self.assertTrue(f.ack("b", "w1"))
+        self.assertTrue(f.has_pending())
+
+        self.assertTrue(f.ack("a", "w2"))
+        self.assertFalse(f.has_pending())
+        self.assertEqual(f.counts()["done"], 2)
+
+        # done is remembered, unless forced
+        self.assertFalse(f.push("a", "url/a", b"a"))
+        self.assertTrue(f.push("a", "url/a", b"a2", force=True))
+        self.assertEqual(f.lease("w1", 1), [("a", b"a2")])
+
+    def test_forced_push_keeps_foreign_lease(self):
+        f = self.frontier
+        f.push("a", "url/a", b"a")
+        f.lease("w1", 1)
+
+        self.assertFalse(f.push("a", "url/a", b"a", force=True, worker="w2"))
+        self.assertTrue(f.push("a", "url/a", b"a", force=True, worker="w1"))
+        self.assertEqual(f.counts()["queued"], 1)
+
+    def test_expired_leases(self):
+        f = self.frontier
+        f.lease_seconds = 0.01
+        f.push("a", "url/a", b"a")
+
+        # a crashed worker never acknowledges its lease
+        f.lease("crashed", 1)
+        time.sleep(0.02)
+        self.assertEqual(f.requeue_expired(), 1)
+        self.assertEqual(f.lease("w2", 1), [("a", b"a")])
+
+        # and after `max_attempts` leases, the request fails
+        time.sleep(0.02)
+        f.requeue_expired()
+        self.assertEqual(f.counts()["failed"], 1)
+        self.assertFalse(f.has_pending())
+
+    def test_nack(self):
+        f = self.frontier
+        f.push("a", "url/a", b"a")
+
+        f.lease("w1", 1)
+        self.assertTrue(f.nack("a", "w1"))
+        self.assertEqual(f.counts()["queued"], 1)
+
+        f.lease("w1", 1)
+        self.assertTrue(f.nack("a", "w1"))
+        self.assertEqual(f.counts()["failed"], 1)
+
+    def test_new_run(self):
+        f = self.frontier
+        for key in "abc":
+            f.push(key, f"url/{key}", key.encode())
+        f.lease("w1", 2)
+        f.ack("a", "w1")
+        f.save_stats("w1", {"pages" : 1})
+
+        # done requests are queued again, the one still leased is kept
+        self.assertEqual(f.new_run(), 1)
+        self.assertEqual(f.merged_stats(), {})
+        self.assertTrue(f.push("a", "url/a", b"a"))
+        self.assertFalse(f.push("c", "url/c", b"c"))
+        self.assertEqual(f.counts(), {"queued" : 2, "leased" : 1, "done" : 0, "failed" : 0})
+
+    def test_merged_stats(self):
+        f = self.frontier
+        f.save_stats("w1", {"pages" : 3, "memusage/max" : 10, "reason" : "x"})
+        f.save_stats("w2", {"pages" : 4, "memusage/max" : 20})
+
+        self.assertEqual(f.merged_stats(), {"pages" : 7, "memusage/max" : 20})
+        self.assertEqual(f.workers(), ["w1", "w2"])
+
+# ---------------------------------------------------------------------------- #
+
+class FrontierSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "frontier.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_worker(self, worker: str):
+        settings = frontier_settings(self.path, worker)
+        settings.update(SQLITE_PATH=None)
+
+        crawler = get_crawler(NovelSpider, settings_dict=settings)
+        spider = NovelSpider.from_crawler(crawler, prefetch=1)
+        crawler.spider = spider
+
+        scheduler = FrontierScheduler.from_crawler(crawler)
+        scheduler.open(spider)
+        middleware = FrontierMiddleware.from_crawler(crawler)
+        return spider, scheduler, middleware
+
+    def test_middleware_needs_scheduler(self):
+        crawler = get_crawler(NovelSpider)
+        with self.assertRaises(NotConfigured):
+            FrontierMiddleware.from_crawler(crawler)
+
+    def test_workers_share_requests(self):
+        spider1, sched1, mw1 = self.make_worker("w1")
+        spider2, sched2, mw2 = self.make_worker("w2")
+
+        page, = spider1.start_requests()
+        self.assertTrue(sched1.enqueue_request(page))
+
+        # the second worker's copy is dropped, and not counted in flight
+        page2, = spider2.start_requests()
+        self.assertFalse(sched2.enqueue_request(page2))
+        spider2._page_dropped(page2, spider2)
+        self.assertEqual(spider2.streams["favnovelcnt"].in_flight, 0)
+
+        # whichever worker leases the page gets a working request
+        request = sched2.next_request()
+        self.assertIsNone(sched1.next_request())
+        self.assertEqual(request.url, page.url)
+        self.assertEqual(request.callback, spider2._parse)
+        self.assertEqual(request.cb_kwargs, page.cb_kwargs)
+
+        with open(TESTPATH + "search_results.html", mode='rb') as file:
+            response = HtmlResponse(
+                url=request.url, body=file.read(), encoding='utf-8',
+                request=request
+            )
+
+        out = list(mw2.process_spider_output(
+            response, spider2.parse_start_url(response, **request.cb_kwargs),
+            spider2
+        ))
+        next_page, = [o for o in out if isinstance(o, Request)]
+        self.assertEqual(next_page.cb_kwargs["page"], 2)
+        self.assertEqual(sched2.frontier.counts()["done"], 1)
+
+        # a retry of a leased request replaces it, a failure gives it back
+        self.assertTrue(sched2.enqueue_request(next_page))
+        request = sched1.next_request()
+        retry = request.replace(dont_filter=True)
+        self.assertTrue(sched1.enqueue_request(retry))
+        self.assertEqual(sched1.frontier.counts()["queued"], 1)
+
+        request = sched1.next_request()
+        mw1.process_exception(request, IOError("timeout"), spider1)
+        self.assertEqual(sched1.frontier.counts()["queued"], 1)
+
+        request = sched1.next_request()
+        mw1.process_exception(request, IgnoreRequest(), spider1)
+        self.assertFalse(sched1.has_pending_requests())
+
+        for worker in (sched1, sched2):
+            worker.close("finished")
+            worker.spider_closed(None, "finished")
+
+    def write_archive(self, orders: list) -> str:
+        """Three pages of 10 novels per order, then empty pages"""
+
+        with open(TESTPATH + "search_results.html", encoding='utf8') as file:
+            body = file.read()
+        empty = body[:body.index('<div class="searchkekka_box">')]
+
+        html = [("Content-Type", "text/html; charset=utf-8")]
+        archive = os.path.join(self.tmp.name, "crawl.warc.gz")
+        writer = ArchiveWriter(archive)
+
+        # every order finds its own novels
+        for i, order in enumerate(orders):
+            for page in range(1, 8):
+                offset = 10*(page - 1) + 30*i
+                text = re.sub(
+                    r"n(\d{4})aa",
+                    lambda m: f"n{int(m.group(1)) + offset:04d}aa", body
+                ) if page < 4 else empty
+                url = get_search_order(order) % page
+                writer.write(url, 200, html, text.encode('utf8'))
+        writer.close()
+        return archive
+
+    def crawl(self, archive: str, run: int, order: str="favnovelcnt"):
+        proc = subprocess.run(
+            [sys.executable, "-m", "syosetu.frontier", "crawl", "novels",
+            "--workers", "2", "--path", self.path, "--replay", archive,
+            "-a", f"order={order}",
+            "-a", "max_novel_cnt=0", "-a", "max_page_cnt=0", "-a", "prefetch=1",
+            "-s", f"SQLITE_PATH={self.tmp.name}/novels.db",
+            "-s", f"PARQUET_DIR={self.tmp.name}/output{run}",
+            "-s", "LOG_LEVEL=ERROR"],
+            cwd="./syosetu/", capture_output=True, text=True, timeout=120
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+
+        frontier = Frontier(self.path)
+        stats = frontier.merged_stats()
+        counts = frontier.counts()
+        workers = frontier.workers()
+        frontier.close()
+
+        self.assertEqual(len(workers), 2)
+        self.assertEqual(counts["queued"] + counts["leased"], 0)
+        self.assertEqual(counts["failed"], 0)
+        self.assertNotIn("novels/pending_dropped", stats)
+        return stats
+
+    def test_distributed_crawl(self):
+        """Two worker processes crawl a recorded archive"""
+
+        archive = self.write_archive(["favnovelcnt"])
+
+        # a second run crawls everything again
+        for run in range(2):
+            stats = self.crawl(archive, run)
+            self.assertEqual(stats["item_scraped_count"], 30)
+
+    def test_distributed_crawl_orders(self):
+        """Novels held for the rankings of all orders are not lost"""
+
+        archive = self.write_archive(["favnovelcnt", "hyoka"])
+        stats = self.crawl(archive, 0, order="favnovelcnt,hyoka")
+        self.assertEqual(stats["item_scraped_count"], 60)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# Copyright (c) 2022 Delbert Yip
+# 
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys 
+import os 
+import tempfile
+import unittest 
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.core.downloader import Slot
+from scrapy.utils.test import get_crawler
+import syosetu.spiders.novels_spider as nspider
+from syosetu.middlewares import SyosetuDownloaderMiddleware
+from syosetu.middlewares import AdaptiveConcurrencyMiddleware
+
+# ---------------------------------------------------------------------------- #
+
+SEARCH_URL = nspider.get_search_order("favnovelcnt") % 1
+CHAPTER_URL = "https://ncode.syosetu.com/n0001aa/1/"
+
+class CacheMiddlewareTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.crawler = get_crawler(nspider.NovelSpider, {
+            'SYOSETU_CACHE_ENABLED' : True,
+            'SYOSETU_CACHE_DIR' : self.tmp.name,
+            'SYOSETU_CACHE_POLICY' : [
+                (r"yomou\.syosetu\.com/search", 0), 
+                (r"ncode\.syosetu\.com/n\d{4}[a-z]{2}/\d+/?$", 3600),
+            ],
+        })
+        self.spider = nspider.NovelSpider.from_crawler(self.crawler)
+        self.mw = SyosetuDownloaderMiddleware.from_crawler(self.crawler)
+    
+    def tearDown(self):
+        self.mw.spider_closed(self.spider)
+        self.tmp.cleanup()
+    
+    def _stat(self, name: str) -> int:
+        return self.crawler.stats.get_value(f"syosetu_cache/{name}", 0)
+    
+    def _fetch(self, url: str, body: bytes, status: int=200, headers=None):
+        """Run a request through the middleware with a fake download"""
+        
+        request = Request(url)
+        res = self.mw.process_request(request, self.spider)
+        
+        if res is None:
+            res = HtmlResponse(
+                url=url, status=status, body=body, 
+                headers=headers or {}, request=request
+            )
+        
+        return request, self.mw.process_response(request, res, self.spider)
+    
+    def test_fresh_hit(self):
+        
+        body = "<html>第一話</html>".encode('utf8')
+        _, first = self._fetch(CHAPTER_URL, body)
+        request, second = self._fetch(CHAPTER_URL, b'', status=500)
+        
+        self.assertIn('cached', second.flags)
+        self.assertEqual(second.body, body)
+        self.assertEqual(self._stat('miss'), 1)
+        self.assertEqual(self._stat('hit'), 1)
+        self.assertEqual(self._stat('bytes_saved'), len(body))
+    
+    def test_revalidate_stale(self):
+        
+        body = b"<html>results</html>"
+        headers = {
+            'ETag' : '"abc"', 
+            'Last-Modified' : 'Mon, 03 Jan 2022 00:00:00 GMT'
+        }
+        self._fetch(SEARCH_URL, body, headers=headers)
+        
+        # search pages are stale at once, so they are revalidated 
+        request, response = self._fetch(SEARCH_URL, b'', status=304)
+        
+        self.assertEqual(request.headers.get('If-None-Match'), b'"abc"')
+        self.assertEqual(
+            request.headers.get('If-Modified-Since'), 
+            b'Mon, 03 Jan 2022 00:00:00 GMT'
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, body)
+        self.assertEqual(self._stat('revalidated'), 1)
+        self.assertEqual(self._stat('bytes_saved'), len(body))
+        
+        # a changed page replaces the cached one 
+        self._fetch(SEARCH_URL, b"<html>new</html>")
+        _, response = self._fetch(SEARCH_URL, b'', status=304)
+        self.assertEqual(response.body, b"<html>new</html>")
+    
+    def test_identical_bodies_stored_once(self):
+        
+        body = b"<html>same</html>"
+        self._fetch(CHAPTER_URL, body)
+        self._fetch("https://ncode.syosetu.com/n0001aa/2/", body)
+        
+        blobs = [f for _, _, files in os.walk(self.mw.blob_dir) for f in files]
+        self.assertEqual(len(blobs), 1)
+    
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    
+    HOST = "ncode.syosetu.com"
+    
+    def setUp(self):
+        self.crawler = get_crawler(nspider.NovelSpider, {
+            'ADAPTIVE_CONCURRENCY_ENABLED' : True,
+            'ADAPTIVE_TARGET_LATENCY' : 1.0,
+            'ADAPTIVE_START_CONCURRENCY' : 2,
+            'ADAPTIVE_MAX_CONCURRENCY' : 4,
+        })
+        self.slot = Slot(concurrency=8, delay=0.0)
+        self.crawler.engine = SimpleNamespace(
+            downloader=SimpleNamespace(slots={self.HOST: self.slot})
+        )
+        
+        self.spider = nspider.NovelSpider.from_crawler(self.crawler)
+        self.mw = AdaptiveConcurrencyMiddleware.from_crawler(self.crawler)
+        self.mw.spider_opened(self.spider)
+    
+    def _respond(self, latency: float, status: int=200, host: str=HOST):
+        request = Request(f"https://{host}/n0001aa/", meta={
+            'download_slot' : host, 'download_latency' : latency
+        })
+        response = HtmlResponse(url=request.url, status=status, body=b'')
+        return self.mw.process_response(request, response, self.spider)
+    
+    def test_additive_increase(self):
+        
+        for _ in range(2 + 3 + 4 + 10):
+            self._respond(0.2)
+        
+        self.assertEqual(self.slot.concurrency, 4)
+        self.assertEqual(self.slot.delay, 0.0)
+        self.assertEqual(
+            self.crawler.stats.get_value(f"adaptive/{self.HOST}/concurrency"), 4
+        )
+    
+    def test_multiplicative_decrease(self):
+        
+        for _ in range(2 + 3):
+            self._respond(0.2)
+        self.assertEqual(self.slot.concurrency, 4)
+        
+        # in-flight responses of the same event only decrease once 
+        for _ in range(3):
+            self._respond(0.2, status=429)
+        
+        self.assertEqual(self.slot.concurrency, 2)
+        self.assertGreater(self.slot.delay, 0)
+        self.assertEqual(
+            self.crawler.stats.get_value(f"adaptive/{self.HOST}/throttled"), 3
+        )
+    
+    def test_untracked_host(self):
+        
+        slot = Slot(concurrency=8, delay=0.0)
+        self.crawler.engine.downloader.slots["example.com"] = slot
+        
+        for _ in range(5):
+            self._respond(5.0, status=503, host="example.com")
+        
+        self.assertEqual(slot.concurrency, 8)
+        self.assertEqual(self.mw.hosts, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,22 @@
 import sys 
 import os 
+import tempfile
 import unittest 
+import subprocess
 
 import pandas as pd 
+import regex as re 
 
 from typing import List
 from ast import literal_eval
 
 sys.path.insert(0, os.path.abspath("./syosetu/"))
+import scrapy 
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.python.failure import Failure
+from syosetu.archive import ArchiveWriter
 import syosetu.spiders.novels_spider as nspider
 
 
@@ -83,6 +92,298 @@ class MetricFinderTest(unittest.TestCase):
                         self.assertListOfTuplesEqual(val, actual)
                     else:
                         self.assertEqual(ref.loc[col], val)            
+    
+    def test_scanner_matches_per_metric(self):
+        
+        for i in range(1, 11):
+            
+            with self.subTest(suffix=i):
+                data = self._readFile(i)
+                self.finder.replace_data(data)
+                
+                expected = self.finder._findPerMetric()
+                actual = nspider.FindNovelMetrics.scan(data)
+                
+                self.assertEqual(list(expected), list(actual))
+                self.assertEqual(expected, actual)
+                
+                # a missing date is reported under the same key
+                data = re.sub(r"最終更新日.{17}", "", data)
+                self.finder.replace_data(data)
+                
+                expected = self.finder._findPerMetric()
+                actual = nspider.FindNovelMetrics.scan(data)
+                
+                self.assertIsNone(actual['dates'])
+                self.assertEqual(expected, actual)
+    
+    def test_find_many(self):
+        
+        texts = [self._readFile(i) for i in range(1, 11)] * 5
+        expected = [nspider.FindNovelMetrics.scan(t) for t in texts]
+        
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                actual = nspider.FindNovelMetrics.find_many(
+                    iter(texts), workers=workers, chunksize=3
+                )
+                self.assertEqual(expected, list(actual))
+    
+    def test_instances_do_not_share_data(self):
+        
+        a = nspider.FindNovelMetrics(self._readFile(1))
+        b = nspider.FindNovelMetrics(self._readFile(2))
+        a.find()
+        
+        self.assertTrue(a.data)
+        self.assertEqual(b.data, dict())
+    
+class NovelSpiderTest(unittest.TestCase):
+    TESTPATH = MetricFinderTest.TESTPATH
+    TRUEVALS = MetricFinderTest.TRUEVALS
+    
+    def _readResponse(self) -> HtmlResponse:
+        """Saved search results page with one box per `_testtxt` file"""
+        
+        with open(self.TESTPATH + "/search_results.html", mode='rb') as file:
+            body = file.read()
+        
+        return HtmlResponse(
+            url=nspider.get_search_order("favnovelcnt") % 1,
+            body=body, encoding='utf-8'
+        )
+    
+    def test_parse_search_results(self):
+        
+        spider = nspider.NovelSpider()
+        items = list(spider.parse(self._readResponse()))
+        self.assertEqual(len(items), 10)
+        
+        for i, item in enumerate(items, start=1):
+            
+            with self.subTest(suffix=i):
+                ref = self.TRUEVALS.loc[i, :]
+                
+                for col in nspider.NOVEL_METRIC_FIELDS:
+                    self.assertEqual(ref.loc[col], item[col])
+                
+                self.assertEqual(
+                    ref.loc['most_recent_update'], item['most_recent_update']
+                )
+                self.assertEqual(
+                    ref.loc['keywords'].split(), item['keywords']
+                )
+                self.assertEqual(
+                    item['url'], f"https://ncode.syosetu.com/n{i:04d}aa/"
+                )
+    
+    def test_lxml_box_parser(self):
+        
+        response = self._readResponse()
+        expected = nspider.NovelSpider().parse(response)
+        actual = nspider.NovelSpider(box_parser='lxml').parse(response)
+        
+        self.assertEqual(
+            [dict(item) for item in expected], 
+            [dict(item) for item in actual]
+        )
+    
+    def _searchPage(self, request, offset: int=0, empty=False) -> HtmlResponse:
+        """Saved search results, with ncodes shifted by `offset`"""
+        
+        body = self._readResponse().text 
+        if empty:
+            body = body[:body.index('<div class="searchkekka_box">')]
+        
+        body = re.sub(
+            r"n(\d{4})aa", lambda m: f"n{int(m.group(1)) + offset:04d}aa", body
+        )
+        return HtmlResponse(
+            url=request.url, body=body, encoding='utf-8', request=request
+        )
+    
+    def _pageSpider(self, **kwargs) -> nspider.NovelSpider:
+        crawler = get_crawler(nspider.NovelSpider)
+        return nspider.NovelSpider.from_crawler(crawler, **kwargs)
+    
+    def test_pagination_stops_at_quota(self):
+        
+        spider = self._pageSpider(max_novel_cnt=15, max_page_cnt=0, prefetch=2)
+        
+        pages = list(spider.start_requests())
+        self.assertEqual([r.cb_kwargs['page'] for r in pages], [1, 2])
+        
+        out = list(spider.parse_start_url(
+            self._searchPage(pages[0]), **pages[0].cb_kwargs
+        ))
+        items = [o for o in out if not isinstance(o, scrapy.Request)]
+        requests = [o for o in out if isinstance(o, scrapy.Request)]
+        
+        self.assertEqual(len(items), 10)
+        self.assertEqual([r.cb_kwargs['page'] for r in requests], [3])
+        
+        # page 2 repeats 5 novels of page 1 
+        out = list(spider.parse_start_url(
+            self._searchPage(pages[1], offset=5), **pages[1].cb_kwargs
+        ))
+        
+        self.assertEqual(len(out), 5)
+        self.assertEqual(len(spider.emitted), 15)
+        self.assertTrue(spider.pages_done)
+        self.assertEqual(spider.crawler.stats.get_value('novels/duplicate'), 5)
+        
+        # the prefetched page 3 adds nothing 
+        out = list(spider.parse_start_url(
+            self._searchPage(requests[0], offset=100), **requests[0].cb_kwargs
+        ))
+        self.assertEqual(out, [])
+        
+        # only emitted novels are followed 
+        req = scrapy.Request("https://ncode.syosetu.com/n0001aa/")
+        self.assertIs(spider._filter_novel_request(req, None), req)
+        req = scrapy.Request("https://ncode.syosetu.com/n0101aa/")
+        self.assertIsNone(spider._filter_novel_request(req, None))
+    
+    def test_pagination_stops_at_empty_page(self):
+        
+        spider = self._pageSpider(max_novel_cnt=0, max_page_cnt=0, prefetch=1)
+        
+        page, = spider.start_requests()
+        for i in range(3):
+            out = list(spider.parse_start_url(
+                self._searchPage(page, offset=10*i), **page.cb_kwargs
+            ))
+            page, = [o for o in out if isinstance(o, scrapy.Request)]
+            self.assertEqual(page.cb_kwargs['page'], i + 2)
+        
+        out = list(spider.parse_start_url(
+            self._searchPage(page, empty=True), **page.cb_kwargs
+        ))
+        self.assertEqual(out, [])
+        self.assertEqual(len(spider.emitted), 30)
+    
+    def test_pagination_max_pages(self):
+        
+        spider = self._pageSpider(max_page_cnt=1, prefetch=3)
+        
+        page, = spider.start_requests()
+        out = list(spider.parse_start_url(
+            self._searchPage(page), **page.cb_kwargs
+        ))
+        self.assertEqual(len(out), 10)
+        self.assertTrue(spider.pages_done)
+    
+    def test_multiple_orders(self):
+        
+        spider = self._pageSpider(
+            order="weekly, favnovelcnt", max_page_cnt=1, prefetch=1
+        )
+        
+        weekly, fav = spider.start_requests()
+        self.assertEqual(weekly.cb_kwargs, dict(order='weekly', page=1))
+        self.assertEqual(fav.cb_kwargs, dict(order='favnovelcnt', page=1))
+        self.assertIn("order=weekly", weekly.url)
+        
+        # held until the other order is done 
+        out = list(spider.parse_start_url(
+            self._searchPage(weekly), **weekly.cb_kwargs
+        ))
+        self.assertEqual(out, [])
+        
+        # 5 novels of the second order were already parsed 
+        out = list(spider.parse_start_url(
+            self._searchPage(fav, offset=5), **fav.cb_kwargs
+        ))
+        self.assertEqual(len(out), 15)
+        self.assertEqual(len({item['ncode'] for item in out}), 15)
+        
+        items = {item['ncode'] : item for item in out}
+        self.assertEqual(items['n0001aa']['rankings'], {'weekly' : 1})
+        self.assertEqual(
+            items['n0006aa']['rankings'], {'weekly' : 6, 'favnovelcnt' : 1}
+        )
+        self.assertEqual(items['n0015aa']['rankings'], {'favnovelcnt' : 10})
+        
+        # each novel page is requested once 
+        req = scrapy.Request("https://ncode.syosetu.com/n0006aa/")
+        self.assertIs(spider._filter_novel_request(req, None), req)
+        self.assertIsNone(spider._filter_novel_request(req.copy(), None))
+    
+    def test_failed_page_stops_order(self):
+        
+        spider = self._pageSpider(max_novel_cnt=0, max_page_cnt=0, prefetch=2)
+        
+        first, second = spider.start_requests()
+        response = HtmlResponse(url=second.url, status=404, request=second)
+        
+        failure = Failure(HttpError(response))
+        failure.request = second 
+        self.assertEqual(list(spider._page_failed(failure)), [])
+        self.assertTrue(spider.streams['favnovelcnt'].done)
+        self.assertEqual(
+            spider.crawler.stats.get_value('novels/search_failed'), 1
+        )
+        
+        # the page still in flight is parsed 
+        out = list(spider.parse_start_url(
+            self._searchPage(first), **first.cb_kwargs
+        ))
+        self.assertEqual(len(out), 10)
+    
+    def test_crawl_ends_at_missing_page(self):
+        """A crawl, through the engine, without a page limit"""
+        
+        with open("./syosetu/tests/data/search_results.html", **FILE_OPTS) as file:
+            body = file.read()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            # two pages of results, the third is not found 
+            archive = os.path.join(tmp, "crawl.warc.gz")
+            writer = ArchiveWriter(archive)
+            for page in range(1, 3):
+                text = re.sub(
+                    r"n(\d{4})aa",
+                    lambda m: f"n{int(m.group(1)) + 10*(page - 1):04d}aa", body
+                )
+                writer.write(
+                    nspider.get_search_order("favnovelcnt") % page, 200,
+                    [("Content-Type", "text/html; charset=utf-8")],
+                    text.encode('utf8')
+                )
+            writer.close()
+            
+            proc = subprocess.run(
+                [sys.executable, "-m", "syosetu.archive", archive, 
+                nspider.NovelSpider.name, 
+                "-a", "max_novel_cnt=0", "-a", "max_page_cnt=0", 
+                "-s", "LOG_LEVEL=ERROR",
+                "-s", f"SQLITE_PATH={tmp}/novels.db",
+                "-s", f"PARQUET_DIR={tmp}/output"],
+                cwd="./syosetu/", capture_output=True, text=True, timeout=120
+            )
+        
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn("scraped 20 items", proc.stdout)
+    
+    def test_pending_at_close(self):
+        
+        spider = self._pageSpider(
+            order="weekly, favnovelcnt", max_page_cnt=1, prefetch=1
+        )
+        weekly, fav = spider.start_requests()
+        list(spider.parse_start_url(self._searchPage(weekly), **weekly.cb_kwargs))
+        
+        # closed early, e.g. by CLOSESPIDER_TIMEOUT 
+        with self.assertLogs(spider.logger.logger, level='WARNING'):
+            spider._spider_closed(spider, 'closespider_timeout')
+        self.assertEqual(
+            spider.crawler.stats.get_value('novels/pending_dropped'), 10
+        )
+    
+    def test_order_list(self):
+        spider = nspider.NovelSpider(order=['weekly', 'hyoka'], prefetch=3)
+        self.assertEqual(list(spider.streams), ['weekly', 'hyoka'])
+        self.assertEqual(len(spider.start_urls), 6)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+# Copyright (c) 2022 Delbert Yip
+# 
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys 
+import os 
+import logging
+import sqlite3
+import tempfile
+import unittest 
+
+from datetime import timedelta
+
+import pandas as pd 
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+import syosetu.spiders.novels_spider as nspider
+import syosetu.pipelines as pipelines
+from syosetu.store import NovelStore
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+def read_response() -> HtmlResponse:
+    """Saved search results page"""
+    
+    with open(TESTPATH + "search_results.html", mode='rb') as file:
+        body = file.read()
+    
+    return HtmlResponse(
+        url=nspider.get_search_order("favnovelcnt") % 1,
+        body=body, encoding='utf-8'
+    )
+
+def read_items(spider: nspider.NovelSpider=None) -> list:
+    """`Novel` items of the saved search results page"""
+    
+    spider = nspider.NovelSpider() if spider is None else spider
+    
+    logging.disable(logging.CRITICAL)
+    try:
+        return list(spider.parse(read_response()))
+    finally:
+        logging.disable(logging.NOTSET)
+
+# ---------------------------------------------------------------------------- #
+
+@unittest.skipIf(pipelines.pa is None, "requires pyarrow")
+class ParquetPipelineTest(unittest.TestCase):
+    
+    items = read_items()
+    
+    def test_row_groups(self):
+        
+        spider = nspider.NovelSpider()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            pipe = pipelines.ParquetPipeline(tmp, max_rows=4)
+            pipe.open_spider(spider)
+            
+            for item in self.items:
+                self.assertIs(pipe.process_item(item, spider), item)
+            
+            pipe.close_spider(spider)
+            
+            meta = pipelines.pq.ParquetFile(pipe.path).metadata
+            self.assertEqual(meta.num_row_groups, 3)
+            self.assertEqual(meta.num_rows, len(self.items))
+            
+            df = pd.read_parquet(pipe.path)
+        
+        self.assertEqual(str(df['word_cnt'].dtype), 'int32')
+        self.assertTrue(
+            pd.api.types.is_datetime64_any_dtype(df['most_recent_update'])
+        )
+        
+        for i, item in enumerate(self.items):
+            row = df.iloc[i]
+            for col in nspider.NOVEL_METRIC_FIELDS:
+                self.assertEqual(item[col], row[col])
+            
+            self.assertEqual(item['keywords'], list(row['keywords']))
+            self.assertEqual(
+                item['most_recent_update'], 
+                row['most_recent_update'].to_pydatetime()
+            )
+    
+    def test_flush_by_bytes(self):
+        
+        spider = nspider.NovelSpider()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            pipe = pipelines.ParquetPipeline(tmp, max_bytes=1)
+            pipe.open_spider(spider)
+            
+            for item in self.items:
+                pipe.process_item(item, spider)
+                self.assertEqual(pipe.rows, 0)
+            
+            pipe.close_spider(spider)
+            meta = pipelines.pq.ParquetFile(pipe.path).metadata
+        
+        self.assertEqual(meta.num_row_groups, len(self.items))
+    
+class SqlitePipelineTest(unittest.TestCase):
+    
+    items = read_items()
+    
+    def test_upsert(self):
+        
+        spider = nspider.NovelSpider()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "novels.db")
+            
+            pipe = pipelines.SqlitePipeline(path, batch_size=4)
+            pipe.open_spider(spider)
+            for item in self.items:
+                pipe.process_item(item, spider)
+            pipe.close_spider(spider)
+            
+            # a later crawl sees one novel updated 
+            updated = self.items[0].copy()
+            updated['bookmark_cnt'] += 1 
+            updated['most_recent_update'] += timedelta(days=1)
+            updated['rankings'] = {'weekly' : 3, 'hyoka' : 41}
+            
+            pipe.open_spider(spider)
+            pipe.process_item(updated, spider)
+            pipe.close_spider(spider)
+            
+            store = NovelStore(path)
+            ncodes = [item['ncode'] for item in self.items]
+            rows = {row['ncode']: row for row in store.load(ncodes)}
+            
+            self.assertEqual(len(rows), len(self.items))
+            self.assertEqual(
+                rows[updated['ncode']]['bookmark_cnt'], updated['bookmark_cnt']
+            )
+            self.assertEqual(
+                rows[updated['ncode']]['most_recent_update'], 
+                updated['most_recent_update']
+            )
+            self.assertEqual(rows[ncodes[1]]['keywords'], self.items[1]['keywords'])
+            self.assertEqual(
+                rows[updated['ncode']]['rankings'], updated['rankings']
+            )
+            
+            self.assertFalse(store.is_unchanged(
+                ncodes[0], self.items[0]['most_recent_update']
+            ))
+            self.assertTrue(store.is_unchanged(
+                ncodes[1], self.items[1]['most_recent_update']
+            ))
+            store.close()
+    
+    def test_add_missing_columns(self):
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "novels.db")
+            
+            # a database from before `rankings` was stored 
+            conn = sqlite3.connect(path)
+            conn.execute(
+                "CREATE TABLE novels (ncode TEXT PRIMARY KEY, title TEXT)"
+            )
+            conn.close()
+            
+            store = NovelStore(path)
+            store.upsert_many(self.items[:1])
+            row, = store.load([self.items[0]['ncode']])
+            store.close()
+        
+        self.assertEqual(row['title'], self.items[0]['title'])
+        self.assertIsNone(row['rankings'])
+    
+    def test_skip_unchanged(self):
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "novels.db")
+            
+            store = NovelStore(path)
+            store.upsert_many(self.items[:3])
+            store.close()
+            
+            crawler = get_crawler(nspider.NovelSpider, {
+                'SQLITE_PATH' : path, 'SYOSETU_SKIP_UNCHANGED' : True
+            })
+            spider = nspider.NovelSpider.from_crawler(crawler)
+            read_items(spider)
+            
+            for i, item in enumerate(self.items):
+                request = Request(item['url'])
+                res = spider._skip_unchanged(request, read_response())
+                
+                if i < 3:
+                    self.assertIsNone(res)
+                else:
+                    self.assertIs(res, request)
+            
+            spider.store.close()
+        
+        self.assertEqual(crawler.stats.get_value('novels/unchanged_skipped'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import gc
+import unittest
+import tracemalloc
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy.http import HtmlResponse
+from syosetu.records import NovelRecord, NovelTable, KEYWORDS, MISSING
+from syosetu.spiders.novels_spider import Novel, NovelSpider, NOVEL_METRIC_FIELDS
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+def parse_search_results():
+    with open(TESTPATH + "search_results.html", mode='rb') as file:
+        response = HtmlResponse(
+            url="https://yomou.syosetu.com/search.php", body=file.read(),
+            encoding='utf-8'
+        )
+    return list(NovelSpider().parse(response))
+
+def synthetic_novels(n: int):
+    """`n` novels shaped like search results, with distinct text"""
+    genres = ["ハイファンタジー〔ファンタジー〕", "異世界〔恋愛〕", "現実世界〔恋愛〕"]
+    tags = ["異世界転生", "チート", "ハーレム", "ざまぁ", "恋愛", "R15", "残酷な描写あり"]
+
+    for i in range(n):
+        yield Novel(
+            ncode=f"n{i:04d}aa", title=f"タイトル{i}", author=f"作者{i % 500}",
+            genre=genres[i % 3], summary=f"あらすじ{i}",
+            url=f"https://ncode.syosetu.com/n{i:04d}aa/",
+            keywords=[tags[(i + j) % len(tags)] for j in range(5)],
+            most_recent_update=datetime(2022, 1, 1 + i % 28, 12, i % 60),
+            **{name: i * 7 + k for k, name in enumerate(NOVEL_METRIC_FIELDS)}
+        )
+
+def allocated(build) -> int:
+    """Bytes still allocated by the result of `build`"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+# ---------------------------------------------------------------------------- #
+
+class NovelRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.novels = parse_search_results()
+
+    def test_roundtrip(self):
+        self.assertEqual(len(self.novels), 10)
+
+        for novel in self.novels:
+            record = NovelRecord.from_item(novel)
+            self.assertIsNone(record.url)
+            self.assertIsInstance(record.genre, int)
+            self.assertEqual(dict(record.to_item()), dict(novel))
+
+    def test_missing_and_interned(self):
+        novel = Novel(
+            ncode="n0001aa", title="t", author="a", genre=None, summary="s",
+            url="https://example.com/n0001aa", keywords=["異世" + "界"],
+            most_recent_update=None, rankings={"hyoka" : 3},
+            **{name: None for name in NOVEL_METRIC_FIELDS}
+        )
+        record = NovelRecord.from_item(novel)
+
+        self.assertEqual(record.word_cnt, MISSING)
+        self.assertEqual(record.url, "https://example.com/n0001aa")
+        self.assertIs(KEYWORDS[record.keywords[0]], sys.intern("異世界"))
+        self.assertEqual(dict(record.to_item()), dict(novel))
+
+    def test_near_duplicates(self):
+        novel = self.novels[1]
+        novel['near_duplicates'] = [self.novels[0]['ncode']]
+
+        record = NovelRecord.from_item(novel)
+        self.assertEqual(record.near_duplicates, [self.novels[0]['ncode']])
+        self.assertEqual(dict(record.to_item()), dict(novel))
+
+        table = NovelTable.from_items(self.novels)
+        self.assertEqual([dict(n) for n in table], [dict(n) for n in self.novels])
+        self.assertNotIn('near_duplicates', table.item(0))
+
+class NovelTableTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        novels = parse_search_results()
+        table = NovelTable(capacity=2)
+        table.extend(novels)
+
+        self.assertEqual(len(table), 10)
+        self.assertEqual([dict(n) for n in table], [dict(n) for n in novels])
+        self.assertEqual(
+            table.metric('word_cnt').tolist(), [n['word_cnt'] for n in novels]
+        )
+        self.assertEqual(table.record(0), NovelRecord.from_item(novels[0]))
+
+        df = table.to_frame()
+        self.assertEqual(list(df.index), [n['ncode'] for n in novels])
+        self.assertEqual(
+            list(df['genre'].astype(str)), [n['genre'] for n in novels]
+        )
+
+    def test_memory(self):
+        n = 20_000
+        items = allocated(lambda: list(synthetic_novels(n)))
+        table = allocated(lambda: NovelTable.from_items(synthetic_novels(n)))
+        self.assertLess(table * 4, items)
+
+        # most of what remains is the titles and summaries
+        def without_text():
+            for novel in synthetic_novels(n):
+                novel['title'] = novel['summary'] = None
+                yield novel
+
+        items = allocated(lambda: list(without_text()))
+        table = allocated(lambda: NovelTable.from_items(without_text()))
+        self.assertLess(table * 8, items)
+
+if __name__ == '__main__':
+    unittest.main()
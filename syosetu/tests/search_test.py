@@ -0,0 +1,217 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import json
+import gzip
+import timeit
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from syosetu.search import (
+    SUMMARY_CHAPTER, SearchIndex, _decode_varints, _encode_varints,
+    index_chapters, index_summaries
+)
+from syosetu.store import NovelStore
+from syosetu.text import normalize
+
+# ---------------------------------------------------------------------------- #
+SAMPLES = [
+    "./test/testing_data/northern_front_c1_sample1.txt",
+    "./test/testing_data/northern_front_c1_sample2_with_punctuation.txt",
+]
+
+def sample_lines() -> list:
+    """Sentences of the samples, or 40 characters of one without periods"""
+    lines = []
+    for path in SAMPLES:
+        with open(path, mode='r', encoding='utf8') as file:
+            text = file.read()
+        for line in text.replace("。", "。\n").splitlines():
+            lines.extend(line[i:i + 40] for i in range(0, len(line), 40))
+    return [line for line in lines if len(line.strip()) > 10]
+
+def make_docs(n: int, seed: int=0) -> list:
+    """(ncode, chapter, text) of `n` chapters of random sample lines"""
+    lines = sample_lines()
+    rng = np.random.default_rng(seed)
+    return [
+        (f"n{i // 20:04d}aa", i % 20 + 1,
+        "\n".join(lines[j] for j in rng.integers(0, len(lines), 8)))
+        for i in range(n)
+    ]
+
+def brute_force(docs: list, query: str) -> set:
+    """Documents with every bigram of `query`"""
+    q = normalize(query).lower()
+    grams = {q[i:i + 2] for i in range(len(q) - 1)}
+    found = set()
+    for ncode, chapter, text in docs:
+        t = normalize(text, collapse=True).lower()
+        if all(g in t for g in grams):
+            found.add((ncode, chapter))
+    return found
+
+QUERIES = ["ジークリンデ", "彼女", "リツハルド", "魔法使い", "ＡＢ"]
+
+# ---------------------------------------------------------------------------- #
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "index")
+        self.docs = make_docs(300)
+
+        # queries from the text itself, so they have hits
+        lines = sample_lines()
+        self.queries = QUERIES + [lines[3][2:6], lines[10][:3], lines[20][5:12]]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def hits(self, index: SearchIndex, query: str, **kwargs) -> set:
+        return {(n, c) for n, c, _ in index.search(query, top=10**6, **kwargs)}
+
+    def test_varints(self):
+        values = np.array([0, 1, 127, 128, 300, 2**21, 2**42 + 5, 2**63], dtype=np.uint64)
+        buf, ends = _encode_varints(values)
+        self.assertEqual(list(np.diff(np.append(0, ends))), [1, 1, 1, 2, 2, 4, 7, 10])
+        self.assertTrue(np.array_equal(_decode_varints(buf), values))
+
+    def test_same_as_brute_force(self):
+        with SearchIndex(self.path, segment_docs=70) as index:
+            self.assertEqual(index.add_many(self.docs), 300)
+        self.assertEqual(len(os.listdir(self.path)), 6)
+
+        index = SearchIndex(self.path)
+        self.assertEqual(len(index), 300)
+        for query in self.queries:
+            self.assertEqual(self.hits(index, query), brute_force(self.docs, query), query)
+
+            hits = index.search(query, top=5)
+            scores = [score for _, _, score in hits]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            self.assertLessEqual(len(hits), 5)
+
+        # every bigram of both words, or any bigram of either
+        words = self.queries[0] + " " + self.queries[1]
+        first, second = self.hits(index, self.queries[0]), self.hits(index, self.queries[1])
+        self.assertEqual(self.hits(index, words), first & second)
+        self.assertTrue(first | second < self.hits(index, words, require_all=False))
+
+        self.assertEqual(index.search("。、"), [])
+        self.assertEqual(index.search("zzzz"), [])
+
+    def test_one_character(self):
+        with SearchIndex(self.path) as index:
+            index.add_many([("n0000aa", 1, "魔法"), ("n0000aa", 2, "法魔"),
+                            ("n0000aa", 3, "使い魔")])
+        self.assertEqual(len(self.hits(SearchIndex(self.path), "魔")), 3)
+        self.assertEqual(self.hits(SearchIndex(self.path), "魔 使"), {("n0000aa", 3)})
+
+    def test_replace_and_merge(self):
+        with SearchIndex(self.path, segment_docs=100) as index:
+            index.add_many(self.docs)
+
+            # replaced in a flushed segment and in the buffer
+            index.add("n0000aa", 1, "新しい本文です")
+            index.add("n0000aa", 2, "古い")
+            index.add("n0000aa", 2, "二回目の本文")
+
+        index = SearchIndex(self.path)
+        self.assertEqual(len(index), 300)
+        self.assertEqual(len(index.segments), 4)
+        self.assertEqual(self.hits(index, "新しい"), {("n0000aa", 1)})
+        self.assertEqual(self.hits(index, "古い"), set())
+        self.assertEqual(self.hits(index, "二回目"), {("n0000aa", 2)})
+
+        docs = [d for d in self.docs if d[:2] not in {("n0000aa", 1), ("n0000aa", 2)}]
+        before = {q: self.hits(index, q) for q in self.queries}
+        for query in self.queries:
+            self.assertEqual(before[query], brute_force(docs, query))
+
+        index.merge(max_segments=2)
+        self.assertEqual(len(index.segments), 2)
+        index.merge()
+        self.assertEqual(len(index.segments), 1)
+        self.assertEqual(len(index.segments[0]), 300)
+        self.assertFalse(index.segments[0].deleted.any())
+
+        reopened = SearchIndex(self.path)
+        for query in self.queries:
+            self.assertEqual(self.hits(reopened, query), before[query])
+        self.assertEqual(
+            sorted(os.listdir(self.path)),
+            sorted(["manifest.json", os.path.basename(reopened.segments[0].path)])
+        )
+
+    def test_index_chapters_and_summaries(self):
+        out_dir = os.path.join(self.tmp.name, "chapters")
+        os.makedirs(out_dir)
+
+        def write(ncode, chapter, text, checkpoint=True):
+            # as `ChapterSpider` does, one gzip member per chapter
+            path = os.path.join(out_dir, f"{ncode}.jsonl.gz")
+            record = {"ncode" : ncode, "chapter" : chapter, "title" : f"第{chapter}話", "text" : text}
+            with gzip.open(path, mode='ab') as file:
+                file.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf8'))
+            if checkpoint:
+                with open(os.path.join(out_dir, f"{ncode}.checkpoint.json"), 'w') as file:
+                    json.dump({"chapter" : chapter, "offset" : os.path.getsize(path)}, file)
+
+        write("n1111aa", 1, "剣と魔法の世界")
+        write("n1111aa", 2, "北の戦線")
+        write("n2222bb", 1, "魔法学院")
+        # not checkpointed yet
+        write("n2222bb", 2, "書きかけの魔法", checkpoint=False)
+
+        store_path = os.path.join(self.tmp.name, "novels.db")
+        store = NovelStore(store_path)
+        store.upsert_many([{
+            "ncode" : "n1111aa", "title" : "北の魔法", "summary" : "あらすじ",
+            "keywords" : ["異世界", "戦記"]
+        }])
+        store.close()
+
+        with SearchIndex(self.path) as index:
+            self.assertEqual(index_chapters(index, out_dir), 3)
+            self.assertEqual(index_summaries(index, store_path), 1)
+
+        index = SearchIndex(self.path)
+        self.assertEqual(
+            self.hits(index, "魔法"),
+            {("n1111aa", 1), ("n2222bb", 1), ("n1111aa", SUMMARY_CHAPTER)}
+        )
+        self.assertEqual(self.hits(index, "戦記"), {("n1111aa", SUMMARY_CHAPTER)})
+        self.assertEqual(self.hits(index, "第2話"), {("n1111aa", 2)})
+
+        # only what was written since
+        write("n2222bb", 3, "続きの魔法")
+        with index:
+            self.assertEqual(index_chapters(index, out_dir), 2)
+            self.assertEqual(index_chapters(index, out_dir), 0)
+        self.assertEqual(len(SearchIndex(self.path)), 6)
+        self.assertEqual(
+            self.hits(SearchIndex(self.path), "の魔法"),
+            {("n2222bb", 2), ("n2222bb", 3), ("n1111aa", SUMMARY_CHAPTER)}
+        )
+
+    def test_query_speed(self):
+        with SearchIndex(self.path) as index:
+            index.add_many(make_docs(20000, seed=1))
+
+        index = SearchIndex(self.path)
+        for query in self.queries:
+            index.search(query)
+            seconds = min(timeit.repeat(lambda: index.search(query), number=5, repeat=3)) / 5
+            self.assertLess(seconds, 0.05, query)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+import syosetu.seen as seen
+from syosetu.dupefilters import SeenSetDupeFilter
+from syosetu.spiders.chapters import ChapterSpider, _NovelState
+
+# ---------------------------------------------------------------------------- #
+
+class PackTest(unittest.TestCase):
+
+    def test_pack_ncode(self):
+        codes = ["n0000a", "n0000z", "n0000aa", "n0001a", "n6093en", "n9999zz"]
+        keys = [seen.pack_ncode(c) for c in codes]
+
+        self.assertEqual(keys, sorted(keys))
+        self.assertLess(keys[-1], 2**23)
+        self.assertEqual([seen.unpack_ncode(k) for k in keys], codes)
+
+        with self.assertRaises(ValueError):
+            seen.pack_ncode("n12ab")
+
+    def test_page_key(self):
+        key, chapter = seen.page_key("https://ncode.syosetu.com/n6093en/12/")
+        self.assertEqual(chapter, 12)
+        self.assertEqual(key >> seen.CHAPTER_BITS, seen.pack_ncode("n6093en"))
+
+        key, chapter = seen.page_key("https://ncode.syosetu.com/n6093en/")
+        self.assertEqual(chapter, 0)
+
+        self.assertIsNone(seen.page_key("https://yomou.syosetu.com/search.php"))
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_add_many_matches_add(self):
+
+        keys = np.random.default_rng(0).integers(0, 2**43, size=2000)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bits, hashes = seen.BloomFilter.size_for(2000, 0.01)
+            one = seen.BloomFilter(os.path.join(tmp, "one"), bits, hashes)
+            many = seen.BloomFilter(os.path.join(tmp, "many"), bits, hashes)
+
+            for key in keys.tolist():
+                one.add(key)
+            many.add_many(keys)
+
+            np.testing.assert_array_equal(one.bits, many.bits)
+            self.assertTrue(all(k in one for k in keys.tolist()))
+
+            # false positives stay near the error rate
+            other = range(2**44, 2**44 + 10_000)
+            rate = sum(k in one for k in other) / len(other)
+            self.assertLess(rate, 0.03)
+
+            one.close()
+            many.close()
+
+class SeenSetTest(unittest.TestCase):
+
+    def test_runs(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "seen.db")
+
+            store = seen.SeenSet(path, capacity=1000, batch_size=3)
+            self.assertEqual(store.run, 1)
+            self.assertEqual([store.visit(k) for k in range(5)], [seen.NEW]*5)
+            self.assertEqual(store.visit(1), seen.SEEN)
+            self.assertEqual(store.visit(4), seen.SEEN)
+            store.close()
+
+            store = seen.SeenSet(path, capacity=1000, batch_size=3)
+            self.assertEqual(store.run, 2)
+            self.assertEqual(len(store), 5)
+            self.assertIn(3, store)
+            self.assertNotIn(7, store)
+
+            self.assertEqual(store.visit(3), seen.SEEN_BEFORE)
+            self.assertEqual(store.visit(3), seen.SEEN)
+            self.assertEqual(store.visit(7), seen.NEW)
+
+            # an unclean exit leaves the filter unsaved
+            store.flush()
+            store.conn.close()
+            os.remove(path + '.bloom')
+
+            store = seen.SeenSet(path, capacity=1000, batch_size=3)
+            self.assertEqual(len(store), 6)
+            self.assertEqual(store.visit(7), seen.SEEN_BEFORE)
+            self.assertEqual(store.visit(0), seen.SEEN_BEFORE)
+            self.assertEqual(store.visit(8), seen.NEW)
+            store.close()
+
+            # and a crash before the filter is saved
+            store = seen.SeenSet(path, capacity=1000, batch_size=1)
+            store.visit(9)
+            store.conn.close()
+
+            store = seen.SeenSet(path, capacity=1000)
+            self.assertEqual(store.visit(9), seen.SEEN_BEFORE)
+            store.close()
+
+class SeenSetDupeFilterTest(unittest.TestCase):
+
+    def make_crawler(self, tmp: str):
+        return get_crawler(ChapterSpider, {
+            'SEEN_SET_PATH' : os.path.join(tmp, "seen.db"),
+            'SEEN_SET_CAPACITY' : 1000,
+        })
+
+    def make_filter(self, tmp: str) -> SeenSetDupeFilter:
+        return SeenSetDupeFilter.from_crawler(self.make_crawler(tmp))
+
+    def test_written_chapters(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            crawler = self.make_crawler(tmp)
+            df = SeenSetDupeFilter.from_crawler(crawler)
+            spider = ChapterSpider.from_crawler(
+                crawler, ncodes="n0001aa", out_dir=os.path.join(tmp, "out")
+            )
+            crawler.spider = spider
+
+            # a written chapter is added, a skipped one is not
+            state = _NovelState("n0001aa", 0)
+            spider._write(state, 1, {"title" : "第1話", "text" : "本文"})
+            spider._write(state, 2, None)
+            df.close('finished')
+
+            df = self.make_filter(tmp)
+            self.assertTrue(df.request_seen(Request("https://ncode.syosetu.com/n0001aa/1/")))
+            self.assertFalse(df.request_seen(Request("https://ncode.syosetu.com/n0001aa/2/")))
+            df.close('finished')
+
+    def test_request_seen(self):
+
+        novel = Request("https://ncode.syosetu.com/n0001aa/")
+        chapter = Request("https://ncode.syosetu.com/n0001aa/3/")
+        unwritten = Request("https://ncode.syosetu.com/n0001aa/4/")
+        search = Request("https://yomou.syosetu.com/search.php?p=1")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            df = self.make_filter(tmp)
+            for req in (novel, chapter, unwritten, search):
+                self.assertFalse(df.request_seen(req))
+                self.assertTrue(df.request_seen(req.copy()))
+
+            # chapter 4 was requested, but the run ended before it was written
+            df.chapter_written("n0001aa", 3)
+            df.close('finished')
+
+            # a later run skips written chapters, but not novel or search pages
+            df = self.make_filter(tmp)
+            self.assertFalse(df.request_seen(novel))
+            self.assertTrue(df.request_seen(novel))
+            self.assertTrue(df.request_seen(chapter))
+            self.assertFalse(df.request_seen(unwritten))
+            self.assertTrue(df.request_seen(unwritten))
+            self.assertFalse(df.request_seen(search))
+            df.close('finished')
+
+        self.assertEqual(df.stats.get_value('seen_set/seen_before'), 2)
+        self.assertEqual(df.stats.get_value('seen_set/skipped_chapters'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import gzip
+import timeit
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from syosetu.spiders.novels_spider import (
+    REMOVE_PUNCT_REGEX, format_novel_metric_string
+)
+from syosetu.text import iter_normalized, normalize, normalize_file
+
+# ---------------------------------------------------------------------------- #
+SAMPLES = [
+    "./test/testing_data/northern_front_c1_sample1.txt",
+    "./test/testing_data/northern_front_c1_sample2_with_punctuation.txt",
+]
+
+RUBY_TEXT = (
+    "彼は|魔法使い《ウィザード》だ。漢字《かんじ》と、ｶﾞｷﾞ　ＡＢＣ１２３！\n"
+    "\u304b\u3099と｜《》と《三国志》 x  y"
+)
+
+def read_sample(path: str) -> str:
+    with open(path, mode='r', encoding='utf8') as file:
+        return file.read()
+
+def remove_punct(text: str) -> str:
+    """The regex cleaning being replaced"""
+    return format_novel_metric_string([REMOVE_PUNCT_REGEX.sub('', text)])
+
+def chunked(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+# ---------------------------------------------------------------------------- #
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_same_as_regex(self):
+        for path in SAMPLES:
+            text = read_sample(path)
+            self.assertEqual(normalize(text), remove_punct(text))
+
+    def test_ruby_and_width(self):
+        self.assertEqual(
+            normalize(RUBY_TEXT),
+            "彼は魔法使いだ漢字とガギABC123がとと三国志xy"
+        )
+        self.assertEqual(
+            normalize(RUBY_TEXT, collapse=True),
+            "彼は魔法使いだ漢字とガギ ABC123 がとと三国志 x y"
+        )
+
+    def test_chunks(self):
+        texts = [RUBY_TEXT, read_sample(SAMPLES[1])[:3000]]
+        for text in texts:
+            for collapse in (False, True):
+                whole = normalize(text, collapse)
+                for size in (1, 2, 3, 7, 50, 1000):
+                    self.assertEqual(
+                        ''.join(iter_normalized(chunked(text, size), collapse)),
+                        whole, (size, collapse)
+                    )
+
+    def test_mark_in_next_chunk(self):
+        # a base at the end of a chunk composes with a mark after the cut
+        for text, expected in (
+            ("き\u3099", "ぎ"), ("カ\u3099", "ガ"), ("a\u0301", "\u00e1"),
+            ("ｶﾞ", "ガ"), ("\u1100\u1161\u11a8", "\uac01"),
+        ):
+            text = "本文の" + text + "です"
+            for i in range(1, len(text)):
+                self.assertEqual(
+                    ''.join(iter_normalized([text[:i], text[i:]])),
+                    normalize(text), (text, i)
+                )
+            self.assertIn(expected, normalize(text))
+
+    def test_file(self):
+        text = read_sample(SAMPLES[1]) + RUBY_TEXT
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "chapter.txt.gz")
+            dst = os.path.join(tmp, "clean.txt")
+            with gzip.open(src, mode='wt', encoding='utf8') as file:
+                file.write(text)
+
+            written = normalize_file(src, dst, chunk_size=100)
+            self.assertEqual(read_sample(dst), normalize(text))
+            self.assertEqual(written, len(normalize(text)))
+
+    def test_faster_than_regex(self):
+        text = read_sample(SAMPLES[0]) * 50
+        normalize(text)
+
+        regex = min(timeit.repeat(lambda: remove_punct(text), number=1, repeat=3))
+        table = min(timeit.repeat(lambda: normalize(text), number=1, repeat=3))
+        self.assertLess(3 * table, regex)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import time
+import logging
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath("./syosetu/"))
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from syosetu.pipelines import TimeSeriesPipeline
+from syosetu.spiders.novels_spider import NovelSpider, get_search_order
+from syosetu.timeseries import MetricStore, item_metrics
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./syosetu/tests/data/"
+
+DAY = 86400
+
+def read_items() -> list:
+    with open(TESTPATH + "search_results.html", mode='rb') as file:
+        response = HtmlResponse(
+            url=get_search_order("favnovelcnt") % 1, body=file.read(),
+            encoding='utf-8'
+        )
+
+    logging.disable(logging.CRITICAL)
+    try:
+        return list(NovelSpider().parse(response))
+    finally:
+        logging.disable(logging.NOTSET)
+
+def novel(ncode: str, **metrics) -> dict:
+    return dict(ncode=ncode, **metrics)
+
+# ---------------------------------------------------------------------------- #
+
+class MetricStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = MetricStore(
+            os.path.join(self.tmp.name, "metrics.db"), block_size=2
+        )
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_only_changes_are_stored(self):
+        s = self.store
+
+        self.assertEqual(s.append(0, [
+            novel("n0001aa", bookmark_cnt=10, global_pnt=100),
+            novel("n0002aa", bookmark_cnt=5),
+        ]), 3)
+        self.assertEqual(s.append(DAY, [
+            novel("n0001aa", bookmark_cnt=10, global_pnt=120),
+            novel("n0002aa", bookmark_cnt=5),
+        ]), 1)
+        self.assertEqual(s.append(2*DAY, [
+            novel("n0001aa", bookmark_cnt=14),
+            novel("n0002aa", bookmark_cnt=9),
+        ]), 2)
+        s.append(3*DAY, [novel("n0001aa", bookmark_cnt=15)])
+        s.append(4*DAY, [novel("n0001aa", bookmark_cnt=20)])
+
+        # over several blocks, with the value from before the start
+        ts, values = s.history("n0001aa", "bookmark_cnt", DAY, 3*DAY)
+        self.assertEqual(ts.tolist(), [0, 2*DAY, 3*DAY])
+        self.assertEqual(values.tolist(), [10, 14, 15])
+
+        ts, values = s.history("n0001aa", "bookmark_cnt")
+        self.assertEqual(values.tolist(), [10, 14, 15, 20])
+
+        self.assertEqual(s.value_at("n0001aa", "bookmark_cnt", 3*DAY + 5), 15)
+        self.assertEqual(s.value_at("n0001aa", "bookmark_cnt", DAY), 10)
+        self.assertIsNone(s.value_at("n0001aa", "bookmark_cnt", -1))
+        self.assertEqual(s.growth("n0001aa", "bookmark_cnt", DAY, 4*DAY), 10)
+        self.assertIsNone(s.growth("n0003aa", "bookmark_cnt", 0, DAY))
+
+        self.assertEqual(
+            s.movers("bookmark_cnt", DAY, 2*DAY), [("n0001aa", 4), ("n0002aa", 4)]
+        )
+        self.assertEqual(s.movers("bookmark_cnt", 0, 4*DAY, top=1), [("n0001aa", 10)])
+        self.assertEqual(s.movers("global_pnt", 0, DAY), [("n0001aa", 20)])
+        self.assertEqual(s.metrics(), ["bookmark_cnt", "global_pnt"])
+
+        # snapshots older than a series' last point are not history
+        self.assertEqual(s.append(DAY, [novel("n0001aa", bookmark_cnt=0)]), 0)
+
+    def test_year_of_snapshots(self):
+        s = MetricStore(os.path.join(self.tmp.name, "year.db"))
+        rng = np.random.default_rng(0)
+
+        n = 200
+        values = np.zeros(n, dtype=np.int64)
+        for day in range(365):
+            # about half of the novels gain bookmarks on a day
+            values += rng.integers(1, 4, n) * (rng.random(n) < 0.5)
+            s.append(day*DAY, [
+                novel(f"n{i:04d}aa", bookmark_cnt=int(v))
+                for i, v in enumerate(values)
+            ])
+
+        start = time.perf_counter()
+        growth = s.growth("n0001aa", "bookmark_cnt", 274*DAY, 364*DAY)
+        movers = s.movers("bookmark_cnt", 357*DAY, 364*DAY)
+        elapsed = time.perf_counter() - start
+
+        ts, history = s.history("n0001aa", "bookmark_cnt")
+        self.assertEqual(history[-1], values[1])
+        self.assertEqual(growth, history[-1] - s.value_at(
+            "n0001aa", "bookmark_cnt", 274*DAY
+        ))
+        self.assertEqual(len(movers), 10)
+        self.assertEqual(
+            movers[0][1], max(s.growth(f"n{i:04d}aa", "bookmark_cnt",
+                357*DAY, 364*DAY) for i in range(n))
+        )
+        self.assertLess(elapsed, 0.1)
+        s.close()
+
+class TimeSeriesPipelineTest(unittest.TestCase):
+
+    def test_crawls(self):
+        items = read_items()
+        self.assertEqual(item_metrics(items[0])["yearly_pnt"], 344938)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.db")
+            crawler = get_crawler(
+                NovelSpider, settings_dict={'TIMESERIES_PATH' : path}
+            )
+
+            for bookmarks in (0, 7):
+                pipeline = TimeSeriesPipeline.from_crawler(crawler)
+                pipeline.open_spider(None)
+                for item in items:
+                    item = item.copy()
+                    item['bookmark_cnt'] += bookmarks
+                    pipeline.process_item(item, None)
+                pipeline.close_spider(None)
+
+                # snapshots are stamped to the second
+                time.sleep(1.01 - time.time() % 1)
+
+            store = MetricStore(path)
+            ncode = items[0]['ncode']
+            self.assertEqual(
+                store.history(ncode, "bookmark_cnt")[1].tolist(),
+                [items[0]['bookmark_cnt'], items[0]['bookmark_cnt'] + 7]
+            )
+            self.assertEqual(len(store.history(ncode, "yearly_pnt")[0]), 1)
+            self.assertEqual(len(store.movers("bookmark_cnt", 0, 2**40)), 10)
+            store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import unittest
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath("./src/Learning/"))
+from base import CommonTest, TestAssertionError, TestRuntimeError, outputs_match
+
+# ---------------------------------------------------------------------------- #
+
+# module level, so worker processes can unpickle them
+
+def frame_of(n: int) -> pd.DataFrame:
+    print("building", n)
+    return pd.DataFrame({
+        'word' : [f"w{i}" for i in range(n)],
+        'count' : np.arange(n),
+        'share' : np.arange(n) / 3,
+    })
+
+def invert(n: int) -> float:
+    return 1 / n
+
+def expected_frame(n: int) -> pd.DataFrame:
+    # same values, rows and columns in another order
+    df = pd.DataFrame({
+        'share' : np.arange(n) / 3 * (1 + 1e-12),
+        'word' : [f"w{i}" for i in range(n)],
+        'count' : np.arange(n),
+    })
+    return df.iloc[::-1]
+
+# ---------------------------------------------------------------------------- #
+
+class OutputsMatchTest(unittest.TestCase):
+
+    def test_frames(self):
+        self.assertTrue(outputs_match(frame_of(5), expected_frame(5)))
+
+        wrong = expected_frame(5)
+        wrong.loc[2, 'word'] = "x"
+        self.assertFalse(outputs_match(frame_of(5), wrong))
+
+        wrong = expected_frame(5)
+        wrong['count'] += 1
+        self.assertFalse(outputs_match(frame_of(5), wrong))
+
+        self.assertFalse(outputs_match(frame_of(6), expected_frame(5)))
+        self.assertFalse(outputs_match(frame_of(5), expected_frame(5).iloc[:, :2]))
+        self.assertFalse(outputs_match(frame_of(5)['count'], expected_frame(5)))
+
+    def test_arrays_and_scalars(self):
+        self.assertTrue(outputs_match(np.array([1., np.nan]), np.array([1., np.nan])))
+        self.assertFalse(outputs_match(np.array([1., 2.]), np.array([1., 2.1])))
+        self.assertTrue(outputs_match(
+            np.array([1., 2.]), np.array([1., 2.1]), rtol=0.1
+        ))
+        self.assertFalse(outputs_match(np.arange(3), np.arange(4)))
+        self.assertTrue(outputs_match(pd.Series(['a', None]), pd.Series(['a', None])))
+        self.assertTrue(outputs_match(0.1 + 0.2, 0.3))
+        self.assertTrue(outputs_match(['a'], ['a']))
+
+class CommonTestTest(unittest.TestCase):
+
+    def test_serial(self):
+        inputs = [3, 10, 100]
+        t = CommonTest(frame_of, inputs, [expected_frame(n) for n in inputs])
+
+        self.assertTrue(t.passed)
+        self.assertEqual(t.results[0].stdout, "building 3\n")
+
+        summary = t.summary()
+        self.assertEqual(list(summary.index), [0, 1, 2])
+        self.assertTrue(summary['passed'].all())
+        self.assertTrue((summary['peak_mib'] > 0).all())
+
+        # slowdown against a previous run
+        baseline = summary.assign(seconds=summary['seconds'] / 2)
+        slowdown = t.summary(baseline)['slowdown']
+        self.assertTrue(np.allclose(slowdown, 2))
+
+    def test_failures_are_raised(self):
+        with self.assertRaises(TestRuntimeError) as ctx:
+            CommonTest(invert, [1, 0, 2], [1., 0., 0.5])
+        self.assertIn("ZeroDivisionError", str(ctx.exception))
+
+        with self.assertRaises(TestAssertionError):
+            CommonTest(invert, [1, 2], [1., 0.25])
+
+        t = CommonTest(invert, [1, 0, 4], [1., 0., 0.5], raise_errors=False)
+        self.assertEqual([r.case for r in t.failures()], [1, 2])
+        self.assertEqual(t.results[2].output, 0.25)
+        errors = t.summary()['error']
+        self.assertTrue(pd.isna(errors[0]))
+        self.assertEqual(errors[1], "ZeroDivisionError: division by zero")
+
+    def test_pools(self):
+        stdout = sys.stdout
+        inputs = list(range(1, 9))
+        outputs = [expected_frame(n) for n in inputs]
+
+        for pool in ('process', 'thread'):
+            t = CommonTest(frame_of, inputs, outputs, workers=4, pool=pool)
+            self.assertTrue(t.passed)
+            self.assertEqual([r.case for r in t.results], list(range(8)))
+
+            # memory is traced in processes, but not in shared threads
+            self.assertEqual(
+                t.results[0].peak_bytes is None, pool == 'thread'
+            )
+
+        with self.assertRaises(TestAssertionError):
+            CommonTest(invert, [1, 2, 4], [1., 0.5, 0.3], workers=2)
+
+        self.assertIs(sys.stdout, stdout)
+
+    def test_caller_tracing_memory(self):
+        tracemalloc.start()
+        try:
+            block = bytearray(2**22)
+            del block
+            peak = tracemalloc.get_traced_memory()[1]
+
+            t = CommonTest(frame_of, [4], [expected_frame(4)])
+            self.assertIsNone(t.results[0].peak_bytes)
+
+            # still tracing, and the peak was not reset
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertGreaterEqual(tracemalloc.get_traced_memory()[1], peak)
+        finally:
+            tracemalloc.stop()
+
+if __name__ == '__main__':
+    unittest.main()
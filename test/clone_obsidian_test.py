@@ -0,0 +1,118 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import io
+import sys
+import os
+import json
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath("./Obsidian notebooks/"))
+import cloneObsidian as co
+
+# ---------------------------------------------------------------------------- #
+
+def write(path: str, text: str, mtime: int=None) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', encoding='utf8') as file:
+        file.write(text)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+def read(path: str) -> str:
+    with open(path, mode='r', encoding='utf8') as file:
+        return file.read()
+
+# ---------------------------------------------------------------------------- #
+
+class SyncTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "vault") + "/"
+        self.dest = os.path.join(self.tmp.name, "clone") + "/"
+        os.makedirs(self.dest)
+
+        write(self.src + "Notes/a.md", "# a", mtime=10**18)
+        write(self.src + "Notes/sub/b.md", "# b", mtime=10**18)
+        write(self.src + "Notes/c.md", "# c", mtime=10**18)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sync(self, dry_run: bool=False) -> dict:
+        with redirect_stdout(io.StringIO()):
+            clone = co.cloneObsidian(
+                folders=["Notes"], dest=self.dest, obsidian_path=self.src,
+                sync=True, dry_run=dry_run, workers=2
+            )
+        return {state : sorted(rels) for state, rels in clone.report.items()}
+
+    def counted_sync(self, dry_run: bool=False):
+        """The report, and the files hashed for it"""
+        with mock.patch.object(co, "fileHash", wraps=co.fileHash) as hashed:
+            report = self.sync(dry_run)
+        return report, sorted(
+            os.path.relpath(call.args[0], self.tmp.name)
+            for call in hashed.call_args_list
+        )
+
+    def manifest(self) -> dict:
+        with open(self.dest + co.MANIFEST_NAME, encoding='utf8') as file:
+            return json.load(file)
+
+    def test_sync(self):
+        report = self.sync()
+        self.assertEqual(report["new"], ["Notes/a.md", "Notes/c.md", "Notes/sub/b.md"])
+        self.assertEqual(read(self.dest + "Notes/sub/b.md"), "# b")
+        self.assertEqual(len(self.manifest()), 3)
+
+        # nothing changed, nothing is read
+        report, hashed = self.counted_sync()
+        self.assertEqual(len(report["unchanged"]), 3)
+        self.assertEqual(hashed, [])
+
+        # touched but same content: hashed once, not copied
+        write(self.src + "Notes/a.md", "# a", mtime=2*10**18)
+        report, hashed = self.counted_sync()
+        self.assertEqual(report["changed"], [])
+        self.assertEqual(hashed, ["vault/Notes/a.md"])
+        self.assertEqual(os.stat(self.dest + "Notes/a.md").st_mtime_ns, 10**18)
+        self.assertEqual(self.manifest()["Notes/a.md"]["mtime_ns"], 2*10**18)
+        self.assertEqual(self.counted_sync()[1], [])
+
+        # changed, new and removed, reported but not copied on a dry run
+        write(self.src + "Notes/sub/b.md", "# B", mtime=2*10**18)
+        write(self.src + "Notes/d.md", "# d")
+        os.remove(self.src + "Notes/c.md")
+        before = self.manifest()
+
+        expected = {
+            "new" : ["Notes/d.md"], "changed" : ["Notes/sub/b.md"],
+            "unchanged" : ["Notes/a.md"], "removed" : ["Notes/c.md"],
+        }
+        self.assertEqual(self.sync(dry_run=True), expected)
+        self.assertFalse(os.path.exists(self.dest + "Notes/d.md"))
+        self.assertEqual(read(self.dest + "Notes/sub/b.md"), "# b")
+        self.assertEqual(self.manifest(), before)
+
+        self.assertEqual(self.sync(), expected)
+        self.assertEqual(read(self.dest + "Notes/d.md"), "# d")
+        self.assertEqual(read(self.dest + "Notes/sub/b.md"), "# B")
+        self.assertEqual(
+            sorted(self.manifest()), ["Notes/a.md", "Notes/d.md", "Notes/sub/b.md"]
+        )
+
+        # and a second sync reads nothing
+        report, hashed = self.counted_sync()
+        self.assertEqual(len(report["unchanged"]), 3)
+        self.assertEqual(report["removed"], [])
+        self.assertEqual(hashed, [])
+
+if __name__ == '__main__':
+    unittest.main()
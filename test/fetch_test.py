@@ -0,0 +1,219 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import gzip
+import time
+import asyncio
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.abspath("./src/Learning/"))
+import fetch
+from fetch import FetchClient, decode_body, fetch_pages
+
+# ---------------------------------------------------------------------------- #
+
+def index_page(ncode: str) -> bytes:
+    return (
+        f"<html><head><meta charset='utf-8'><title>{ncode}</title></head>"
+        f"<body><div class='novel_title'>小説 {ncode}</div></body></html>"
+    ).encode('utf8')
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Novel index pages at /<ncode>, with ?delay=, ?enc= and ?chunked.
+    /gate waits for the server's `gate` event.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body in one write, so no Nagle delays
+    wbufsize = -1
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+
+        if parts.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/n0001")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if parts.path == "/close":
+            body = index_page("close")
+            self.send_response(200)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+
+        if parts.path == "/gate":
+            self.server.gate.wait(5)
+
+        if "delay" in query:
+            time.sleep(float(query["delay"][0]))
+
+        body = index_page(parts.path.strip("/"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+
+        enc = query.get("enc", [""])[0]
+        if enc == "gzip":
+            body = gzip.compress(body)
+        elif enc == "br":
+            body = fetch.brotli.compress(body)
+        if enc:
+            self.send_header("Content-Encoding", enc)
+
+        if "chunked" in query:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), 7):
+                chunk = body[i:i + 7]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+# ---------------------------------------------------------------------------- #
+
+class FetchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        cls.server.connections = 0
+        cls.server.gate = threading.Event()
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.connections = 0
+        self.server.gate.clear()
+
+    def test_pooled_pages(self):
+        urls = [f"{self.base}/n{i:04d}" for i in range(300)]
+        pages = fetch_pages(
+            urls + urls[:5], per_host=4,
+            parse=lambda p: p.tree().findtext(".//title")
+        )
+
+        self.assertEqual(len(pages), 305)
+        self.assertTrue(all(p.ok for p in pages))
+        self.assertEqual([p.data for p in pages[:3]], ["n0000", "n0001", "n0002"])
+        self.assertIs(pages[300], pages[0])
+        # keep-alive connections are reused
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_encodings(self):
+        queries = ["?enc=gzip", "?chunked", "?enc=gzip&chunked", "?enc=br"]
+        if fetch.brotli is None:
+            queries.pop()
+
+        pages = fetch_pages(f"{self.base}/n0042{q}" for q in queries)
+        for page in pages:
+            self.assertTrue(page.ok, page)
+            self.assertEqual(page.body, index_page("n0042"))
+            self.assertEqual(page.encoding, "utf-8")
+            self.assertIn("小説 n0042", page.text)
+
+        soup = pages[0].tree(soup=True)
+        self.assertEqual(soup.find("div", class_="novel_title").text, "小説 n0042")
+
+    def test_redirects_and_errors(self):
+        closed = f"http://127.0.0.1:{self.server.server_address[1] + 1}/x"
+        pages = fetch_pages(
+            [f"{self.base}/redirect", f"{self.base}/close", closed,
+            "ftp://example.com/"],
+            retries=0
+        )
+
+        self.assertEqual(pages[0].url, f"{self.base}/n0001")
+        self.assertEqual(pages[0].tree().findtext(".//title"), "n0001")
+        self.assertEqual(pages[1].tree().findtext(".//title"), "close")
+        self.assertIsNotNone(pages[2].error)
+        self.assertIn("ValueError", pages[3].error)
+        self.assertFalse(pages[3].ok)
+
+    def test_concurrent_stream(self):
+        urls = [f"{self.base}/n{i:04d}?delay=0.2" for i in range(20)]
+        urls.insert(0, f"{self.base}/gate")
+
+        async def collect():
+            pages = []
+            async with FetchClient(per_host=10) as client:
+                async for page in client.stream(urls):
+                    pages.append(page)
+                    # the gated page is held until all others are in
+                    if len(pages) == 20:
+                        self.server.gate.set()
+            return pages
+
+        start = time.perf_counter()
+        pages = asyncio.run(collect())
+        seconds = time.perf_counter() - start
+
+        self.assertTrue(all(p.ok for p in pages))
+        self.assertEqual({p.url for p in pages}, set(urls))
+        # the first requested page did not hold up the others
+        self.assertEqual(pages[-1].url, f"{self.base}/gate")
+        # 4s one at a time
+        self.assertLess(seconds, 2)
+
+    def test_queued_requests_do_not_time_out(self):
+        # 4 rounds of 0.3s on 2 connections, each well within the timeout
+        urls = [f"{self.base}/n{i:04d}?delay=0.3" for i in range(8)]
+        pages = fetch_pages(urls, per_host=2, timeout=1, retries=0)
+
+        self.assertTrue(all(p.ok for p in pages), [p.error for p in pages])
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_inside_running_loop(self):
+        async def notebook_cell():
+            return fetch_pages([f"{self.base}/n0007"])
+
+        page, = asyncio.run(notebook_cell())
+        self.assertEqual(page.tree().findtext(".//title"), "n0007")
+
+    def test_decode_body(self):
+        import zlib
+        body = b"abc" * 10
+        self.assertEqual(decode_body(zlib.compress(body), "deflate"), body)
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.assertEqual(
+            decode_body(raw.compress(body) + raw.flush(), "deflate"), body
+        )
+        self.assertEqual(
+            decode_body(gzip.compress(gzip.compress(body)), "gzip, gzip"), body
+        )
+        with self.assertRaises(ValueError):
+            decode_body(body, "compress")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath("./src/Learning/"))
+import kanji_table as kt
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./test/testing_data/"
+
+def read_sample() -> str:
+    path = TESTPATH + "northern_front_c1_sample2_with_punctuation.txt"
+    with open(path, mode='r', encoding='utf8') as file:
+        return file.read()
+
+def count_with_dict(text: str, system: str) -> np.ndarray:
+    """Reference: one dict lookup per character"""
+
+    with open(kt.JSON_PATH, mode='r', encoding='utf8') as file:
+        data = json.load(file)
+
+    counts = np.zeros(kt.LEVELS[system] + 1, dtype=np.int64)
+    for char in text:
+        if char in data:
+            counts[kt._level(system, data[char].get(system))] += 1
+
+    return counts
+
+# ---------------------------------------------------------------------------- #
+
+class KanjiTableTest(unittest.TestCase):
+
+    def test_saved_table_is_current(self):
+        table = kt.load_table()
+
+        self.assertIsInstance(table, np.memmap)
+        np.testing.assert_array_equal(table, kt.build_table())
+
+    def test_save_and_load(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "table.npy")
+            kt.save_table(kt.build_table(), path)
+
+            table = kt.load_table(path, mmap=False)
+            self.assertEqual(table.dtype, np.uint8)
+            self.assertEqual(table[ord('一') - kt.BASE].tolist(), [1, 1, 5, 1])
+
+    def test_count_levels(self):
+        text = read_sample()
+
+        for system in kt.SYSTEMS:
+            np.testing.assert_array_equal(
+                kt.count_levels(text, system), count_with_dict(text, system)
+            )
+
+        profile = kt.level_profile(text)
+        self.assertEqual(list(profile), list(kt.SYSTEMS))
+        np.testing.assert_array_equal(
+            profile['jlpt'].values, kt.count_levels(text, 'jlpt')
+        )
+
+    def test_non_kanji(self):
+        counts = kt.count_levels("abc　ひらがなカタカナ😀", 'wk')
+
+        self.assertEqual(counts.sum(), 0)
+        self.assertEqual(len(counts), kt.LEVELS['wk'] + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright (c) 2022 Delbert Yip
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath("./src/Learning/"))
+import word_count as wc
+
+# ---------------------------------------------------------------------------- #
+TESTPATH = "./test/testing_data/"
+
+SAMPLES = [
+    TESTPATH + "northern_front_c1_sample1.txt",
+    TESTPATH + "northern_front_c1_sample2_with_punctuation.txt",
+]
+
+# substrings of `northern_front_c1_sample1.txt` behind the saved outputs
+TEST_INPUTS = [
+    '色々な事態に直面をして必死になりな',
+    '一緒にしようかえいいいのいいよこうして鶏の解体をしてからすっかり'
+    '暗くなった時間に帰宅となるだが一'
+]
+
+TRUE_LEMMAS = [
+    ['色々', '事態', '直面', '為る', '必死', '成る'],
+    ['一緒', '為る', 'えー', 'いー', '良い', '良い', 'こう',
+    '為る', '鶏', '解体', '為る', 'すっかり', '暗い', '成る',
+    '帰宅', '成る', '一']
+]
+
+def read_output(i: int) -> pd.DataFrame:
+    return pd.read_csv(
+        TESTPATH + f"jp_text_logger_testWordCount_output{i}.csv", index_col=0
+    )
+
+def assert_same_table(test: pd.DataFrame, true: pd.DataFrame) -> None:
+    """Tables match up to the order of tied lemmas"""
+    pd.testing.assert_frame_equal(test.loc[true.index, :], true)
+    assert len(test) == len(true)
+
+# ---------------------------------------------------------------------------- #
+
+class WordCountTest(unittest.TestCase):
+
+    def test_count_words(self):
+        for i, lemmas in enumerate(TRUE_LEMMAS):
+            assert_same_table(wc.count_words(lemmas), read_output(i))
+
+    def test_iter_chunks(self):
+
+        with open(SAMPLES[1], **wc.FILE_OPTS) as file:
+            text = file.read()
+
+        chunks = list(wc.iter_chunks(text, size=100))
+        self.assertEqual(''.join(chunks), text)
+        self.assertTrue(all(len(c) <= 100 for c in chunks))
+        self.assertTrue(all(
+            wc.SENTENCE_END_REGEX.match(c[-1]) for c in chunks[:-1]
+        ))
+
+        # streamed lines give the same chunks as the whole text
+        with open(SAMPLES[1], **wc.FILE_OPTS) as file:
+            self.assertEqual(list(wc.iter_chunks(file, size=100)), chunks)
+
+    @unittest.skipIf(wc.Tagger is None, "requires fugashi")
+    def test_tag_lemmas(self):
+        for text, lemmas in zip(TEST_INPUTS, TRUE_LEMMAS):
+            self.assertEqual(wc.tag_lemmas(text), lemmas)
+
+    @unittest.skipIf(wc.Tagger is None, "requires fugashi")
+    def test_word_frequencies(self):
+        for i, text in enumerate(TEST_INPUTS):
+            assert_same_table(wc.word_frequencies(text), read_output(i))
+
+        # the cached tagger is reused
+        self.assertIs(wc.get_tagger(), wc.get_tagger())
+
+    @unittest.skipIf(wc.Tagger is None, "requires fugashi")
+    def test_count_files(self):
+
+        with open(SAMPLES[1], **wc.FILE_OPTS) as file:
+            whole = wc.count_lemmas(file.read(), chunk_chars=10**6)
+
+        self.assertEqual(wc.count_files(SAMPLES[1:], workers=1), whole)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i, text in enumerate(TEST_INPUTS):
+                paths.append(os.path.join(tmp, f"{i}.txt"))
+                with open(paths[-1], mode='w', encoding='utf8') as file:
+                    file.write(text)
+
+            counts = wc.count_files(paths + SAMPLES, workers=2)
+
+        expected = sum(
+            (wc.count_lemmas(t) for t in TEST_INPUTS), wc.Counter()
+        ) + wc.count_files(SAMPLES, workers=1)
+
+        self.assertEqual(counts, expected)
+
+if __name__ == '__main__':
+    unittest.main()